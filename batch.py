@@ -0,0 +1,168 @@
+import argparse
+import contextvars
+import dataclasses
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Dict, List, Optional
+
+from configurator import Config
+from driver import RETURN_CODES, create_query_engine, prepare_work_dir, run_pipeline
+from llms import QueryEngine
+from settings import Options
+
+
+def discover_benchmarks(
+    language: str, library: str, only: Optional[List[str]] = None
+) -> List[str]:
+    """
+    Lists the functions of a library under bms/ that have both a source file and
+    a json description.
+
+    Args:
+        language (str): Source language, i.e., the sub-directory of bms/.
+        library (str): Library directory, e.g. libopenaptx.
+        only (Optional[List[str]]): Restricts the result to these function names.
+
+    Returns:
+        List[str]: Sorted function names.
+    """
+    library_path = f"bms/{language}/{library}"
+    names = []
+    for name in sorted(os.listdir(library_path)):
+        if only and name not in only:
+            continue
+        if os.path.isfile(f"{library_path}/{name}/{name}.{language}") and os.path.isfile(
+            f"{library_path}/{name}/{name}.json"
+        ):
+            names.append(name)
+    return names
+
+
+# the benchmark the current thread works for, carried to the threads it
+# spawns by threads.ContextThreadPoolExecutor
+current_benchmark: "contextvars.ContextVar[Optional[str]]" = contextvars.ContextVar(
+    "current_benchmark", default=None
+)
+
+
+class BenchmarkFilter(logging.Filter):
+    """
+    Keeps the records emitted for one benchmark, so every worker logs to its own file.
+    """
+
+    def __init__(self, benchmark_name: str) -> None:
+        super().__init__()
+        self.benchmark_name = benchmark_name
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return current_benchmark.get() == self.benchmark_name
+
+
+def run_benchmark(options: Options, query_engine: QueryEngine) -> Dict[str, Any]:
+    """
+    Runs the whole pipeline for one benchmark in its own work_dir.
+
+    Returns:
+        Dict[str, Any]: Summary entry of the benchmark.
+    """
+    prepare_work_dir(options)
+
+    handler = logging.FileHandler(f"{options.work_dir}/transpilation.log", mode="w")
+    handler.setFormatter(logging.Formatter("%(name)s - %(levelname)s - %(message)s"))
+    handler.addFilter(BenchmarkFilter(options.benchmark_name))
+    logging.getLogger().addHandler(handler)
+    token = current_benchmark.set(options.benchmark_name)
+
+    start = time.time()
+    try:
+        return_code = run_pipeline(options, query_engine)
+        description = RETURN_CODES[return_code]
+    except Exception as e:
+        logging.exception(f"{options.benchmark_name} transpilation crashed.")
+        return_code = None
+        description = f"crashed ({type(e).__name__})"
+    finally:
+        current_benchmark.reset(token)
+        logging.getLogger().removeHandler(handler)
+        handler.close()
+
+    return {
+        "benchmark": options.benchmark_name,
+        "return_code": return_code,
+        "description": description,
+        "seconds": round(time.time() - start, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Transpile every function of a library under bms/ with a shared model."
+    )
+    parser.add_argument("--library", default="libopenaptx")
+    parser.add_argument("--language", default=None, help="defaults to the config")
+    parser.add_argument("--tag", default=None, help="defaults to the config")
+    parser.add_argument("--config", default="config.json")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--only", nargs="*", default=None)
+    args = parser.parse_args()
+
+    base_options = Config.from_json_file(args.config)
+    if args.language:
+        base_options = dataclasses.replace(base_options, language=args.language)
+    if args.tag:
+        base_options = dataclasses.replace(base_options, tag=args.tag)
+
+    names = discover_benchmarks(base_options.language, args.library, args.only)
+    if not names:
+        print(f"No benchmark found under bms/{base_options.language}/{args.library}")
+        return
+
+    logging.getLogger().setLevel(logging.INFO)
+
+    # the model is loaded once and shared by every worker
+    query_engine = create_query_engine(base_options)
+
+    print(f"DEBUG: Transpiling {len(names)} benchmarks with {args.workers} workers")
+    summary = []
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        futures = {
+            executor.submit(
+                run_benchmark,
+                dataclasses.replace(
+                    base_options,
+                    benchmark_name=f"{args.library}/{name}",
+                    submodule_name=name,
+                ),
+                query_engine,
+            ): name
+            for name in names
+        }
+        for future in as_completed(futures):
+            entry = future.result()
+            print(
+                f"DEBUG: {entry['benchmark']}: {entry['description']} ({entry['seconds']}s)"
+            )
+            summary.append(entry)
+
+    summary.sort(key=lambda entry: entry["benchmark"])
+    summary_dir = f"transpilations/{base_options.language}/{args.library}"
+    os.makedirs(summary_dir, exist_ok=True)
+    summary_path = f"{summary_dir}/{base_options.tag}_summary.json"
+    with open(summary_path, "w") as f:
+        json.dump(summary, f, indent=4)
+
+    counts: Dict[str, int] = {}
+    for entry in summary:
+        counts[entry["description"]] = counts.get(entry["description"], 0) + 1
+    for description, count in sorted(counts.items()):
+        print(f"{description}: {count}")
+    print(f"Summary written to {summary_path}")
+    if query_engine.response_cache is not None:
+        print(query_engine.response_cache.stats())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+import argparse
+import subprocess
+import sys
+from typing import List, Tuple
+
+# Modules that are expensive to import and only needed by some query engines
+HEAVY_MODULES = [
+    "torch",
+    "transformers",
+    "google.generativeai",
+    "boto3",
+    "botocore",
+    "openai",
+    "anthropic",
+    "httpx",
+    "matplotlib",
+]
+
+
+def import_time(module: str) -> Tuple[float, List[str]]:
+    """
+    Imports module in a fresh interpreter with -X importtime.
+
+    Returns:
+        Tuple[float, List[str]]: The cumulative import time in seconds and the
+            heavy modules that got imported along.
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+
+    total_us = 0
+    imported = set()
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        name = name[1:]
+        # nested imports are indented, only top-level ones add up to the total
+        if not name.startswith(" "):
+            total_us += int(cumulative)
+        imported.add(name.strip())
+
+    heavy = [module for module in HEAVY_MODULES if module in imported]
+    return total_us / 1e6, heavy
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the import time of modules.")
+    parser.add_argument(
+        "modules", nargs="*", default=["llms", "driver", "supervisor", "test_c_to_rust"]
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    for module in args.modules:
+        try:
+            measurements = [import_time(module) for _ in range(args.repeat)]
+        except RuntimeError as e:
+            print(f"{module}: failed to import ({e})")
+            continue
+        best = min(seconds for seconds, _ in measurements)
+        heavy = measurements[0][1]
+        print(f"{module}: {best:.3f}s, heavy modules: {', '.join(heavy) or 'none'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+import logging
+import re
+from typing import Callable, Dict, Iterable, Iterator, Optional, Tuple
+
+from llms import Prompt, QueryEngine
+
+SIGNATURE_NAME = re.compile(r"(\w+)\s*\([^;{}]*\)\s*$")
+
+
+def section_tokens(query_engine: QueryEngine, prompt: Prompt) -> Dict[str, int]:
+    """
+    Tokens taken by every section of prompt, as counted by the engine.
+    """
+    return {
+        "context": query_engine.count_tokens(prompt.context),
+        "instruction": query_engine.count_tokens(prompt.instruction),
+        "constraints": query_engine.count_tokens("\n".join(prompt.constraints)),
+        "extra_information": query_engine.count_tokens(prompt.extra_information),
+        "history": query_engine.count_tokens(
+            "\n".join(content for _, content in prompt.history)
+        ),
+    }
+
+
+def function_bodies(code: str) -> Iterator[Tuple[str, int, int]]:
+    """
+    Yields the name, start and end offsets of the body of every top-level
+    function of C-like code. Braces in comments and literals are skipped.
+    """
+    depth = 0
+    body_start = None
+    name = None
+    idx = 0
+    while idx < len(code):
+        if code.startswith("//", idx):
+            idx = code.find("\n", idx)
+            if idx == -1:
+                break
+            continue
+        if code.startswith("/*", idx):
+            idx = code.find("*/", idx + 2)
+            if idx == -1:
+                break
+            idx += 2
+            continue
+        char = code[idx]
+        if char in "\"'":
+            end = idx + 1
+            while end < len(code) and code[end] != char:
+                end += 2 if code[end] == "\\" else 1
+            idx = end + 1
+            continue
+        if char == "{":
+            if depth == 0:
+                header = code[code.rfind(";", 0, idx) + 1 : idx]
+                header = header[header.rfind("}") + 1 :]
+                match = SIGNATURE_NAME.search(header)
+                name = match.group(1) if match else None
+                body_start = idx
+            depth += 1
+        elif char == "}" and depth > 0:
+            depth -= 1
+            if depth == 0 and name is not None:
+                yield name, body_start, idx + 1
+                name = None
+        idx += 1
+
+
+def elide_functions(code: str, keep: Callable[[str], bool]) -> str:
+    """
+    Replace the body of every top-level function that keep rejects with an
+    ellipsis, leaving its signature in place.
+    """
+    elided = []
+    last = 0
+    for name, start, end in function_bodies(code):
+        if keep(name):
+            continue
+        elided.append(code[last:start] + "{ /* ... */ }")
+        last = end
+    elided.append(code[last:])
+    return "".join(elided)
+
+
+def fit_prompt(query_engine: QueryEngine, variants: Iterable[Prompt]) -> Prompt:
+    """
+    Pick the first prompt that fits the prompt budget of the engine.
+
+    Args:
+        query_engine (QueryEngine): The engine the prompt is meant for.
+        variants (Iterable[Prompt]): Prompts from the most to the least
+            detailed, generated lazily so that smaller variants are only built
+            when needed.
+
+    Returns:
+        Prompt: The first variant within budget, the last one when none is.
+    """
+    budget = query_engine.prompt_budget()
+    prompt: Optional[Prompt] = None
+    for level, prompt in enumerate(variants):
+        if budget is None:
+            return prompt
+        n_tokens = query_engine.prompt_tokens(prompt)
+        if n_tokens <= budget:
+            if level > 0:
+                logging.info(
+                    f"Prompt trimmed to {n_tokens} tokens at level {level} to fit a budget of {budget}."
+                )
+            return prompt
+    assert prompt is not None, "No prompt variant given"
+    logging.warning(
+        f"No prompt variant fits a budget of {budget} tokens: {section_tokens(query_engine, prompt)}"
+    )
+    return prompt
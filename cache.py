@@ -0,0 +1,140 @@
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator, Optional, Union
+
+
+def cache_root() -> Path:
+    """
+    Root directory of every persistent cache.
+
+    Defaults to ~/.cache/gaintrust and can be overridden with GAINTRUST_CACHE_DIR.
+    """
+    root = os.environ.get("GAINTRUST_CACHE_DIR")
+    if root:
+        return Path(root)
+    return Path.home() / ".cache" / "gaintrust"
+
+
+def digest(*parts: Union[str, bytes]) -> str:
+    """
+    Content hash of a sequence of parts. Parts are length-prefixed so that
+    ("ab", "c") and ("a", "bc") hash differently.
+    """
+    h = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode("utf-8")
+        h.update(str(len(part)).encode("utf-8") + b":")
+        h.update(part)
+    return h.hexdigest()
+
+
+def dir_size(path: Path) -> int:
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, filename)).st_size
+            except FileNotFoundError:
+                pass
+    return total
+
+
+class DiskCache:
+    """
+    A content-addressed cache of directories with size-bounded LRU eviction
+
+    Every entry is a directory named after its key, so callers can store any
+    number of files per entry. Entries are written to a temporary directory and
+    renamed into place, so concurrent writers never observe partial entries.
+
+    Args:
+        name (str): Sub-directory of the cache root holding this cache.
+        max_bytes (int): Entries are evicted, least recently used first, once
+            the cache grows beyond this size.
+    """
+
+    def __init__(self, name: str, max_bytes: int) -> None:
+        self.name = name
+        self.root = cache_root() / name
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    def path(self, key: str) -> Path:
+        return self.root / key
+
+    def get(self, key: str) -> Optional[Path]:
+        """
+        Returns the entry directory of key, or None on a miss.
+        """
+        entry = self.path(key)
+        if not entry.is_dir():
+            self.misses += 1
+            return None
+        try:
+            os.utime(entry)  # mark as recently used
+        except FileNotFoundError:
+            # evicted by a concurrent writer
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry
+
+    @contextmanager
+    def put(self, key: str) -> Iterator[Path]:
+        """
+        Yields a scratch directory that becomes the entry of key on success.
+        """
+        self.root.mkdir(parents=True, exist_ok=True)
+        scratch = Path(tempfile.mkdtemp(prefix=".tmp-", dir=self.root))
+        try:
+            yield scratch
+            try:
+                os.rename(scratch, self.path(key))
+            except OSError:
+                # another writer won the race, keep theirs
+                pass
+        finally:
+            shutil.rmtree(scratch, ignore_errors=True)
+        self.evict()
+
+    def evict(self) -> None:
+        if not self.root.is_dir():
+            return
+        entries = []
+        total = 0
+        for entry in self.root.iterdir():
+            if entry.name.startswith(".tmp-"):
+                continue
+            try:
+                mtime = entry.stat().st_mtime
+            except FileNotFoundError:
+                continue
+            size = dir_size(entry)
+            entries.append((mtime, size, entry))
+            total += size
+
+        entries.sort()
+        for _, size, entry in entries:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+            logging.info(f"Evicted {entry.name} from {self.name} cache.")
+
+    def clear(self) -> None:
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self) -> str:
+        return f"{self.name} cache: {self.hits} hits, {self.misses} misses ({self.hit_rate:.0%} hit rate)"
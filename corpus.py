@@ -0,0 +1,161 @@
+import json
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+from pathlib import Path
+from typing import Any, Dict, List
+
+from cache import cache_root, digest
+
+
+class CorpusStore:
+    """
+    Fuzzing state shared by every candidate of one benchmark
+
+    Holds the libFuzzer corpus, which seeds the verification of new candidates
+    and receives what their fuzzing discovered, and a bank of I/O examples
+    found so far. Corpus files are named after their content by libFuzzer, so
+    merging is a union of file names.
+
+    Args:
+        root (Path): Directory of the store.
+        max_corpus_files (int): The corpus is minimized once it grows beyond this.
+        max_examples (int): Number of I/O examples kept in the bank.
+    """
+
+    def __init__(
+        self, root: Path, max_corpus_files: int = 2000, max_examples: int = 500
+    ) -> None:
+        self.root = root
+        self.corpus_dir = root / "corpus"
+        self.bank_file = root / "examples.json"
+        self.max_corpus_files = max_corpus_files
+        self.max_examples = max_examples
+        self.lock = threading.Lock()
+        self.corpus_dir.mkdir(parents=True, exist_ok=True)
+
+    def corpus_size(self) -> int:
+        return sum(1 for _ in self.corpus_dir.iterdir())
+
+    def seed(self, corpus_dir: str) -> int:
+        """
+        Copy the stored corpus into corpus_dir.
+
+        Returns:
+            int: Number of seeded inputs.
+        """
+        os.makedirs(corpus_dir, exist_ok=True)
+        n_seeds = 0
+        with self.lock:
+            for path in self.corpus_dir.iterdir():
+                shutil.copy(path, corpus_dir)
+                n_seeds += 1
+        return n_seeds
+
+    def merge_back(self, corpus_dir: str) -> int:
+        """
+        Add the inputs of corpus_dir that are not stored yet.
+
+        Returns:
+            int: Number of new inputs.
+        """
+        if not os.path.isdir(corpus_dir):
+            return 0
+        n_new = 0
+        with self.lock:
+            for name in os.listdir(corpus_dir):
+                target = self.corpus_dir / name
+                if target.exists():
+                    continue
+                # copy then rename, concurrent readers never see partial inputs
+                tmp = self.corpus_dir / f".{name}.tmp"
+                shutil.copy(os.path.join(corpus_dir, name), tmp)
+                os.replace(tmp, target)
+                n_new += 1
+        return n_new
+
+    def reduce(self, fuzz_target: str, main_entry: str, env: Dict[str, str]) -> None:
+        """
+        Minimize the stored corpus with cargo bolero reduce once it grew too large.
+
+        Args:
+            fuzz_target (str): A fuzz target of the benchmark used to replay the corpus.
+            main_entry (str): The fuzzing test.
+            env (Dict[str, str]): Environment of the fuzzing command.
+        """
+        with self.lock:
+            size = self.corpus_size()
+            if size <= self.max_corpus_files:
+                return
+            logging.info(f"Reducing a corpus of {size} inputs.")
+            result = subprocess.run(
+                f"cargo bolero reduce --manifest-path {fuzz_target}/Cargo.toml "
+                f"--features fuzzing {main_entry} --target-dir {fuzz_target}/target/__fuzz__ "
+                f"--sanitizer NONE --corpus-dir {self.corpus_dir}",
+                shell=True,
+                capture_output=True,
+                env=env,
+            )
+            if result.returncode != 0:
+                logging.info("Failed to reduce the corpus.")
+                return
+            logging.info(f"Corpus reduced to {self.corpus_size()} inputs.")
+
+    def _load_examples(self) -> List[Any]:
+        if not self.bank_file.exists():
+            return []
+        try:
+            return json.loads(self.bank_file.read_text())
+        except json.JSONDecodeError:
+            return []
+
+    def examples(self) -> List[Any]:
+        """
+        The example bank, counter examples of earlier candidates first.
+        """
+        with self.lock:
+            return self._load_examples()
+
+    def record_examples(self, positive_examples: str, counter_examples: str) -> int:
+        """
+        Add examples to the bank, keeping at most max_examples.
+
+        Returns:
+            int: Number of new examples.
+        """
+        with self.lock:
+            old = self._load_examples()
+            n_old = len(old)
+            bank: Dict[str, Any] = {}
+            # counter examples discriminate candidates best, keep them first
+            for example in json.loads(counter_examples) + old + json.loads(positive_examples):
+                bank.setdefault(json.dumps(example, sort_keys=True), example)
+            examples = list(bank.values())[: self.max_examples]
+
+            with tempfile.NamedTemporaryFile(
+                "w", dir=self.root, suffix=".tmp", delete=False
+            ) as f:
+                json.dump(examples, f)
+            os.replace(f.name, self.bank_file)
+        return len(bank) - n_old
+
+
+_stores: Dict[str, CorpusStore] = {}
+_stores_lock = threading.Lock()
+
+
+def corpus_store(language: str, submodule_name: str, src_code: str) -> CorpusStore:
+    """
+    The store of a benchmark, shared by every thread of the process.
+
+    Stores live under the cache root and are keyed by the benchmark source, so
+    editing a benchmark starts from an empty corpus.
+    """
+    key = f"{submodule_name}-{digest(language, submodule_name, src_code)[:16]}"
+    with _stores_lock:
+        if key not in _stores:
+            _stores[key] = CorpusStore(cache_root() / "corpus" / key)
+        return _stores[key]
@@ -0,0 +1,256 @@
+import logging
+import os
+import queue
+import shutil
+import subprocess
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterator, Optional
+
+from cache import cache_root, digest
+
+# Every candidate is compiled against the same set of crates
+DEPENDENCIES: Dict[str, str] = {
+    "rand": "0.8.4",
+    "libc": "0.2",
+    "regex": "1.10.2",
+    "lazy_static": "1.4.0",
+    "once_cell": "1.19.0",
+}
+
+EDITION = "2021"
+
+
+def crate_name(work_dir: str) -> str:
+    # cargo new names the package after its directory
+    return Path(work_dir).resolve().name
+
+
+def manifest(name: str) -> str:
+    dependencies = "".join(
+        f'{dep} = "{version}"\n' for dep, version in DEPENDENCIES.items()
+    )
+    return (
+        "[package]\n"
+        f'name = "{name}"\n'
+        'version = "0.1.0"\n'
+        f'edition = "{EDITION}"\n'
+        "\n"
+        "[dependencies]\n"
+        f"{dependencies}"
+    )
+
+
+def init_crate(work_dir: str) -> bool:
+    """
+    Create a library crate with the default dependencies at work_dir unless one exists.
+
+    Returns:
+        bool: Whether a new crate has been created.
+    """
+    crate_toml = Path(work_dir) / "Cargo.toml"
+    if crate_toml.exists():
+        return False
+    os.makedirs(f"{work_dir}/src", exist_ok=True)
+    crate_toml.write_text(manifest(crate_name(work_dir)), encoding="utf-8")
+    lib_rs = Path(work_dir) / "src" / "lib.rs"
+    if not lib_rs.exists():
+        lib_rs.write_text("", encoding="utf-8")
+    return True
+
+
+def dependency_target_dir() -> str:
+    """
+    Target directory dependencies are compiled into once, and which the target
+    directory of every crate is seeded from.
+
+    Can be overridden with GAINTRUST_TARGET_DIR.
+    """
+    target_dir = os.environ.get("GAINTRUST_TARGET_DIR")
+    if target_dir:
+        return target_dir
+    # keyed by the dependency set so that changing it starts from a fresh directory
+    return str(cache_root() / "target" / digest(manifest("wspace"))[:16])
+
+
+# artifacts of a package in a target directory, per profile directory
+PACKAGE_ARTIFACTS = [
+    ".fingerprint/{name}-*",
+    "build/{name}-*",
+    "deps/{name}-*",
+    "deps/lib{name}-*",
+    "incremental/{name}-*",
+    "lib{name}.*",
+    "{name}.d",
+]
+
+
+def drop_package_artifacts(target_dir: str, name: str) -> None:
+    """
+    Remove the artifacts of package name from every profile of target_dir.
+    """
+    for profile in Path(target_dir).iterdir():
+        if not profile.is_dir():
+            continue
+        for pattern in PACKAGE_ARTIFACTS:
+            for path in profile.glob(pattern.format(name=name.replace("-", "_"))):
+                if path.is_dir() and not path.is_symlink():
+                    shutil.rmtree(path, ignore_errors=True)
+                else:
+                    path.unlink(missing_ok=True)
+
+
+def seed_target_dir(target_dir: str) -> None:
+    """
+    Create target_dir as a copy of the shared dependency target directory, so
+    that a crate compiles with its own target directory without rebuilding
+    dependencies.
+
+    The warm-up crate is a wspace package like every crate, so its artifacts
+    are dropped from the copy. Otherwise cargo would take them for an up to
+    date build of the new crate, whatever its code.
+    """
+    if os.path.exists(target_dir):
+        return
+    if not os.path.isdir(dependency_target_dir()):
+        os.makedirs(target_dir, exist_ok=True)
+        return
+    # copy then rename, a concurrent seeding of the same directory keeps its copy
+    tmp = f"{target_dir}.{os.getpid()}-{threading.get_ident()}.tmp"
+    shutil.copytree(dependency_target_dir(), tmp, symlinks=True)
+    drop_package_artifacts(tmp, "wspace")
+    try:
+        os.replace(tmp, target_dir)
+    except OSError:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def crate_target_dir(work_dir: str) -> str:
+    """
+    Target directory of the crate at work_dir, seeded from the dependency
+    target directory on first use.
+
+    Every crate has its own, the shared one is only ever built by
+    warm_dependencies, so that concurrent workers neither wait on the cargo
+    lock of one directory nor clean each other's artifacts.
+    """
+    target_dir = f"{work_dir}/target"
+    seed_target_dir(target_dir)
+    return target_dir
+
+
+def cargo_env(
+    work_dir: str, rustflags: Optional[str] = None, target_dir: Optional[str] = None
+) -> Dict[str, str]:
+    env = os.environ.copy()
+    env["CARGO_TARGET_DIR"] = target_dir or crate_target_dir(work_dir)
+    if rustflags is not None:
+        env["RUSTFLAGS"] = rustflags
+    return env
+
+
+def clean(work_dir: str, target_dir: Optional[str] = None) -> None:
+    """
+    Remove the artifacts of the crate at work_dir from its own target
+    directory, keeping compiled dependencies.
+    """
+    target_dir = target_dir or f"{work_dir}/target"
+    if not os.path.isdir(target_dir):
+        return
+    subprocess.run(
+        ["cargo", "clean", "-p", crate_name(work_dir)],
+        capture_output=True,
+        cwd=work_dir,
+        env=cargo_env(work_dir, target_dir=target_dir),
+    )
+
+
+_warm_lock = threading.Lock()
+_warmed = set()
+
+
+def warm_dependencies(
+    rustflags: str, command: str = "build", target_dir: Optional[str] = None
+) -> None:
+    """
+    Compile the default dependencies into the shared target directory.
+
+    Dependency artifacts are only reused under identical RUSTFLAGS and cargo
+    command, so every combination in use has to be warmed.
+    """
+    target_dir = target_dir or dependency_target_dir()
+    with _warm_lock:
+        if (rustflags, command, target_dir) in _warmed:
+            return
+        template = cache_root() / "template" / digest(target_dir)[:16] / "wspace"
+        init_crate(str(template))
+        logging.info(f"Warming up dependencies in {target_dir} with cargo {command}.")
+        subprocess.run(
+            ["cargo", command, "--manifest-path", "Cargo.toml"],
+            capture_output=True,
+            cwd=template,
+            env=cargo_env(str(template), rustflags, target_dir),
+        )
+        _warmed.add((rustflags, command, target_dir))
+
+
+class CratePool:
+    """
+    A pool of pre-initialized wspace crates.
+
+    Each crate has its own target directory, seeded from the shared dependency
+    target directory, so that crates can be compiled concurrently without
+    waiting on cargo's build directory lock and without rebuilding dependencies.
+
+    Args:
+        root (str): Directory holding the crates of the pool.
+        size (int): Number of crates.
+        rustflags (str): RUSTFLAGS every crate is compiled with.
+        command (str): The cargo command crates are compiled with, build or check.
+    """
+
+    def __init__(
+        self, root: str, size: int, rustflags: str, command: str = "build"
+    ) -> None:
+        self.root = root
+        self.size = size
+        self.rustflags = rustflags
+        self.free: "queue.Queue[str]" = queue.Queue()
+
+        warm_dependencies(rustflags, command)
+        for idx in range(size):
+            slot = f"{root}/slot_{idx}"
+            init_crate(f"{slot}/wspace")
+            seed_target_dir(f"{slot}/target")
+            self.free.put(slot)
+
+    def acquire(self) -> str:
+        """
+        Borrows a crate of the pool, blocking until one is free.
+
+        Returns:
+            str: The crate directory.
+        """
+        return f"{self.free.get()}/wspace"
+
+    def release(self, crate_dir: str) -> None:
+        self.free.put(str(Path(crate_dir).parent))
+
+    @contextmanager
+    def crate(self) -> Iterator[str]:
+        """
+        Borrows a crate of the pool. Yields the crate directory.
+        """
+        crate_dir = self.acquire()
+        try:
+            yield crate_dir
+        finally:
+            self.release(crate_dir)
+
+    @staticmethod
+    def target_dir(crate_dir: str) -> str:
+        return str(Path(crate_dir).parent / "target")
+
+    def close(self) -> None:
+        shutil.rmtree(self.root, ignore_errors=True)
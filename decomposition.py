@@ -0,0 +1,247 @@
+import logging
+import re
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Set, Tuple
+
+STRUCT_NAME = re.compile(r"\bstruct\s+(\w+)")
+ENUM_NAME = re.compile(r"\benum\s+(\w+)")
+# the last identifier of a typedef, also for function pointers: typedef int (*name)(int);
+TYPEDEF_NAME = re.compile(r"(\w+)\s*\)?\s*(?:\([^()]*\))?\s*;\s*$")
+RUST_FN = re.compile(
+    r"^[ \t]*((?:pub(?:\([^)]*\))?\s+)?(?:(?:const|unsafe|extern\s+\"C\")\s+)*fn\s+(\w+)[^{;]*)",
+    re.M,
+)
+
+
+@dataclass
+class Function:
+    """
+    A function of a benchmark and what it depends on
+
+    Args:
+        calls (Set[str]): Functions of the benchmark it calls.
+        types (Set[str]): Structs, typedefs and enums it mentions, directly or
+            through the definitions of other types.
+    """
+
+    name: str
+    declaration: str
+    implementation: str
+    calls: Set[str] = field(default_factory=set)
+    types: Set[str] = field(default_factory=set)
+
+
+def function_name(declaration: str, implementation: str, language: str) -> str:
+    if language == "c":
+        return declaration.split("(")[0].split("\n")[-1].strip().split(" ")[-1].lstrip("*")
+    return implementation.split("{")[0].split("(")[-2].split("\n")[-1].strip().split(" ")[-1]
+
+
+def header_code(source_dict: Dict[str, Any]) -> str:
+    """
+    Everything of a benchmark json but its functions: includes, enums,
+    typedefs, defines, globals and structs.
+    """
+    all_aux = (
+        "\n".join(source_dict["Enums"])
+        + "\n"
+        + "\n".join(source_dict["TypeDefs"])
+        + "\n"
+        + "\n".join(source_dict["Defines"])
+        + "\n"
+        + "\n".join(source_dict["Globals"])
+    )
+    all_imp = "\n".join(source_dict["Includes"])
+    all_st = "\n".join(source_dict["Structs"])
+    return "\n" + all_imp + "\n" + all_aux + "\n" + all_st
+
+
+def type_definitions(source_dict: Dict[str, Any]) -> Dict[str, str]:
+    """
+    Maps the name of every struct, typedef and enum of a benchmark to its definition.
+    """
+    definitions = {}
+    for struct in source_dict["Structs"]:
+        match = STRUCT_NAME.search(struct)
+        if match:
+            definitions[match.group(1)] = struct
+    for enum in source_dict["Enums"]:
+        match = ENUM_NAME.search(enum)
+        if match:
+            definitions[match.group(1)] = enum
+    for type_def in source_dict["TypeDefs"]:
+        match = TYPEDEF_NAME.search(type_def.strip())
+        if match:
+            definitions[match.group(1)] = type_def
+    return definitions
+
+
+def mentions(code: str, names: Set[str]) -> Set[str]:
+    return {name for name in names if re.search(rf"\b{name}\b", code)}
+
+
+def dependency_graph(source_dict: Dict[str, Any], language: str) -> Dict[str, Function]:
+    """
+    Build the call and type dependencies of the functions of a benchmark json.
+
+    Returns:
+        Dict[str, Function]: Functions by name, in source order.
+    """
+    graph: Dict[str, Function] = {}
+    for declaration, implementation in zip(
+        source_dict["Function Declarations"], source_dict["Function Implementations"]
+    ):
+        name = function_name(declaration, implementation, language)
+        graph[name] = Function(name, declaration, implementation)
+
+    definitions = type_definitions(source_dict)
+    type_names = set(definitions)
+    # types used by the definition of other types
+    type_deps = {
+        name: mentions(definition, type_names - {name})
+        for name, definition in definitions.items()
+    }
+    for function in graph.values():
+        body = function.implementation[function.implementation.find("{") :]
+        function.calls = {
+            name
+            for name in graph
+            if name != function.name and re.search(rf"\b{name}\s*\(", body)
+        }
+        pending = list(mentions(function.implementation, type_names))
+        while pending:
+            name = pending.pop()
+            if name not in function.types:
+                function.types.add(name)
+                pending.extend(type_deps[name])
+    return graph
+
+
+def components(graph: Dict[str, Function]) -> List[Tuple[str, ...]]:
+    """
+    Strongly connected components of the call graph, i.e. sets of mutually
+    recursive functions, which have to be translated together. Functions
+    outside of call cycles are components of their own.
+
+    Returns:
+        List[Tuple[str, ...]]: Components in source order, and the functions of
+        a component in source order too.
+    """
+    order = {name: idx for idx, name in enumerate(graph)}
+    index: Dict[str, int] = {}
+    lowlink: Dict[str, int] = {}
+    stack: List[str] = []
+    on_stack: Set[str] = set()
+    result: List[Tuple[str, ...]] = []
+
+    # Tarjan's algorithm, iteratively since call chains can be long
+    for root in graph:
+        if root in index:
+            continue
+        work = [(root, iter(sorted(graph[root].calls, key=order.get)))]
+        index[root] = lowlink[root] = len(index)
+        stack.append(root)
+        on_stack.add(root)
+        while work:
+            name, calls = work[-1]
+            callee = next(calls, None)
+            if callee is not None:
+                if callee not in index:
+                    index[callee] = lowlink[callee] = len(index)
+                    stack.append(callee)
+                    on_stack.add(callee)
+                    work.append((callee, iter(sorted(graph[callee].calls, key=order.get))))
+                elif callee in on_stack:
+                    lowlink[name] = min(lowlink[name], index[callee])
+                continue
+            work.pop()
+            if work:
+                caller = work[-1][0]
+                lowlink[caller] = min(lowlink[caller], lowlink[name])
+            if lowlink[name] == index[name]:
+                component = []
+                while True:
+                    member = stack.pop()
+                    on_stack.discard(member)
+                    component.append(member)
+                    if member == name:
+                        break
+                result.append(tuple(sorted(component, key=order.get)))
+    return sorted(result, key=lambda component: order[component[0]])
+
+
+def levels(graph: Dict[str, Function]) -> List[List[Tuple[str, ...]]]:
+    """
+    Group the components of the call graph into levels that only call
+    components of earlier levels, so that the components of a level can be
+    translated concurrently.
+    """
+    remaining = components(graph)
+    done: Set[str] = set()
+    result = []
+    while remaining:
+        level = [
+            component
+            for component in remaining
+            if set().union(*(graph[name].calls for name in component)) <= done | set(component)
+        ]
+        result.append(level)
+        for component in level:
+            if len(component) > 1:
+                logging.info(f"Call cycle among {', '.join(component)}, translating them together.")
+            done.update(component)
+        remaining = [component for component in remaining if component not in level]
+    return result
+
+
+def callees(graph: Dict[str, Function], names: Tuple[str, ...]) -> List[str]:
+    """
+    Functions the functions of names call, directly or not, in source order.
+    """
+    seen: Set[str] = set()
+    pending = [callee for name in names for callee in graph[name].calls]
+    while pending:
+        callee = pending.pop()
+        if callee not in seen and callee not in names:
+            seen.add(callee)
+            pending.extend(graph[callee].calls)
+    return [function for function in graph if function in seen]
+
+
+def rust_signatures(rust_code: str) -> Dict[str, str]:
+    """
+    Maps the name of every function of rust_code to its signature.
+    """
+    return {
+        match.group(2): " ".join(match.group(1).split())
+        for match in RUST_FN.finditer(rust_code)
+    }
+
+
+def strip_in_scope(rust_code: str, in_scope: str) -> str:
+    """
+    Drop the use declarations of rust_code that in_scope already has, since
+    translations of single functions tend to repeat the imports they were shown.
+    """
+    imports = {line.strip() for line in in_scope.splitlines() if line.strip().startswith("use ")}
+    return "\n".join(
+        line for line in rust_code.splitlines() if line.strip() not in imports
+    )
+
+
+def assemble(parts: List[str]) -> str:
+    """
+    Join translated pieces of code, hoisting their use declarations to the top
+    once each, since pieces translated separately tend to repeat imports.
+    """
+    imports: Dict[str, None] = {}
+    bodies = []
+    for part in parts:
+        lines = []
+        for line in part.splitlines():
+            if line.strip().startswith("use ") and line.strip().endswith(";"):
+                imports.setdefault(line.strip(), None)
+            else:
+                lines.append(line)
+        bodies.append("\n".join(lines))
+    return "\n".join(list(imports) + bodies)
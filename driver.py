@@ -15,13 +15,23 @@ import shutil
 
 from utils import *
 from fixer import Fixer
-from llms import QueryEngineFactory
+from llms import QueryEngine, QueryEngineFactory, ResponseCache
 from transpiler import Transpiler
 from settings import Options
 import oracle
 from semantics import Candidate, CandidateFactory, SemanticsStrategy
 from configurator import Config
-import csv
+
+RETURN_CODES = {
+    0: "no compiling candidate",
+    1: "equivalent at initial attempt",
+    2: "equivalent after fallback",
+    3: "fixed once, not equivalent",
+    4: "oracle out of scope",
+    5: "oracle partially out of scope",
+    6: "not equivalent",
+}
+
 
 def record_cov_data(report: str, show: List[Tuple[str, str]], work_dir: str):
     with open(f"{work_dir}/cov_report.txt", "w") as f:
@@ -52,6 +62,11 @@ def construct_factory(options: Options) -> CandidateFactory:
         options.language,
         options.submodule_name,
         options.sem_fix,
+        fuzz_shards=options.fuzz_shards,
+        max_counter_examples=options.max_counter_examples,
+        fuzz_plateau_seconds=options.fuzz_plateau_seconds,
+        reuse_fuzz_corpus=options.reuse_fuzz_corpus,
+        tiered_verification=options.tiered_verification,
     )
 
     return factory
@@ -99,52 +114,67 @@ def initial_transpilation(
             return candidate, factory
         else:
             logging.info("Candidate does not compile. Retrying.")
-            with open("measurements.csv", 'w', newline='') as csvfile:
-                writer = csv.writer(csvfile)
-                writer.writerow({"model_name": options.model, "file_name": options.submodule_name})
-    
+            start_measurement(options.model, options.submodule_name)
 
     return None
 
 
-def main():
-    #parser = ArgumentParser(Options)
-    #options = parser.parse_args()
-    options = Config.from_json_file("config.json")
-
+def create_query_engine(options: Options) -> QueryEngine:
     global_constraints = []
     if options.language == "c":
         global_constraints.append("Consider using functions like `wrapping_add` to simulate C semantics.")
 
     query_engine = QueryEngineFactory.create_engine(options.model, global_constraints)
+    if options.response_cache:
+        query_engine.response_cache = ResponseCache(
+            int(os.environ.get("GAINTRUST_RESPONSE_CACHE_MB", "512")) * 2**20,
+            ttl_seconds=float(os.environ.get("GAINTRUST_RESPONSE_CACHE_TTL_HOURS", "0")) * 3600,
+        )
+    return query_engine
+
 
+def prepare_work_dir(options: Options) -> None:
     if os.path.exists(options.work_dir):
         shutil.rmtree(options.work_dir)
     os.makedirs(options.work_dir)
 
     Config.to_json_file(options.work_dir + "config.json", options)
 
+    # record first-time compile rate, compile rate, and testcase pass rate
+    start_measurement(options.model, options.submodule_name)
+
+
+def main():
+    #parser = ArgumentParser(Options)
+    #options = parser.parse_args()
+    options = Config.from_json_file("config.json")
+
+    query_engine = create_query_engine(options)
+
+    prepare_work_dir(options)
+
     crash_report = open(f"{options.work_dir}/crash_report.txt", "w")
     sys.stderr.write = crash_report.write
 
-    # file to record first-time compile rate, compile rate, and testcase pass rate
-    if not os.path.exists('measurements.csv'):
-        with open('measurements.csv', 'w') as csvfile:
-            fieldnames = ['model_name', 'file_name', 'initial_translation', 'initial_translation_attempts', "initital_translation_errors", "clippy_style", "clippy_complexity", "clippy_correctness", "clippy_performance", "compiles", "compiles_attempts", "final_translation_errors"]
-            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-            writer.writeheader()
-        
-    with open('measurements.csv', 'a') as csvfile:
-        fieldnames = ["model_name", "file_name"]
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-        writer.writerow({"model_name": options.model, "file_name": options.submodule_name})
-
     logging.basicConfig(
         filename="%s/transpilation.log" % options.work_dir,
         level=logging.INFO,
         filemode="w",
         format="%(name)s - %(levelname)s - %(message)s",
     )
+
+    run_pipeline(options, query_engine)
+    if query_engine.response_cache is not None:
+        logging.info(query_engine.response_cache.stats())
+
+
+def run_pipeline(options: Options, query_engine: QueryEngine) -> int:
+    """
+    Transpiles a single benchmark: initial translation, then the fallback strategy.
+
+    Returns:
+        int: The return code of the transpilation, see RETURN_CODES.
+    """
     logging.info("%s transpilation has started." % options.benchmark_name)
 
     rng = np.random.default_rng(123)
@@ -153,7 +183,11 @@ def main():
         comp_fixer = None
     else:
         comp_fixer = Fixer(
-            options.comp_fix_m, query_engine, options.comp_fix_attempt_budget
+            options.comp_fix_m,
+            query_engine,
+            options.comp_fix_attempt_budget,
+            compile_mode=options.compile_mode,
+            samples_per_call=options.samples_per_call,
         )
     eq_fixer = None
 
@@ -177,6 +211,9 @@ def main():
             options.transpl_attempt_budget,
             options.work_dir,
             model_params={"temperature": options.initial_temperature},
+            compile_mode=options.compile_mode,
+            parallel_candidates=options.parallel_candidates,
+            samples_per_call=options.samples_per_call,
         )
     else:
         transpiler = Transpiler(
@@ -190,6 +227,9 @@ def main():
             options.transpl_attempt_budget,
             options.work_dir,
             model_params={"temperature": options.initial_temperature},
+            compile_mode=options.compile_mode,
+            parallel_candidates=options.parallel_candidates,
+            samples_per_call=options.samples_per_call,
         )
 
 
@@ -198,7 +238,7 @@ def main():
     transpilation = initial_transpilation(transpiler, options)
     if not transpilation:
         logging.info("Failed to find compilable/checkable candidate. Return Code: 0.")
-        return
+        return 0
 
     candidate, factory = transpilation
     if candidate.ok:
@@ -206,7 +246,7 @@ def main():
         logging.info(
             "Transpilation finished. Equivalent transpilation has been found at initial attempt. Return Code: 1."
         )
-        return
+        return 1
 
     # FALLBACK
     num_oracle_oos = 0
@@ -242,7 +282,7 @@ def main():
                     logging.info(
                         f"Equivalent transpilation has been found by {fallback} strategy. Return Code: 2"
                     )
-                    return
+                    return 2
                 else:
                     pass  # TODO: will think about later. At the moment restart budget always set to 1 for fix.
         else:
@@ -264,7 +304,7 @@ def main():
             elif fallback == "prompt-search":
                 transpiler.prompt = "mutate"
             elif fallback == "simplify":
-                transpiler.prompt = "decomp-iter"
+                transpiler.prompt = f"decomp-{options.decomposition}"
 
             compiles = transpiler.transpile()
             if not compiles:
@@ -282,22 +322,26 @@ def main():
                 logging.info(
                     f"Equivalent transpilation has been found by {fallback} strategy. Restart id: {restart_idx}. Return Code: 2"
                 )
-                return
+                return 2
 
     if fixed_once:
         logging.info(
             "Fallback process failed cleaning semantic errors. Return Code: 3"
         )  # special failure case
+        return 3
     elif num_oracle_oos > 5:
         logging.info(
             "Fallback process failed cleaning semantic errors. Return Code: 4"
         )  # Oracle OOS
+        return 4
     elif num_oracle_oos > 0:
         logging.info(
             "Fallback process failed cleaning semantic errors. Return Code: 5"
         )  # Oracle Partially OOS
+        return 5
     else:
         logging.info("Fallback process failed cleaning semantic errors. Return Code: 6")
+        return 6
 
 
 if __name__ == "__main__":
@@ -40,3 +40,41 @@ class Error:
 
         self.context = context
         self.residual = residual
+
+    @classmethod
+    def from_diagnostic(cls, diagnostic: dict) -> "Error":
+        """
+        Build an error from a rustc JSON diagnostic (the `message` field of a
+        cargo compiler-message record) without re-parsing its rendered text.
+        """
+        err = cls.__new__(cls)
+        err.body = diagnostic.get("rendered") or diagnostic["message"]
+
+        code = diagnostic.get("code")
+        # same format as the textual parser, e.g. "error[E0308]:"
+        err.code = f"error[{code['code']}]:" if code else "error:"
+        err.message = " " + diagnostic["message"]
+
+        err.location = ""
+        context = ""
+        for span in diagnostic.get("spans", []):
+            if span.get("is_primary") and not err.location:
+                err.location = (
+                    f"{span['file_name']}:{span['line_start']}:{span['column_start']}"
+                )
+            for text in span.get("text", []):
+                context = context + text["text"] + "\n"
+            if span.get("label"):
+                context = context + span["label"] + "\n"
+        err.context = context
+
+        err.diagnostic = ""
+        residual = ""
+        for child in diagnostic.get("children", []):
+            if child["message"].startswith("-Ztrack-diagnostics:"):
+                err.diagnostic = child["message"].split("/")[1]
+            else:
+                residual = residual + child["message"] + "\n"
+        err.residual = residual
+
+        return err
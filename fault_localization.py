@@ -0,0 +1,122 @@
+from typing import Callable, Dict, List, Tuple
+
+import numpy as np
+
+# Spectrum of every line: examples that pass/fail and cover/do not cover it
+Spectrum = Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]
+
+
+def spectrum(coverage: np.ndarray, failing: np.ndarray) -> Spectrum:
+    """
+    Compute the program spectrum of every line
+
+    Args:
+        coverage (np.ndarray): A boolean examples x lines matrix, true if the example covers the line.
+        failing (np.ndarray): A boolean vector, true if the example is a counter example.
+
+    Returns:
+        Spectrum: ep, ef, np, nf per line.
+    """
+    coverage = np.asarray(coverage, dtype=bool)
+    failing = np.asarray(failing, dtype=bool)
+    if coverage.ndim != 2 or coverage.shape[0] != failing.shape[0]:
+        raise ValueError(
+            f"Coverage of shape {coverage.shape} does not match {failing.shape[0]} examples"
+        )
+
+    # column-wise counts over boolean rows beat an integer matrix product,
+    # which numpy cannot hand to BLAS
+    ef = np.count_nonzero(coverage[failing], axis=0)
+    ep = np.count_nonzero(coverage[~failing], axis=0)
+    nf = np.count_nonzero(failing) - ef
+    np_ = np.count_nonzero(~failing) - ep
+    return ep, ef, np_, nf
+
+
+def _div(num: np.ndarray, den: np.ndarray) -> np.ndarray:
+    num = np.asarray(num, dtype=np.float64)
+    den = np.asarray(den, dtype=np.float64)
+    return np.divide(num, den, out=np.zeros(np.broadcast(num, den).shape), where=den != 0)
+
+
+def ochiai(ep, ef, np_, nf) -> np.ndarray:
+    return _div(ef, np.sqrt((ef + nf) * (ef + ep)))
+
+
+def tarantula(ep, ef, np_, nf) -> np.ndarray:
+    fail_ratio = _div(ef, ef + nf)
+    pass_ratio = _div(ep, ep + np_)
+    return _div(fail_ratio, fail_ratio + pass_ratio)
+
+
+def dstar(ep, ef, np_, nf, star: int = 3) -> np.ndarray:
+    num = np.asarray(ef, dtype=np.float64) ** star
+    den = ep + nf
+    # an undefined score counts as 1, as it always has for existing callers
+    return np.where(den == 0, 1.0, _div(num, den))
+
+
+def jaccard(ep, ef, np_, nf) -> np.ndarray:
+    return _div(ef, ef + nf + ep)
+
+
+def op2(ep, ef, np_, nf) -> np.ndarray:
+    return ef - _div(ep, ep + np_ + 1)
+
+
+def barinel(ep, ef, np_, nf) -> np.ndarray:
+    return np.where(ep + ef == 0, 0, 1 - _div(ep, ep + ef))
+
+
+def kulczynski2(ep, ef, np_, nf) -> np.ndarray:
+    return 0.5 * (_div(ef, ef + nf) + _div(ef, ef + ep))
+
+
+FORMULAS: Dict[str, Callable[..., np.ndarray]] = {
+    "ochiai": ochiai,
+    "tarantula": tarantula,
+    "dstar": dstar,
+    "jaccard": jaccard,
+    "op2": op2,
+    "barinel": barinel,
+    "kulczynski2": kulczynski2,
+}
+
+
+def suspiciousness(
+    coverage: np.ndarray, failing: np.ndarray, technique: str = "ochiai"
+) -> np.ndarray:
+    """
+    Score every line by a SBFL formula
+
+    Args:
+        coverage (np.ndarray): A boolean examples x lines matrix.
+        failing (np.ndarray): A boolean vector, true if the example is a counter example.
+        technique (str): One of FORMULAS.
+
+    Returns:
+        np.ndarray: Suspiciousness score per line.
+    """
+    if technique not in FORMULAS:
+        raise ValueError(f"Unknown SBFL technique: {technique}")
+    return FORMULAS[technique](*spectrum(coverage, failing))
+
+
+def rank(
+    scores: np.ndarray, lines: List[str], top: int = 0
+) -> List[Tuple[int, float, str]]:
+    """
+    Rank lines from most to least suspicious. Ties keep the line order.
+
+    Args:
+        scores (np.ndarray): Suspiciousness score per line.
+        lines (List[str]): The lines scores refer to.
+        top (int): Number of lines to return, all when 0.
+
+    Returns:
+        List[Tuple[int, float, str]]: Line index, score and line.
+    """
+    order = np.argsort(-np.asarray(scores), kind="stable")
+    if top:
+        order = order[:top]
+    return [(int(idx), float(scores[idx]), lines[idx]) for idx in order]
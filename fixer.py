@@ -1,52 +1,50 @@
 import copy
 import random
 import logging
-import anthropic
 import subprocess
 import numpy as np
+import crates
 from llms import Prompt, QueryEngine
 from utils import *
 
 
 class Fixer:
     def __init__(
-        self, fix_type, query_engine: QueryEngine, comp_fix_attempt_budget=3
+        self,
+        fix_type,
+        query_engine: QueryEngine,
+        comp_fix_attempt_budget=3,
+        compile_mode=CHECK,
+        samples_per_call=1,
     ) -> None:
         self.comp_fix_attempt_budget = comp_fix_attempt_budget
         self.fix_type = fix_type
         self.query_engine = query_engine
+        self.compile_mode = compile_mode
+        self.samples_per_call = samples_per_call
 
     def fix(self, rust_code="", comp_out=None, work_dir=None):
         self.fix_path = []
         return self.comp_fix_msft_work(rust_code, comp_out, work_dir)
 
     def cargo_fix(self, work_dir):
-        with cd(f"{work_dir}"):
-            subprocess.run(f"cargo clean", capture_output=True, shell=True)
-            comp_output_bf_cfix = subprocess.run(
-                f'RUSTFLAGS="-Z track-diagnostics -Z time-passes" cargo build --manifest-path Cargo.toml',
-                capture_output=True,
-                shell=True,
-            )
-            _, _, _, _, init_num_errors = parse_error_timepass(
-                comp_output_bf_cfix.stderr, work_dir.split("/")[-1]
-            )
-
-            subprocess.run(f"cargo fix --allow-no-vcs", capture_output=True, shell=True)
-
-            subprocess.run(f"cargo clean", capture_output=True, shell=True)
-            comp_output_af_cfix = subprocess.run(
-                f'RUSTFLAGS="-Z track-diagnostics -Z time-passes" cargo build --manifest-path Cargo.toml',
-                capture_output=True,
-                shell=True,
-            )
-            _, _, _, _, fnl_num_errors = parse_error_timepass(
-                comp_output_af_cfix.stderr, work_dir.split("/")[-1]
-            )
-
-            logging.info(
-                f"\tNumber of errors decreased from {init_num_errors} to {fnl_num_errors} with cargo fix."
-            )
+        comp_output_bf_cfix = cargo_compile(work_dir, mode=self.compile_mode)
+        _, _, _, _, init_num_errors = parse_error_json(comp_output_bf_cfix)
+
+        subprocess.run(
+            f"cargo fix --allow-no-vcs",
+            capture_output=True,
+            shell=True,
+            cwd=work_dir,
+            env=crates.cargo_env(work_dir, COMPILE_RUSTFLAGS),
+        )
+
+        comp_output_af_cfix = cargo_compile(work_dir, mode=self.compile_mode)
+        _, _, _, _, fnl_num_errors = parse_error_json(comp_output_af_cfix)
+
+        logging.info(
+            f"\tNumber of errors decreased from {init_num_errors} to {fnl_num_errors} with cargo fix."
+        )
 
     def comp_fix_msft_work(self, rust_code, init_comp_out, work_dir):
         errors = init_comp_out[0]
@@ -82,17 +80,23 @@ class Fixer:
                     ],
                 )
 
-                rust_code = self.query_engine.generate_code(prompt)
+                samples = self.query_engine.generate_codes(prompt, self.samples_per_call)
                 num_llm_call += 1  # increment before log
-                comp_output = compile_and_record_query(
-                    rust_code, work_dir, self.query_engine.stringify_prompt(prompt), num_llm_call
-                )
-
-                fnl_comp_out = parse_error_timepass(
-                    comp_output.stderr, work_dir.split("/")[-1]
-                )
-                new_errors = fnl_comp_out[0]
-                cur_errors = set(new_errors) - set(errors)
+                # the first sample that introduces no new error is taken
+                for sample_idx, rust_code in enumerate(samples):
+                    comp_output = compile_and_record_query(
+                        rust_code,
+                        work_dir,
+                        self.query_engine.stringify_prompt(prompt),
+                        num_llm_call if sample_idx == 0 else f"{num_llm_call}_{sample_idx}",
+                        mode=self.compile_mode,
+                    )
+
+                    fnl_comp_out = parse_error_json(comp_output)
+                    new_errors = fnl_comp_out[0]
+                    cur_errors = set(new_errors) - set(errors)
+                    if not cur_errors:
+                        break
 
                 if not cur_errors:
                     errors = new_errors
@@ -5,7 +5,7 @@ This module provides specialized integration between GAINTRUST's local LLM imple
 (like LocalQwen) and LangChain's ecosystem, specifically for C to Rust transpilation.
 """
 
-from typing import List, Dict, Any, Union, Optional, Callable, Type, ClassVar
+from typing import List, Dict, Any, Union, Optional, Callable, Type, ClassVar, Iterator
 import logging
 import json
 import os
@@ -14,9 +14,9 @@ from pathlib import Path
 
 # LangChain imports
 from langchain_core.language_models import BaseChatModel, BaseLanguageModel
-from langchain_core.messages import AIMessage, HumanMessage, SystemMessage, BaseMessage
-from langchain_core.callbacks import CallbackManagerForLLMRun
-from langchain_core.outputs import ChatGeneration, ChatResult, LLMResult
+from langchain_core.messages import AIMessage, AIMessageChunk, HumanMessage, SystemMessage, BaseMessage
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult, LLMResult
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.runnables import Runnable, RunnablePassthrough
@@ -24,7 +24,7 @@ from langchain_core.runnables import Runnable, RunnablePassthrough
 # Import GAINTRUST components
 from llms import QueryEngine, Prompt, USER, ASSISTANT, LocalQwen, CodeLlama
 from llms import QueryEngineFactory
-from utils import tag, cd, compile_and_record_query, parse_error_timepass
+from utils import tag, cd, compile_and_record_query, parse_error_json, rendered_diagnostics
 
 class LocalModelLangChainAdapter(BaseChatModel):
     """
@@ -64,6 +64,20 @@ class LocalModelLangChainAdapter(BaseChatModel):
         """Get the model name."""
         return self._model_name
     
+    def _model_params(self, kwargs: Dict[str, Any]) -> Dict[str, Any]:
+        # Add any additional model parameters from kwargs
+        model_params = {"temperature": 0.2}  # Default
+        if "temperature" in kwargs:
+            model_params["temperature"] = kwargs["temperature"]
+        # local engines bound the answer only, max_length caps it when max_new_tokens is not given
+        if "max_new_tokens" in kwargs:
+            model_params["max_new_tokens"] = kwargs["max_new_tokens"]
+        elif "max_length" in kwargs:
+            model_params["max_new_tokens"] = kwargs["max_length"]
+        if "do_sample" in kwargs:
+            model_params["do_sample"] = kwargs["do_sample"]
+        return model_params
+
     def _generate(
         self, 
         messages: List[BaseMessage], 
@@ -78,24 +92,51 @@ class LocalModelLangChainAdapter(BaseChatModel):
         # Convert LangChain messages to GAINTRUST Prompt format
         prompt = self._convert_messages_to_prompt(messages)
         
-        # Add any additional model parameters from kwargs
-        model_params = {"temperature": 0.2}  # Default
-        if "temperature" in kwargs:
-            model_params["temperature"] = kwargs["temperature"]
-        if "max_length" in kwargs:
-            model_params["max_length"] = kwargs["max_length"]
-        if "do_sample" in kwargs:
-            model_params["do_sample"] = kwargs["do_sample"]
-        
         # Query the model using GAINTRUST's QueryEngine
-        response = self.query_engine.query(prompt, model_params)
+        response = self.query_engine.query(prompt, self._model_params(kwargs))
         
         # Format the response for LangChain
         message = AIMessage(content=response)
         generation = ChatGeneration(message=message)
         
         return ChatResult(generations=[generation])
+
+    async def _agenerate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs
+    ) -> ChatResult:
+        """
+        Async counterpart of _generate, so that chains invoked with ainvoke/abatch
+        overlap their requests.
+        """
+        prompt = self._convert_messages_to_prompt(messages)
+        response = await self.query_engine.aquery(prompt, self._model_params(kwargs))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=response))])
     
+    def _stream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs
+    ) -> Iterator[ChatGenerationChunk]:
+        """
+        Stream the response chunk by chunk, used by chain.stream(). Closing the
+        stream cancels the generation of local and served models.
+        """
+        prompt = self._convert_messages_to_prompt(messages)
+        model_params = self._model_params(kwargs)
+        if stop:
+            model_params["stop"] = stop
+        for chunk in self.query_engine.stream_query(prompt, model_params):
+            generation_chunk = ChatGenerationChunk(message=AIMessageChunk(content=chunk))
+            if run_manager:
+                run_manager.on_llm_new_token(chunk, chunk=generation_chunk)
+            yield generation_chunk
+
     def _convert_messages_to_prompt(self, messages: List[BaseMessage]) -> Prompt:
         """
         Convert LangChain messages to a GAINTRUST Prompt object.
@@ -181,12 +222,18 @@ class CToRustTranspilerChain:
         os.makedirs(f"{self.work_dir}/results", exist_ok=True)
         
         # Initialize the model
+        # local models are shared with every other chain of the process, or
+        # served by GAINTRUST_MODEL_SERVER when set
         if model_name == "local-qwen":
             qwen_model_name = self.model_kwargs.get("model_name", "Qwen/Qwen2.5-0.5B-Instruct")
-            self.model = LocalQwen(self.global_constraints, model_name=qwen_model_name)
+            self.model = QueryEngineFactory.create_engine(
+                model_name, self.global_constraints, model_name=qwen_model_name
+            )
         elif model_name == "codellama":
             codellama_model_name = self.model_kwargs.get("model_name", "codellama/CodeLlama-13b-hf")
-            self.model = CodeLlama(self.global_constraints, model_name=codellama_model_name)
+            self.model = QueryEngineFactory.create_engine(
+                model_name, self.global_constraints, model_name=codellama_model_name
+            )
         else:
             # Try to use the factory to create any supported engine
             try:
@@ -355,9 +402,9 @@ class CToRustTranspilerChain:
                 # Parse errors - CompletedProcess object has stdout and stderr attributes
                 num_errs = 0
                 error_output = ""
-                if compile_result and hasattr(compile_result, 'stderr'):
-                    error_output = compile_result.stderr.decode('utf-8', errors='ignore')
-                    num_errs = error_output.count("error")
+                if compile_result and hasattr(compile_result, 'stdout'):
+                    error_output = rendered_diagnostics(compile_result)
+                    num_errs = parse_error_json(compile_result)[-1]
                 
                 # Check if this is the best result so far
                 if num_errs < min_num_errs:
@@ -530,9 +577,9 @@ class CToRustTranspilerWithFeedback(CToRustTranspilerChain):
                 # Parse errors - CompletedProcess object has stdout and stderr attributes
                 num_errs = 0
                 improved_error_output = ""
-                if improved_compile_result and hasattr(improved_compile_result, 'stderr'):
-                    improved_error_output = improved_compile_result.stderr.decode('utf-8', errors='ignore')
-                    num_errs = improved_error_output.count("error")
+                if improved_compile_result and hasattr(improved_compile_result, 'stdout'):
+                    improved_error_output = rendered_diagnostics(improved_compile_result)
+                    num_errs = parse_error_json(improved_compile_result)[-1]
                 
                 logging.info(f"Feedback loop {i+1}: {num_errs} errors")
                 
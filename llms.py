@@ -1,16 +1,22 @@
-import anthropic
-import boto3
-import botocore
+import asyncio
+import contextlib
+import copy
 import logging
+import os
+import queue
+import threading
+import time
+import urllib.error
+import urllib.request
+import weakref
+from collections import OrderedDict
+from concurrent.futures import Future
 from abc import abstractmethod
+import dataclasses
 from dataclasses import dataclass, field
 import json
-import httpx
-from openai import OpenAI
 import re
-from typing import Any, List, Dict, Tuple, Union
-import google.generativeai
-from transformers import pipeline, AutoTokenizer, AutoModelForCausalLM
+from typing import Any, AsyncIterator, Callable, Iterator, List, Dict, Optional, Tuple, Union
 from overrides import override
 from tenacity import (
     retry,
@@ -18,7 +24,7 @@ from tenacity import (
     stop_after_delay,
     retry_if_exception_type,
 )
-import torch
+from threads import ContextThreadPoolExecutor
 from utils import tag
 
 
@@ -27,6 +33,18 @@ ASSISTANT = "ASSISTANT"
 
 MAX_TOKEN: int = 8192
 
+# Requests an engine keeps in flight at once from async code
+MAX_CONCURRENCY: int = int(os.environ.get("GAINTRUST_LLM_CONCURRENCY", "8"))
+
+# Context of local models, shared by the prompt and the response
+CONTEXT_TOKENS: int = int(os.environ.get("GAINTRUST_CONTEXT_TOKENS", "4096"))
+MAX_NEW_TOKENS: int = int(os.environ.get("GAINTRUST_MAX_NEW_TOKENS", "1024"))
+
+# Concurrent prompts to local models arriving within the window are generated
+# as one batch of at most MAX_BATCH rows, 0 disables batching
+BATCH_WINDOW_MS: int = int(os.environ.get("GAINTRUST_BATCH_WINDOW_MS", "0"))
+MAX_BATCH: int = int(os.environ.get("GAINTRUST_MAX_BATCH", "8"))
+
 
 @dataclass
 class Prompt:
@@ -62,6 +80,15 @@ Here are some constraints contained in <list> tags that you should respect:
 {self.extra_information}
 """
 
+    def to_dict(self) -> Dict[str, Any]:
+        return dataclasses.asdict(self)
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "Prompt":
+        data = dict(data)
+        data["history"] = [tuple(turn) for turn in data.get("history", [])]
+        return cls(**data)
+
 
 class QueryError(Exception):
     """
@@ -71,9 +98,127 @@ class QueryError(Exception):
     pass
 
 
+class ResponseCache:
+    """
+    Model responses persisted across runs
+
+    Entries are keyed by the stringified prompt, model id and model parameters.
+    Greedy requests (temperature 0 or do_sample disabled) have one response per
+    key. Sampled requests keep every sample drawn so far: the i-th request of a
+    run for a key replays the i-th stored sample and only requests beyond the
+    stored ones reach the model, so a rerun sees the same sequence of samples.
+
+    Args:
+        max_bytes (int): Entries are evicted, least recently used first, beyond this size.
+        ttl_seconds (float): Entries older than this are ignored, never when 0.
+    """
+
+    def __init__(self, max_bytes: int, ttl_seconds: float = 0) -> None:
+        from cache import DiskCache
+
+        self.disk = DiskCache("responses", max_bytes)
+        self.ttl_seconds = ttl_seconds
+        # samples of each key already handed out by this process
+        self.cursors: Dict[str, int] = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def deterministic(model_params: Dict[str, Any]) -> bool:
+        return (
+            model_params.get("do_sample", True) is False
+            or model_params.get("temperature", None) == 0
+        )
+
+    @staticmethod
+    def key(model_id: str, prompt: str, model_params: Dict[str, Any]) -> str:
+        from cache import digest
+
+        return digest(model_id, prompt, json.dumps(model_params, sort_keys=True, default=str))
+
+    def _load(self, key: str) -> List[str]:
+        entry = self.disk.get(key)
+        if entry is None:
+            return []
+        try:
+            stored = json.loads((entry / "responses.json").read_text())
+        except (FileNotFoundError, json.JSONDecodeError):
+            return []
+        if self.ttl_seconds and time.time() - stored["created"] > self.ttl_seconds:
+            return []
+        return stored["responses"]
+
+    def _save(self, key: str, responses: List[str]) -> None:
+        content = json.dumps({"created": time.time(), "responses": responses})
+        entry = self.disk.path(key)
+        if entry.is_dir():
+            tmp = entry / f".responses-{threading.get_ident()}.tmp"
+            tmp.write_text(content)
+            os.replace(tmp, entry / "responses.json")
+        else:
+            with self.disk.put(key) as scratch:
+                (scratch / "responses.json").write_text(content)
+
+    def take(self, key: str, n: int, deterministic: bool) -> List[str]:
+        """
+        Claim up to n stored responses of key.
+        """
+        with self.lock:
+            responses = self._load(key)
+            if deterministic:
+                taken = responses[:1] * n
+            else:
+                cursor = self.cursors.get(key, 0)
+                taken = responses[cursor : cursor + n]
+                self.cursors[key] = cursor + len(taken)
+            self.hits += len(taken)
+            self.misses += n - len(taken)
+            return taken
+
+    def add(self, key: str, responses: List[str], deterministic: bool) -> None:
+        """
+        Store freshly generated responses of key.
+        """
+        if not responses:
+            return
+        with self.lock:
+            if deterministic:
+                self._save(key, responses[:1])
+                return
+            stored = self._load(key)
+            self._save(key, stored + responses)
+            self.cursors[key] = self.cursors.get(key, 0) + len(responses)
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self) -> str:
+        return f"response cache: {self.hits} hits, {self.misses} misses ({self.hit_rate:.0%} hit rate)"
+
+
 class QueryEngine:
-    def __init__(self, global_constraints: List[str]) -> None:
+    def __init__(
+        self, global_constraints: List[str], max_concurrency: int = MAX_CONCURRENCY
+    ) -> None:
         self.global_constraints = global_constraints
+        self.max_concurrency = max_concurrency
+        self.response_cache: Optional[ResponseCache] = None
+        # async clients and semaphores are bound to the event loop that created them
+        self._loop_resources: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[str, Any]]" = (
+            weakref.WeakKeyDictionary()
+        )
+
+    def loop_resource(self, name: str, factory: Callable[[], Any]) -> Any:
+        """
+        Returns the resource name of the running event loop, creating it with factory on first use.
+        """
+        resources = self._loop_resources.setdefault(asyncio.get_running_loop(), {})
+        if name not in resources:
+            resources[name] = factory()
+        return resources[name]
 
     @abstractmethod
     def raw_query(
@@ -94,7 +239,115 @@ class QueryEngine:
         model_params: Dict[str, Any] = {"temperature": 0.2},
     ) -> str:
         # return self.raw_query(self.stringify_prompt(prompt), model_params)
-        return self.raw_query(prompt, model_params)
+        if self.response_cache is None:
+            return self.raw_query(prompt, model_params)
+        key, deterministic = self.cache_key(prompt, model_params)
+        cached = self.response_cache.take(key, 1, deterministic)
+        if cached:
+            return cached[0]
+        response = self.raw_query(prompt, model_params)
+        self.response_cache.add(key, [response], deterministic)
+        return response
+
+    async def araw_query(
+        self,
+        prompt: Union[str, Prompt],
+        model_params: Dict[str, Any],
+    ) -> str:
+        """
+        Override this method with a native async client where one exists. By
+        default raw_query runs on a worker thread.
+        """
+        return await asyncio.to_thread(self.raw_query, prompt, model_params)
+
+    @retry(
+        reraise=True,
+        retry=retry_if_exception_type(QueryError),
+        wait=wait_random_exponential(multiplier=1, max=120),
+        stop=stop_after_delay(900),
+    )
+    async def aquery(
+        self,
+        prompt: Prompt,
+        model_params: Dict[str, Any] = {"temperature": 0.2},
+    ) -> str:
+        """
+        Async counterpart of query. At most max_concurrency requests of an
+        engine are in flight at once; retries back off without holding a slot.
+        """
+        semaphore = self.loop_resource(
+            "semaphore", lambda: asyncio.Semaphore(self.max_concurrency)
+        )
+        if self.response_cache is None:
+            async with semaphore:
+                return await self.araw_query(prompt, model_params)
+        key, deterministic = self.cache_key(prompt, model_params)
+        cached = self.response_cache.take(key, 1, deterministic)
+        if cached:
+            return cached[0]
+        async with semaphore:
+            response = await self.araw_query(prompt, model_params)
+        self.response_cache.add(key, [response], deterministic)
+        return response
+
+    def raw_stream(
+        self, prompt: Union[str, Prompt], model_params: Dict[str, Any]
+    ) -> Iterator[str]:
+        """
+        Override this method with the streaming API of the model. By default
+        the whole response is a single chunk.
+        """
+        yield self.raw_query(prompt, model_params)
+
+    def stream_query(
+        self,
+        prompt: Prompt,
+        model_params: Dict[str, Any] = {"temperature": 0.2},
+    ) -> Iterator[str]:
+        """
+        Yields the response to prompt chunk by chunk as it is generated. Closing
+        the iterator cancels the generation of engines that stream. Streams
+        are not retried, since part of the response may have been consumed.
+        """
+        with contextlib.closing(self.raw_stream(prompt, model_params)) as chunks:
+            if self.response_cache is None:
+                yield from chunks
+                return
+            key, deterministic = self.cache_key(prompt, model_params)
+            cached = self.response_cache.take(key, 1, deterministic)
+            if cached:
+                yield cached[0]
+                return
+            response = []
+            for chunk in chunks:
+                response.append(chunk)
+                yield chunk
+            # only complete responses are cached
+            self.response_cache.add(key, ["".join(response)], deterministic)
+
+    def model_id(self) -> str:
+        """
+        Identifies the model answering queries in response cache keys.
+        """
+        for attr in ("model_name", "modelId", "model"):
+            value = getattr(self, attr, None)
+            if isinstance(value, str):
+                return value
+        return type(self).__name__
+
+    def cache_key(
+        self, prompt: Union[str, Prompt], model_params: Dict[str, Any]
+    ) -> Tuple[str, bool]:
+        """
+        Returns:
+            str: The response cache key of the request.
+            bool: Whether the request is deterministic.
+        """
+        prompt_str = prompt if isinstance(prompt, str) else self.stringify_prompt(prompt)
+        return (
+            ResponseCache.key(self.model_id(), prompt_str, model_params),
+            ResponseCache.deterministic(model_params),
+        )
 
     def stringify_prompt(self, prompt: Prompt) -> str:
         """
@@ -109,10 +362,27 @@ class QueryEngine:
 
         return prompt_str
 
-    def generate_code(
-        self, prompt: Prompt, model_params: Dict[str, Any] = {"temperature": 0.2}
-    ) -> str:
-        constrained_prompt = Prompt(
+    def count_tokens(self, text: str) -> int:
+        """
+        Override this method with the tokenizer of the model. By default
+        tokens are estimated at four characters each.
+        """
+        return len(text) // 4
+
+    def prompt_tokens(self, prompt: Prompt) -> int:
+        """
+        Size of prompt as sent to the model, global constraints included.
+        """
+        return self.count_tokens(self.stringify_prompt(self.constrain(prompt)))
+
+    def prompt_budget(self) -> Optional[int]:
+        """
+        Tokens a prompt may take, None when the context fits any prompt.
+        """
+        return None
+
+    def constrain(self, prompt: Prompt) -> Prompt:
+        return Prompt(
             context=prompt.context,
             instruction=prompt.instruction,
             constraints=prompt.constraints
@@ -125,9 +395,104 @@ class QueryEngine:
             preamble=prompt.preamble,
             history=prompt.history,
         )
-        response = self.query(constrained_prompt, model_params)
+
+    def generate_code(
+        self, prompt: Prompt, model_params: Dict[str, Any] = {"temperature": 0.2}
+    ) -> str:
+        response = self.query(self.constrain(prompt), model_params)
+        return QueryEngine.extract(response)
+
+    async def agenerate_code(
+        self, prompt: Prompt, model_params: Dict[str, Any] = {"temperature": 0.2}
+    ) -> str:
+        response = await self.aquery(self.constrain(prompt), model_params)
         return QueryEngine.extract(response)
 
+    def generate_codes(
+        self,
+        prompt: Prompt,
+        n: int,
+        model_params: Dict[str, Any] = {"temperature": 0.2},
+    ) -> List[str]:
+        """
+        Generate n candidates for the same prompt, with the requests overlapping.
+
+        Returns:
+            List[str]: The extracted code of every candidate.
+        """
+        if n == 1:
+            return [self.generate_code(prompt, model_params)]
+
+        async def sample() -> List[str]:
+            try:
+                return await self.agenerate_codes(prompt, n, model_params)
+            finally:
+                await self.aclose()
+
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return asyncio.run(sample())
+        # asyncio.run cannot nest in the loop of this thread, async callers
+        # should await agenerate_codes instead
+        with ContextThreadPoolExecutor(max_workers=1) as executor:
+            return executor.submit(asyncio.run, sample()).result()
+
+    async def agenerate_codes(
+        self,
+        prompt: Prompt,
+        n: int,
+        model_params: Dict[str, Any] = {"temperature": 0.2},
+    ) -> List[str]:
+        return list(
+            await asyncio.gather(
+                *(self.agenerate_code(prompt, model_params) for _ in range(n))
+            )
+        )
+
+    def code_samples(
+        self,
+        prompt: Prompt,
+        budget: int,
+        batch_size: int = 1,
+        model_params: Dict[str, Any] = {"temperature": 0.2},
+    ) -> Iterator[str]:
+        """
+        Yields up to budget candidates for prompt, generated batch_size at a time,
+        so that callers stopping early do not pay for the whole budget.
+        """
+        remaining = budget
+        while remaining > 0:
+            n = min(batch_size, remaining)
+            yield from self.generate_codes(prompt, n, model_params)
+            remaining -= n
+
+    async def acode_samples(
+        self,
+        prompt: Prompt,
+        budget: int,
+        batch_size: int = 1,
+        model_params: Dict[str, Any] = {"temperature": 0.2},
+    ) -> AsyncIterator[str]:
+        """
+        code_samples for callers running in an event loop.
+        """
+        remaining = budget
+        while remaining > 0:
+            n = min(batch_size, remaining)
+            for code in await self.agenerate_codes(prompt, n, model_params):
+                yield code
+            remaining -= n
+
+    async def aclose(self) -> None:
+        """
+        Close the async clients of the running event loop.
+        """
+        resources = self._loop_resources.pop(asyncio.get_running_loop(), {})
+        for resource in resources.values():
+            if hasattr(resource, "close") and asyncio.iscoroutinefunction(resource.close):
+                await resource.close()
+
     @staticmethod
     def extract(response: str) -> str:
         #print("DEBUG: Query Engine Extracting")
@@ -190,6 +555,9 @@ class QueryEngine:
 
 class Claude2(QueryEngine):
     def __init__(self, global_constraints: List[str]) -> None:
+        import boto3
+        import botocore
+
         super().__init__(global_constraints)
         config = botocore.config.Config(
             read_timeout=900, connect_timeout=900, retries={"max_attempts": 0}
@@ -200,6 +568,8 @@ class Claude2(QueryEngine):
 
     @override
     def stringify_prompt(self, prompt: Prompt) -> str:
+        import anthropic
+
         prompt_str = ""
         for content in prompt.history:
             role, content = content
@@ -257,9 +627,16 @@ class Claude2(QueryEngine):
 
 class Claude3(QueryEngine):
     def __init__(self, global_constraints: List[str]) -> None:
+        import boto3
+        import botocore
+
         super().__init__(global_constraints)
+        # async queries run raw_query on worker threads, which share this pool
         config = botocore.config.Config(
-            read_timeout=900, connect_timeout=900, retries={"max_attempts": 0}
+            read_timeout=900,
+            connect_timeout=900,
+            retries={"max_attempts": 0},
+            max_pool_connections=max(10, self.max_concurrency),
         )
         self.bedrock = boto3.client(service_name="bedrock-runtime", config=config)
         self.modelId = "anthropic.claude-3-sonnet-20240229-v1:0"
@@ -292,63 +669,57 @@ class Claude3(QueryEngine):
         return response[0]["text"]
 
 
-class Mistral(QueryEngine):
-    def __init__(self, global_constraints: List[str], model_name: str = "mistralai/Mistral-7B-v0.1"):
-        super().__init__(global_constraints)
-        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
-        self.generator = pipeline("text-generation", model=model_name, device_map="auto")
-        self.model_name = model_name
-
-    def stringify_prompt(self, prompt: Prompt) -> str:
-        messages = self.messages(prompt)
-        prompt_str = "\n".join(f"{msg['role']}: {msg['content']}" for msg in messages)
-        return prompt_str
-
-    @retry(
-        reraise=True,
-        retry=retry_if_exception_type(Exception),
-        wait=wait_random_exponential(multiplier=1, max=30),
-        stop=stop_after_delay(300),
-    )
-    def raw_query(self, prompt: Union[str, Prompt], model_params: Dict[str, Any]) -> str:
-        if isinstance(prompt, Prompt):
-            prompt = self.stringify_prompt(prompt)
+class GPT4(QueryEngine):
+    def __init__(self, global_constraints: List[str]) -> None:
+        import httpx
+        from openai import OpenAI
 
-        logging.info(f"Querying local model '{self.model_name}' with params: {model_params}")
+        super().__init__(global_constraints)
+        self.client = OpenAI(timeout=httpx.Timeout(900.0, read=900.0, connect=900.0))
+        self.model = "gpt-4-turbo-preview"
 
+    @override
+    def raw_query(
+        self,
+        prompt: Union[str, Prompt],
+        model_params: Dict[str, Any],
+    ) -> str:
         try:
-            output = self.generator(
-                prompt,
-                do_sample=model_params.get("do_sample", True),
-                temperature=model_params.get("temperature", 0.7),
-                max_length=model_params.get("max_length", 1024),
-                return_full_text=False,
-                truncation=True,
+            response = self.client.chat.completions.create(
+                model=self.model,
+                temperature=model_params["temperature"],
+                messages=self.messages(prompt),
             )
-            
-            response = output[0]['generated_text']
-
         except Exception as e:
-            logging.error(f"Error during model inference: {e}")
             raise QueryError(e)
 
-        return response
-
+        logging.info(
+            f"A query to GPT4 is made with model paramters as follows: {str(model_params)}"
+        )
+        return response.choices[0].message.content
 
-class GPT4(QueryEngine):
-    def __init__(self, global_constraints: List[str]) -> None:
-        super().__init__(global_constraints)
-        self.client = OpenAI(timeout=httpx.Timeout(900.0, read=900.0, connect=900.0))
-        self.model = "gpt-4-turbo-preview"
+    def async_client(self) -> Any:
+        import httpx
+        from openai import AsyncOpenAI
+
+        return AsyncOpenAI(
+            timeout=httpx.Timeout(900.0, read=900.0, connect=900.0),
+            max_retries=0,
+            http_client=httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=self.max_concurrency),
+                timeout=httpx.Timeout(900.0, read=900.0, connect=900.0),
+            ),
+        )
 
     @override
-    def raw_query(
+    async def araw_query(
         self,
         prompt: Union[str, Prompt],
         model_params: Dict[str, Any],
     ) -> str:
+        client = self.loop_resource("client", self.async_client)
         try:
-            response = self.client.chat.completions.create(
+            response = await client.chat.completions.create(
                 model=self.model,
                 temperature=model_params["temperature"],
                 messages=self.messages(prompt),
@@ -361,15 +732,20 @@ class GPT4(QueryEngine):
         )
         return response.choices[0].message.content
 
+
+class Gemini(QueryEngine):
     def __init__(self, global_constraints: List[str]) -> None:
+        import google.generativeai
+
         super().__init__(global_constraints)
         google.generativeai.configure()
         self.model = google.generativeai.GenerativeModel("gemini-pro")
 
     MAX_TOKEN = 2048
 
-    @override
-    def raw_query(self, prompt: str | Prompt, model_params: Dict[str, Any]) -> str:
+    def request(
+        self, prompt: str | Prompt, model_params: Dict[str, Any]
+    ) -> Dict[str, Any]:
         generation_config = {
             "temperature": model_params["temperature"],
             "max_output_tokens": self.MAX_TOKEN,
@@ -390,15 +766,13 @@ class GPT4(QueryEngine):
 
         request_options = {"timeout": 900}
 
-        try:
-            response = self.model.generate_content(
-                contents,
-                generation_config=generation_config,
-                request_options=request_options,
-            )
-        except Exception as e:
-            raise QueryError(e)
-        response.resolve()
+        return {
+            "contents": contents,
+            "generation_config": generation_config,
+            "request_options": request_options,
+        }
+
+    def answer(self, response: Any, model_params: Dict[str, Any]) -> str:
         if len(response.candidates) > 0 and len(response.candidates[0].content.parts) > 0:
             logging.info(
                 f"A query to Gemini is made with model paramters as follows: {str(model_params)}"
@@ -407,78 +781,942 @@ class GPT4(QueryEngine):
         else:
             raise QueryError("Response doesn't contain useful information")
 
-class LocalQwen(QueryEngine):
-    def __init__(self, global_constraints: List[str], model_name: str = "Qwen/Qwen2.5-3B-Instruct"):
+    @override
+    def raw_query(self, prompt: str | Prompt, model_params: Dict[str, Any]) -> str:
+        try:
+            response = self.model.generate_content(**self.request(prompt, model_params))
+        except Exception as e:
+            raise QueryError(e)
+        response.resolve()
+        return self.answer(response, model_params)
+
+    @override
+    async def araw_query(
+        self, prompt: str | Prompt, model_params: Dict[str, Any]
+    ) -> str:
+        try:
+            response = await self.model.generate_content_async(
+                **self.request(prompt, model_params)
+            )
+        except Exception as e:
+            raise QueryError(e)
+        return self.answer(response, model_params)
+
+
+class PrefixCache:
+    """
+    Key/value caches of recently prefilled prompts, reused by prompts that share a prefix
+
+    Fix prompts repeat the same source code and constraints round after round,
+    so a new prompt only needs to be prefilled from where it departs from the
+    closest cached one. Entries are evicted least recently used first once
+    their tensors take more than max_bytes.
+
+    Args:
+        max_bytes (int): Memory budget of all entries.
+        min_prefix (int): Shorter common prefixes are not worth a copy of the cache.
+    """
+
+    def __init__(self, max_bytes: int, min_prefix: int = 32) -> None:
+        self.max_bytes = max_bytes
+        self.min_prefix = min_prefix
+        # token ids -> (token ids, cache, size in bytes)
+        self.entries: "OrderedDict[bytes, Tuple[Any, Any, int]]" = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.reused_tokens = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def tensors(cache: Any) -> List[Any]:
+        if hasattr(cache, "layers"):
+            tensors = [t for layer in cache.layers for t in (layer.keys, layer.values)]
+            return [t for t in tensors if t is not None]
+        return list(cache.key_cache) + list(cache.value_cache)
+
+    @staticmethod
+    def common_prefix(a: Any, b: Any) -> int:
+        import numpy as np
+
+        n = min(len(a), len(b))
+        mismatches = np.flatnonzero(a[:n] != b[:n])
+        return int(mismatches[0]) if len(mismatches) else n
+
+    def lookup(self, tokens: Any) -> Tuple[int, Optional[Any]]:
+        """
+        Find the cached prompt sharing the longest prefix with tokens.
+
+        Args:
+            tokens (np.ndarray): Token ids of the prompt.
+
+        Returns:
+            int: Length of the reused prefix.
+            Optional[DynamicCache]: A private copy of the cache cropped to that prefix.
+        """
+        with self.lock:
+            best_len, best_key = 0, None
+            for key, (cached_tokens, _, _) in self.entries.items():
+                common = self.common_prefix(cached_tokens, tokens)
+                if common > best_len:
+                    best_len, best_key = common, key
+            if best_key is None or best_len < self.min_prefix:
+                self.misses += 1
+                return 0, None
+            self.entries.move_to_end(best_key)
+            self.hits += 1
+            self.reused_tokens += best_len
+            cache = copy.deepcopy(self.entries[best_key][1])
+        cache.crop(best_len)
+        return best_len, cache
+
+    def store(self, tokens: Any, cache: Any) -> None:
+        """
+        Keep a copy of the cache of tokens, evicting old entries over budget.
+        """
+        size = sum(t.numel() * t.element_size() for t in self.tensors(cache))
+        if size > self.max_bytes:
+            return
+        entry = (tokens.copy(), copy.deepcopy(cache), size)
+        key = tokens.tobytes()
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key)[2]
+            self.entries[key] = entry
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, _, evicted_size) = self.entries.popitem(last=False)
+                self.size -= evicted_size
+
+    def stats(self) -> str:
+        return (
+            f"prefix cache: {self.hits} hits, {self.misses} misses, "
+            f"{self.reused_tokens} tokens reused, {len(self.entries)} entries in {self.size / 2**20:.0f} MB"
+        )
+
+
+class SampledEngine(QueryEngine):
+    """
+    An engine drawing several samples of a prompt in one request, see raw_query_n
+    """
+
+    @abstractmethod
+    def raw_query_n(
+        self, prompt: Union[str, Prompt], model_params: Dict[str, Any], n: int
+    ) -> List[str]: ...
+
+    @override
+    def raw_query(
+        self, prompt: Union[str, Prompt], model_params: Dict[str, Any]
+    ) -> str:
+        return self.raw_query_n(prompt, model_params, 1)[0]
+
+    @retry(
+        reraise=True,
+        retry=retry_if_exception_type(QueryError),
+        wait=wait_random_exponential(multiplier=1, max=120),
+        stop=stop_after_delay(900),
+    )
+    def query_n(
+        self,
+        prompt: Prompt,
+        model_params: Dict[str, Any],
+        n: int,
+    ) -> List[str]:
+        if self.response_cache is None:
+            return self.raw_query_n(prompt, model_params, n)
+        key, deterministic = self.cache_key(prompt, model_params)
+        cached = self.response_cache.take(key, n, deterministic)
+        if len(cached) == n:
+            return cached
+        responses = self.raw_query_n(prompt, model_params, n - len(cached))
+        self.response_cache.add(key, responses, deterministic)
+        return cached + responses
+
+    @override
+    def generate_code(
+        self, prompt: Prompt, model_params: Dict[str, Any] = {"temperature": 0.2}
+    ) -> str:
+        return self.generate_codes(prompt, 1, model_params)[0]
+
+    @override
+    def generate_codes(
+        self,
+        prompt: Prompt,
+        n: int,
+        model_params: Dict[str, Any] = {"temperature": 0.2},
+    ) -> List[str]:
+        # nothing after the code block is extracted, so decoding ends with it
+        model_params = dict(model_params, stop_on_code=True)
+        responses = self.query_n(self.constrain(prompt), model_params, n)
+        return [QueryEngine.extract(response) for response in responses]
+
+    @override
+    async def agenerate_codes(
+        self,
+        prompt: Prompt,
+        n: int,
+        model_params: Dict[str, Any] = {"temperature": 0.2},
+    ) -> List[str]:
+        # the n samples are drawn as one batch
+        return await asyncio.to_thread(self.generate_codes, prompt, n, model_params)
+
+
+class CodeBlockExtractor:
+    """
+    Finds the first complete code block of a response while it is generated
+
+    Text is fed chunk by chunk and only the new part is scanned, with enough
+    overlap to catch delimiters split across chunks. The outermost block is
+    delimited by <code></code> or by triple backticks, as in QueryEngine.extract.
+    """
+
+    DELIMITERS = {"<code>": "</code>", "```": "```"}
+    OVERLAP = max(len(delimiter) for delimiter in DELIMITERS.values()) - 1
+
+    def __init__(self) -> None:
+        self.text = ""
+        self.scanned = 0
+        self.closer: Optional[str] = None
+        self.body_start = 0
+        self.end: Optional[int] = None
+
+    def feed(self, chunk: str) -> bool:
+        """
+        Returns:
+            bool: Whether a complete code block has been seen.
+        """
+        if self.end is not None:
+            return True
+        self.text += chunk
+        start = max(0, self.scanned - self.OVERLAP)
+        self.scanned = len(self.text)
+        if self.closer is None:
+            found = [
+                (idx, opener)
+                for opener in self.DELIMITERS
+                if (idx := self.text.find(opener, start)) >= 0
+            ]
+            if not found:
+                return False
+            idx, opener = min(found)
+            self.closer = self.DELIMITERS[opener]
+            self.body_start = idx + len(opener)
+        idx = self.text.find(self.closer, max(start, self.body_start))
+        if idx < 0:
+            return False
+        self.end = idx + len(self.closer)
+        return True
+
+    @property
+    def code(self) -> Optional[str]:
+        if self.end is None:
+            return None
+        return self.text[self.body_start : self.end - len(self.closer)]
+
+
+def truncate_at_code_block(response: str) -> str:
+    """
+    Cut response after its first complete code block, if any.
+    """
+    extractor = CodeBlockExtractor()
+    if extractor.feed(response):
+        return response[: extractor.end]
+    return response
+
+
+@dataclass
+class GenerationRequest:
+    """
+    A prompt waiting for a batch, see BatchScheduler
+
+    Args:
+        prompt (str): The stringified prompt.
+        kwargs (Dict[str, Any]): Generation arguments, see LocalEngine.generation_kwargs.
+        n (int): Number of samples.
+        stop (List[str]): Generation of a sample ends with any of these strings.
+        stop_on_code (bool): Generation of a sample ends with its first complete code block.
+    """
+
+    prompt: str
+    kwargs: Dict[str, Any]
+    n: int = 1
+    stop: List[str] = field(default_factory=list)
+    stop_on_code: bool = False
+    future: Future = field(default_factory=Future)
+
+    @property
+    def stops_early(self) -> bool:
+        return bool(self.stop) or self.stop_on_code
+
+    def finish(self, response: str) -> str:
+        response = truncate_at_stop(response, self.stop)
+        if self.stop_on_code:
+            response = truncate_at_code_block(response)
+        return response
+
+    @property
+    def n_rows(self) -> int:
+        # greedy decoding yields the same sequence every time
+        return self.n if self.kwargs["do_sample"] else 1
+
+    def sampling_key(self) -> Tuple[Any, ...]:
+        # one generate call shares the sampling parameters of its rows
+        return tuple(
+            sorted(
+                (key, value)
+                for key, value in self.kwargs.items()
+                if key != "max_new_tokens"
+            )
+        )
+
+
+class StopCriteria:
+    """
+    Per-row stopping criteria of a generation batch: every row ends at its own
+    max_new_tokens, once it produced one of its stop strings, or once it
+    completed a code block if it asked to.
+
+    Args:
+        tokenizer (Any): Tokenizer of the model.
+        prompt_len (int): Length of the (padded) prompts.
+        requests (List[GenerationRequest]): The request of every row.
+    """
+
+    # generated tokens decoded to look for stop strings
+    TAIL_TOKENS = 16
+
+    def __init__(
+        self, tokenizer: Any, prompt_len: int, requests: List[GenerationRequest]
+    ) -> None:
+        self.tokenizer = tokenizer
+        self.prompt_len = prompt_len
+        self.requests = requests
+        self.extractors = [
+            CodeBlockExtractor() if request.stop_on_code else None for request in requests
+        ]
+        self.consumed = prompt_len
+
+    def __call__(self, input_ids: Any, scores: Any, **kwargs: Any) -> Any:
+        import torch
+
+        n_generated = input_ids.shape[1] - self.prompt_len
+        done = []
+        for row, (request, extractor) in enumerate(zip(self.requests, self.extractors)):
+            row_done = n_generated >= request.kwargs["max_new_tokens"]
+            if extractor is not None:
+                # fed every new token, so the block is seen as soon as it closes
+                chunk = self.tokenizer.decode(
+                    input_ids[row, self.consumed :], skip_special_tokens=True
+                )
+                row_done = extractor.feed(chunk) or row_done
+            if request.stop and not row_done:
+                tail = self.tokenizer.decode(
+                    input_ids[row, max(self.prompt_len, input_ids.shape[1] - self.TAIL_TOKENS) :],
+                    skip_special_tokens=True,
+                )
+                row_done = any(stop in tail for stop in request.stop)
+            done.append(row_done)
+        self.consumed = input_ids.shape[1]
+        return torch.tensor(done, dtype=torch.bool, device=input_ids.device)
+
+
+class CancelCriteria:
+    """
+    Ends every row of a generation once cancel is set, e.g. by a stream consumer
+    """
+
+    def __init__(self, cancel: threading.Event) -> None:
+        self.cancel = cancel
+
+    def __call__(self, input_ids: Any, scores: Any, **kwargs: Any) -> Any:
+        import torch
+
+        return torch.full(
+            (input_ids.shape[0],), self.cancel.is_set(), dtype=torch.bool, device=input_ids.device
+        )
+
+
+def truncate_at_stop(response: str, stop: List[str]) -> str:
+    """
+    Cut response after the earliest stop string, which is kept.
+    """
+    ends = [response.find(s) + len(s) for s in stop if s in response]
+    return response[: min(ends)] if ends else response
+
+
+class BatchScheduler:
+    """
+    Groups the prompts submitted to a local model within a short window into
+    one padded generation batch
+
+    Submitting threads block on a future while a single worker owns the model.
+    Requests sharing sampling parameters are generated together, each row with
+    its own max_new_tokens and stop strings. A lone request goes through the
+    prefix-cached path of LocalEngine.generate instead.
+
+    Args:
+        engine (LocalEngine): Engine generating the batches.
+        window (float): Seconds to wait for more requests after the first one.
+        max_batch (int): Rows of a batch, counting every sample of a request.
+    """
+
+    def __init__(self, engine: "LocalEngine", window: float, max_batch: int) -> None:
+        self.engine = engine
+        self.window = window
+        self.max_batch = max_batch
+        self.requests: "queue.Queue[GenerationRequest]" = queue.Queue()
+        self.n_batches = 0
+        self.n_rows = 0
+        self.worker = threading.Thread(target=self.serve_requests, daemon=True)
+        self.worker.start()
+
+    def submit(self, request: GenerationRequest) -> List[str]:
+        self.requests.put(request)
+        return request.future.result()
+
+    def collect(self) -> List[GenerationRequest]:
+        """
+        Blocks for a request, then waits up to window for more.
+        """
+        batch = [self.requests.get()]
+        n_rows = batch[0].n_rows
+        deadline = time.monotonic() + self.window
+        while n_rows < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                request = self.requests.get(timeout=remaining)
+            except queue.Empty:
+                break
+            batch.append(request)
+            n_rows += request.n_rows
+        return batch
+
+    def serve_requests(self) -> None:
+        while True:
+            groups: Dict[Tuple[Any, ...], List[GenerationRequest]] = {}
+            for request in self.collect():
+                groups.setdefault(request.sampling_key(), []).append(request)
+            for group in groups.values():
+                try:
+                    results = self.engine.generate_batch(group)
+                except Exception as e:
+                    for request in group:
+                        request.future.set_exception(e)
+                    continue
+                self.n_batches += 1
+                self.n_rows += sum(request.n_rows for request in group)
+                for request, responses in zip(group, results):
+                    request.future.set_result(responses)
+
+    def stats(self) -> str:
+        average = self.n_rows / self.n_batches if self.n_batches else 0
+        return f"batch scheduler: {self.n_batches} batches, {average:.1f} rows on average"
+
+
+@dataclass
+class SharedModel:
+    """
+    A loaded model and what every engine using it shares
+
+    Args:
+        lock (threading.RLock): Held by every generation, so that the batch
+            scheduler, streams and direct queries never run the model at once.
+    """
+
+    generator: Any
+    prefix_cache: PrefixCache
+    scheduler: Optional[BatchScheduler] = None
+    lock: Any = field(default_factory=threading.RLock)
+
+
+_pipelines: Dict[str, SharedModel] = {}
+_pipelines_lock = threading.Lock()
+
+
+def shared_pipeline(model_name: str, **pipeline_kwargs: Any) -> SharedModel:
+    """
+    The text-generation pipeline of model_name with its prefix cache and batch
+    scheduler, loaded once per process however many engines use the model.
+    """
+    from transformers import pipeline
+
+    key = f"{model_name}:{sorted(pipeline_kwargs.items())}"
+    with _pipelines_lock:
+        if key not in _pipelines:
+            logging.info(f"Loading local model '{model_name}'.")
+            generator = pipeline(
+                "text-generation", model=model_name, device_map="auto", **pipeline_kwargs
+            )
+            prefix_cache = PrefixCache(
+                int(os.environ.get("GAINTRUST_PREFIX_CACHE_MB", "1024")) * 2**20
+            )
+            _pipelines[key] = SharedModel(generator, prefix_cache)
+        return _pipelines[key]
+
+
+class LocalEngine(SampledEngine):
+    """
+    A model run in-process through a Hugging Face text-generation pipeline
+
+    Several samples for the same prompt are decoded as one batch from a single
+    prefill of the prompt, see generate. With GAINTRUST_BATCH_WINDOW_MS set,
+    concurrent prompts are batched together, see BatchScheduler.
+
+    Args:
+        model_name (str): Hugging Face model id.
+        default_temperature (float): Temperature used when model_params has none.
+        pipeline_kwargs: Passed on to transformers.pipeline.
+    """
+
+    def __init__(
+        self,
+        global_constraints: List[str],
+        model_name: str,
+        default_temperature: float,
+        **pipeline_kwargs: Any,
+    ) -> None:
         super().__init__(global_constraints)
         self.model_name = model_name
-        self.generator = pipeline("text-generation", model=model_name, device_map="auto")
+        self.default_temperature = default_temperature
+        shared = shared_pipeline(model_name, **pipeline_kwargs)
+        self.generator = shared.generator
+        self.prefix_cache = shared.prefix_cache
+        self.model_lock = shared.lock
+        self.tokenizer = self.generator.tokenizer
+        self.model = self.generator.model
+        self.max_new_tokens = MAX_NEW_TOKENS
+        self.context_window = min(CONTEXT_TOKENS, self.tokenizer.model_max_length)
+        with _pipelines_lock:
+            if BATCH_WINDOW_MS > 0 and shared.scheduler is None:
+                shared.scheduler = BatchScheduler(self, BATCH_WINDOW_MS / 1000, MAX_BATCH)
+        self.scheduler = shared.scheduler
 
     def stringify_prompt(self, prompt: Prompt) -> str:
         messages = self.messages(prompt)
         prompt_str = "\n".join(f"{msg['role']}: {msg['content']}" for msg in messages)
         return prompt_str
 
-    def raw_query(self, 
-                  prompt: Union[str, Prompt], 
-                  model_params: Dict[str, Any]
-                  ) -> str:
-        
+    @override
+    def count_tokens(self, text: str) -> int:
+        return len(self.tokenizer(text)["input_ids"])
+
+    @override
+    def prompt_budget(self) -> Optional[int]:
+        return self.context_window - self.max_new_tokens
+
+    def generation_kwargs(self, model_params: Dict[str, Any]) -> Dict[str, Any]:
+        do_sample = model_params.get("do_sample", True)
+        kwargs = {
+            "do_sample": do_sample,
+            # a total max_length would leave long prompts no room to answer
+            "max_new_tokens": model_params.get("max_new_tokens", self.max_new_tokens),
+            "pad_token_id": self.tokenizer.pad_token_id
+            if self.tokenizer.pad_token_id is not None
+            else self.tokenizer.eos_token_id,
+        }
+        if do_sample:
+            kwargs["temperature"] = model_params.get(
+                "temperature", self.default_temperature
+            )
+        return kwargs
+
+    def prefill(self, input_ids: Any) -> Any:
+        """
+        Run the model over all but the last prompt token, starting from the
+        longest cached prefix of the prompt.
+
+        Returns:
+            DynamicCache: The key/value cache of the prompt, None for one-token prompts.
+        """
+        import torch
+        from transformers import DynamicCache
+
+        if input_ids.shape[1] < 2:
+            return None
+        tokens = input_ids[0, :-1].cpu().numpy()
+        reused, cache = self.prefix_cache.lookup(tokens)
+        if cache is None:
+            cache = DynamicCache()
+        if reused < len(tokens):
+            with torch.no_grad():
+                self.model(
+                    input_ids=input_ids[:, reused:-1],
+                    past_key_values=cache,
+                    use_cache=True,
+                )
+            self.prefix_cache.store(tokens, cache)
+        logging.info(f"Prefilled {len(tokens) - reused} tokens, reused {reused}.")
+        return cache
+
+    @override
+    def raw_query_n(
+        self, prompt: Union[str, Prompt], model_params: Dict[str, Any], n: int
+    ) -> List[str]:
+        """
+        Sample n responses to prompt, through the batch scheduler if any.
+        model_params may hold stop strings under "stop", and "stop_on_code"
+        to end samples with their first code block.
+        """
         if isinstance(prompt, Prompt):
             prompt = self.stringify_prompt(prompt)
 
-        logging.info(f"Querying local model '{self.model_name}' with params: {model_params}")
-        
+        logging.info(
+            f"Querying local model '{self.model_name}' for {n} samples with params: {model_params}"
+        )
+
+        request = self.generation_request(prompt, model_params, n)
         try:
-            output = self.generator(prompt, max_length=model_params.get("max_length", 1024),
-                                    temperature=model_params.get("temperature", 0.2),
-                                    do_sample=model_params.get("do_sample", True),
-                                    return_full_text=False)
-            response = output[0]["generated_text"]
+            if self.scheduler is not None:
+                return self.scheduler.submit(request)
+            return self.generate(request)
         except Exception as e:
             logging.error(f"Error during model inference: {e}")
             raise QueryError(e)
-        
-        return response
-    
-class CodeLlama(QueryEngine):
+
+    def generation_request(
+        self, prompt: str, model_params: Dict[str, Any], n: int
+    ) -> GenerationRequest:
+        return GenerationRequest(
+            prompt,
+            self.generation_kwargs(model_params),
+            n,
+            model_params.get("stop", []),
+            model_params.get("stop_on_code", False),
+        )
+
+    @override
+    def raw_stream(
+        self, prompt: Union[str, Prompt], model_params: Dict[str, Any]
+    ) -> Iterator[str]:
+        """
+        Stream one sample through a TextIteratorStreamer, generating on a
+        worker thread. Streams bypass the batch scheduler, but wait for the
+        model lock like every other generation.
+        """
+        from transformers import TextIteratorStreamer
+
+        if isinstance(prompt, Prompt):
+            prompt = self.stringify_prompt(prompt)
+        logging.info(
+            f"Streaming from local model '{self.model_name}' with params: {model_params}"
+        )
+
+        request = self.generation_request(prompt, model_params, 1)
+        streamer = TextIteratorStreamer(
+            self.tokenizer, skip_prompt=True, skip_special_tokens=True
+        )
+        cancel = threading.Event()
+        errors: List[Exception] = []
+
+        def run() -> None:
+            try:
+                self.generate(request, streamer, cancel)
+            except Exception as e:
+                errors.append(e)
+                streamer.end()
+
+        worker = threading.Thread(target=run, daemon=True)
+        worker.start()
+        text = ""
+        n_yielded = 0
+        try:
+            for chunk in streamer:
+                text += chunk
+                # stop strings and code blocks cut the response, see finish
+                finished = request.finish(text)
+                if len(finished) > n_yielded:
+                    yield finished[n_yielded:]
+                    n_yielded = len(finished)
+                if len(finished) < len(text):
+                    break
+        finally:
+            cancel.set()
+            worker.join()
+        if errors:
+            logging.error(f"Error during model inference: {errors[0]}")
+            raise QueryError(errors[0])
+
+    def generate(
+        self,
+        request: GenerationRequest,
+        streamer: Any = None,
+        cancel: Optional[threading.Event] = None,
+    ) -> List[str]:
+        """
+        Sample the responses of one request. The prompt is prefilled once and
+        its cache is shared by the samples, which are decoded as a batch.
+
+        Args:
+            streamer (Any): Receives the generated tokens, for single-sample requests.
+            cancel (Optional[threading.Event]): Ends the generation once set.
+        """
+        import torch
+        from transformers import StoppingCriteriaList
+
+        input_ids = self.tokenizer(request.prompt, return_tensors="pt")["input_ids"].to(
+            self.model.device
+        )
+        prompt_len = input_ids.shape[1]
+        if prompt_len > self.prompt_budget():
+            logging.warning(
+                f"Prompt of {prompt_len} tokens exceeds the budget of {self.prompt_budget()}."
+            )
+        n_rows = request.n_rows
+        stopping_criteria = StoppingCriteriaList()
+        if request.stops_early:
+            stopping_criteria.append(
+                StopCriteria(self.tokenizer, prompt_len, [request] * n_rows)
+            )
+        if cancel is not None:
+            stopping_criteria.append(CancelCriteria(cancel))
+        with self.model_lock, torch.no_grad():
+            cache = self.prefill(input_ids)
+            if n_rows > 1:
+                if cache is not None:
+                    cache.batch_repeat_interleave(n_rows)
+                input_ids = input_ids.repeat(n_rows, 1)
+            output = self.model.generate(
+                input_ids=input_ids,
+                attention_mask=torch.ones_like(input_ids),
+                past_key_values=cache,
+                stopping_criteria=stopping_criteria,
+                streamer=streamer,
+                **request.kwargs,
+            )
+        responses = self.tokenizer.batch_decode(
+            output[:, prompt_len:], skip_special_tokens=True
+        )
+        responses = [request.finish(response) for response in responses]
+        return (responses * request.n)[: request.n]
+
+    def generate_batch(self, requests: List[GenerationRequest]) -> List[List[str]]:
+        """
+        Generate the responses of requests sharing sampling parameters as one
+        left-padded batch.
+
+        Returns:
+            List[List[str]]: The responses of every request.
+        """
+        import torch
+        from transformers import StoppingCriteriaList
+
+        if len(requests) == 1:
+            return [self.generate(requests[0])]
+
+        rows = [request for request in requests for _ in range(request.n_rows)]
+        # padded here rather than by the tokenizer, whose padding settings
+        # belong to every engine sharing the pipeline
+        encoded = [
+            self.tokenizer(request.prompt, return_tensors="pt")["input_ids"][0]
+            for request in rows
+        ]
+        prompt_len = max(len(ids) for ids in encoded)
+        input_ids = torch.full(
+            (len(rows), prompt_len), requests[0].kwargs["pad_token_id"], dtype=torch.long
+        )
+        attention_mask = torch.zeros_like(input_ids)
+        for row, ids in enumerate(encoded):
+            input_ids[row, prompt_len - len(ids) :] = ids
+            attention_mask[row, prompt_len - len(ids) :] = 1
+        inputs = {
+            "input_ids": input_ids.to(self.model.device),
+            "attention_mask": attention_mask.to(self.model.device),
+        }
+        limits = [request.kwargs["max_new_tokens"] for request in rows]
+        stopping_criteria = StoppingCriteriaList(
+            [StopCriteria(self.tokenizer, prompt_len, rows)]
+        )
+        kwargs = dict(requests[0].kwargs, max_new_tokens=max(limits))
+        logging.info(f"Generating a batch of {len(rows)} rows for {len(requests)} requests.")
+        with self.model_lock, torch.no_grad():
+            output = self.model.generate(
+                **inputs, stopping_criteria=stopping_criteria, **kwargs
+            )
+
+        results = []
+        row = 0
+        for request in requests:
+            responses = [
+                request.finish(
+                    self.tokenizer.decode(
+                        output[row + idx, prompt_len : prompt_len + limits[row + idx]],
+                        skip_special_tokens=True,
+                    )
+                )
+                for idx in range(request.n_rows)
+            ]
+            results.append((responses * request.n)[: request.n])
+            row += request.n_rows
+        return results
+
+
+class Mistral(LocalEngine):
+    def __init__(self, global_constraints: List[str], model_name: str = "mistralai/Mistral-7B-v0.1"):
+        super().__init__(global_constraints, model_name, default_temperature=0.7)
+
+    @retry(
+        reraise=True,
+        retry=retry_if_exception_type(Exception),
+        wait=wait_random_exponential(multiplier=1, max=30),
+        stop=stop_after_delay(300),
+    )
+    @override
+    def raw_query_n(
+        self, prompt: Union[str, Prompt], model_params: Dict[str, Any], n: int
+    ) -> List[str]:
+        return super().raw_query_n(prompt, model_params, n)
+
+
+class LocalQwen(LocalEngine):
+    def __init__(self, global_constraints: List[str], model_name: str = "Qwen/Qwen2.5-3B-Instruct"):
+        super().__init__(global_constraints, model_name, default_temperature=0.2)
+
+
+class CodeLlama(LocalEngine):
     def __init__(self, global_constraints: List[str], model_name: str = "codellama/CodeLlama-7b-Instruct-hf"):
-        super().__init__(global_constraints)
-        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
-        self.generator = pipeline("text-generation", model=model_name, torch_dtype=torch.float16, device_map="auto")
-        self.model_name = model_name
+        import torch
+
+        super().__init__(
+            global_constraints,
+            model_name,
+            default_temperature=0.7,
+            torch_dtype=torch.float16,
+        )
 
     def stringify_prompt(self, prompt: Prompt) -> str:
         messages = self.messages(prompt)
         prompt_str = "[INST]" + "\n".join(f"{msg['role']}: {msg['content']}" for msg in messages) + "[/INST]"
         return prompt_str
 
-    def raw_query(self, prompt: Union[str, Prompt], model_params: Dict[str, Any]) -> str:
-        if isinstance(prompt, Prompt):
-            prompt = self.stringify_prompt(prompt)
 
-        logging.info(f"Querying local model '{self.model_name}' with params: {model_params}")
+class RemoteEngine(SampledEngine):
+    """
+    A client of a model server, see model_server.py
+
+    The server loads the weights once and batches the requests of every
+    process pointed at it. Prompts are constrained here and stringified by
+    the engine of the server.
+
+    Args:
+        url (str): Address of the server, e.g. http://127.0.0.1:8765.
+        timeout (float): Seconds to wait for a response.
+    """
+
+    def __init__(
+        self, global_constraints: List[str], url: str, timeout: float = 900
+    ) -> None:
+        super().__init__(global_constraints)
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+        self._info: Optional[Dict[str, Any]] = None
+
+    def request(self, path: str, payload: Optional[Dict[str, Any]] = None) -> Any:
+        data = None if payload is None else json.dumps(payload).encode("utf-8")
+        request = urllib.request.Request(
+            f"{self.url}{path}", data=data, headers={"Content-Type": "application/json"}
+        )
         try:
-            output = self.generator(
-                prompt,
-                do_sample=model_params.get("do_sample", True),
-                temperature=model_params.get("temperature", 0.7),
-                max_length=model_params.get("max_length", 1024),
-                return_full_text=False,
-                truncation=True
-            )
-            
-            response = output[0]['generated_text']
-            
-        except Exception as e:
-            logging.error(f"Error during model inference: {e}")
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return json.loads(response.read())
+        except (urllib.error.URLError, OSError, json.JSONDecodeError) as e:
+            logging.error(f"Error querying model server at {self.url}: {e}")
             raise QueryError(e)
 
-        return response
+    def info(self) -> Dict[str, Any]:
+        if self._info is None:
+            self._info = self.request("/info")
+        return self._info
+
+    @override
+    def model_id(self) -> str:
+        return self.info()["model_id"]
+
+    @override
+    def prompt_budget(self) -> Optional[int]:
+        return self.info()["prompt_budget"]
+
+    @override
+    def count_tokens(self, text: str) -> int:
+        return self.request("/tokens", {"text": text})["n_tokens"]
+
+    @override
+    def raw_query_n(
+        self, prompt: Union[str, Prompt], model_params: Dict[str, Any], n: int
+    ) -> List[str]:
+        logging.info(
+            f"Querying model server at {self.url} for {n} samples with params: {model_params}"
+        )
+        payload = {
+            "prompt": prompt if isinstance(prompt, str) else prompt.to_dict(),
+            "model_params": model_params,
+            "n": n,
+        }
+        return self.request("/query", payload)["responses"]
+
+    @override
+    def raw_stream(
+        self, prompt: Union[str, Prompt], model_params: Dict[str, Any]
+    ) -> Iterator[str]:
+        """
+        Stream chunks sent by the server as JSON lines. Closing the stream
+        drops the connection, which cancels the generation on the server.
+        """
+        payload = {
+            "prompt": prompt if isinstance(prompt, str) else prompt.to_dict(),
+            "model_params": model_params,
+        }
+        request = urllib.request.Request(
+            f"{self.url}/stream",
+            data=json.dumps(payload).encode("utf-8"),
+            headers={"Content-Type": "application/json"},
+        )
+        try:
+            response = urllib.request.urlopen(request, timeout=self.timeout)
+        except (urllib.error.URLError, OSError) as e:
+            logging.error(f"Error streaming from model server at {self.url}: {e}")
+            raise QueryError(e)
+        with response:
+            try:
+                for line in response:
+                    chunk = json.loads(line)
+                    if "error" in chunk:
+                        raise QueryError(chunk["error"])
+                    yield chunk["text"]
+            except (OSError, json.JSONDecodeError) as e:
+                logging.error(f"Error streaming from model server at {self.url}: {e}")
+                raise QueryError(e)
+
+
+# Local models served by GAINTRUST_MODEL_SERVER when it is set
+LOCAL_MODELS = ["mistral", "local-qwen", "codellama"]
+
+
+def model_server_url() -> Optional[str]:
+    return os.environ.get("GAINTRUST_MODEL_SERVER") or None
 
 
 class QueryEngineFactory:
     @staticmethod
-    def create_engine(model: str, global_constraints: List[str] = []) -> QueryEngine:
+    def create_engine(
+        model: str,
+        global_constraints: List[str] = [],
+        use_server: bool = True,
+        **engine_kwargs: Any,
+    ) -> QueryEngine:
+        """
+        Args:
+            model (str): Model choice, see Options.model.
+            global_constraints (List[str]): Constraints added to every prompt.
+            use_server (bool): Whether local models go through GAINTRUST_MODEL_SERVER when set.
+            engine_kwargs: Passed on to local engines, e.g. model_name.
+        """
+        if use_server and model in LOCAL_MODELS and model_server_url():
+            if engine_kwargs:
+                logging.info(f"Model server in use, ignoring {engine_kwargs}.")
+            return RemoteEngine(global_constraints, model_server_url())
         match model:
             case "claude2":
                 return Claude2(global_constraints)
@@ -487,12 +1725,12 @@ class QueryEngineFactory:
             case "gpt4":
                 return GPT4(global_constraints)
             case "mistral":
-                return Mistral(global_constraints)
+                return Mistral(global_constraints, **engine_kwargs)
             case "gemini":
                 return Gemini(global_constraints)
             case "local-qwen":
-                return LocalQwen(global_constraints)
+                return LocalQwen(global_constraints, **engine_kwargs)
             case "codellama":
-                return CodeLlama(global_constraints)
+                return CodeLlama(global_constraints, **engine_kwargs)
             case _:
                 raise ValueError(f"Unknown model: {model}")
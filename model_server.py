@@ -0,0 +1,197 @@
+import argparse
+import contextlib
+import json
+import logging
+import queue
+import threading
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Tuple
+
+from llms import LOCAL_MODELS, Prompt, QueryEngineFactory, SampledEngine
+
+
+class ModelServer:
+    """
+    Serves a local model to every pipeline process pointed at it with
+    GAINTRUST_MODEL_SERVER, so that the weights are loaded once.
+
+    Requests are queued and handled by a single worker owning the model.
+    Requests waiting on the same prompt and parameters are drawn as one batch
+    of samples, which shares a single prefill of the prompt. When the engine
+    has a batch scheduler (GAINTRUST_BATCH_WINDOW_MS), requests go straight to
+    it and different prompts are batched too. Streams are generated on the
+    thread of their connection, and wait for the model lock of the engine like
+    every other generation.
+
+    Args:
+        query_engine (SampledEngine): The engine answering requests, built
+            without global constraints since clients constrain their prompts.
+    """
+
+    def __init__(self, query_engine: SampledEngine) -> None:
+        self.query_engine = query_engine
+        self.requests: "queue.Queue[Tuple[Any, Dict[str, Any], int, Future]]" = (
+            queue.Queue()
+        )
+        self.worker = threading.Thread(target=self.serve_requests, daemon=True)
+        self.worker.start()
+
+    def submit(self, prompt: Any, model_params: Dict[str, Any], n: int) -> List[str]:
+        if getattr(self.query_engine, "scheduler", None) is not None:
+            # the scheduler of the engine batches different prompts as well
+            if isinstance(prompt, dict):
+                prompt = Prompt.from_dict(prompt)
+            return self.query_engine.query_n(prompt, model_params, n)
+        future: Future = Future()
+        self.requests.put((prompt, model_params, n, future))
+        return future.result()
+
+    def pending(self) -> List[Tuple[Any, Dict[str, Any], int, Future]]:
+        """
+        Blocks for a request, then takes every other request already queued.
+        """
+        pending = [self.requests.get()]
+        while True:
+            try:
+                pending.append(self.requests.get_nowait())
+            except queue.Empty:
+                return pending
+
+    def serve_requests(self) -> None:
+        while True:
+            groups: Dict[str, List[Tuple[Any, Dict[str, Any], int, Future]]] = {}
+            for request in self.pending():
+                prompt, model_params, _, _ = request
+                key = json.dumps([prompt, model_params], sort_keys=True, default=str)
+                groups.setdefault(key, []).append(request)
+
+            for group in groups.values():
+                prompt, model_params, _, _ = group[0]
+                if isinstance(prompt, dict):
+                    prompt = Prompt.from_dict(prompt)
+                n = sum(request[2] for request in group)
+                try:
+                    responses = self.query_engine.query_n(prompt, model_params, n)
+                except Exception as e:
+                    for *_, future in group:
+                        future.set_exception(e)
+                    continue
+                if len(group) > 1:
+                    logging.info(f"Served {len(group)} requests with a batch of {n} samples.")
+                for _, _, n_request, future in group:
+                    future.set_result(responses[:n_request])
+                    responses = responses[n_request:]
+
+    def info(self) -> Dict[str, Any]:
+        return {
+            "model_id": self.query_engine.model_id(),
+            "prompt_budget": self.query_engine.prompt_budget(),
+        }
+
+
+def handler(server: ModelServer) -> type:
+    class Handler(BaseHTTPRequestHandler):
+        def reply(self, code: int, payload: Dict[str, Any]) -> None:
+            body = json.dumps(payload).encode("utf-8")
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self) -> None:
+            if self.path == "/info":
+                self.reply(200, server.info())
+            else:
+                self.reply(404, {"error": f"Unknown path {self.path}"})
+
+        def do_POST(self) -> None:
+            length = int(self.headers.get("Content-Length", 0))
+            try:
+                payload = json.loads(self.rfile.read(length))
+            except json.JSONDecodeError as e:
+                self.reply(400, {"error": str(e)})
+                return
+
+            if self.path == "/stream":
+                self.stream(payload)
+                return
+
+            try:
+                if self.path == "/query":
+                    responses = server.submit(
+                        payload["prompt"], payload["model_params"], payload.get("n", 1)
+                    )
+                    self.reply(200, {"responses": responses})
+                elif self.path == "/tokens":
+                    n_tokens = server.query_engine.count_tokens(payload["text"])
+                    self.reply(200, {"n_tokens": n_tokens})
+                else:
+                    self.reply(404, {"error": f"Unknown path {self.path}"})
+            except Exception as e:
+                logging.exception(f"Failed to serve {self.path}.")
+                self.reply(500, {"error": f"{type(e).__name__}: {e}"})
+
+        def stream(self, payload: Dict[str, Any]) -> None:
+            """
+            Sends the response as JSON lines, one per chunk. The connection is
+            closed at the end, and a client closing it cancels the generation.
+            """
+            prompt = payload["prompt"]
+            if isinstance(prompt, dict):
+                prompt = Prompt.from_dict(prompt)
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.end_headers()
+            chunks = server.query_engine.stream_query(prompt, payload["model_params"])
+            with contextlib.closing(chunks):
+                try:
+                    for chunk in chunks:
+                        self.wfile.write(json.dumps({"text": chunk}).encode("utf-8") + b"\n")
+                        self.wfile.flush()
+                except (BrokenPipeError, ConnectionResetError):
+                    logging.info("Stream cancelled by the client.")
+                except Exception as e:
+                    logging.exception("Failed to stream.")
+                    error = {"error": f"{type(e).__name__}: {e}"}
+                    self.wfile.write(json.dumps(error).encode("utf-8") + b"\n")
+
+        def log_message(self, format: str, *args: Any) -> None:
+            logging.debug(format % args)
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Serve a local model to pipeline workers over HTTP."
+    )
+    parser.add_argument("--model", default="local-qwen", choices=LOCAL_MODELS)
+    parser.add_argument("--model-name", default=None, help="Hugging Face model id")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(name)s - %(levelname)s - %(message)s")
+
+    engine_kwargs = {"model_name": args.model_name} if args.model_name else {}
+    # the server itself never forwards to another server
+    query_engine = QueryEngineFactory.create_engine(
+        args.model, [], use_server=False, **engine_kwargs
+    )
+    server = ModelServer(query_engine)
+
+    httpd = ThreadingHTTPServer((args.host, args.port), handler(server))
+    print(f"DEBUG: Serving {query_engine.model_id()} at http://{args.host}:{args.port}")
+    print(f"DEBUG: Point workers at it with GAINTRUST_MODEL_SERVER=http://{args.host}:{args.port}")
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+
+
+if __name__ == "__main__":
+    main()
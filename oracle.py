@@ -1,13 +1,24 @@
+import functools
 import logging
 import os
+import queue
+import random
+import signal
 import subprocess
+import threading
+import time
 import tempfile
 import shutil
 import json
+import re
 from dataclasses import dataclass
 from collections import defaultdict
 from typing import Any, Optional, Tuple, List, Dict
 
+from cache import DiskCache, cache_root, digest
+from corpus import CorpusStore
+from threads import ContextThreadPoolExecutor
+
 
 def get_path(path: str) -> str:
     if not os.path.exists(path):
@@ -15,25 +26,31 @@ def get_path(path: str) -> str:
     return path
 
 
-if not os.path.exists("Differential_Tester"):
-    raise RuntimeError("Expect verifier")
-
 instrumentors = {
     "go": "Differential_Tester/.bin/instrument-go/instrument",
     "rust": "Differential_Tester/.bin/instrument-rust/release/instrument",
     "c": "Differential_Tester/.bin/instrument-c/release/instrument",
 }
 
-for language, path in instrumentors.items():
-    if not os.path.exists(path):
+
+def instrumentor(language: str) -> str:
+    """
+    Path to the instrumentor of language. Checked on use rather than on import,
+    so that modules depending on oracle load without the verifier.
+    """
+    if not os.path.exists("Differential_Tester"):
+        raise RuntimeError("Expect verifier")
+    if not os.path.exists(instrumentors[language]):
         raise RuntimeError(f"Missing instrumentor for {language}")
+    return instrumentors[language]
+
 
 n_counter_examples = 1000
 
 
 def instrument_go(src_file: str, tmp_dir: str) -> None:
     shutil.copy(src_file, tmp_dir + "/ground_truth.go")
-    subprocess.check_call([instrumentors["go"], tmp_dir + "/ground_truth.go"])
+    subprocess.check_call([instrumentor("go"), tmp_dir + "/ground_truth.go"])
     subprocess.check_call(["go", "fmt", tmp_dir + "/ground_truth.go"])
     subprocess.check_call(
         [
@@ -51,7 +68,7 @@ def instrument_go(src_file: str, tmp_dir: str) -> None:
 # requires installing the following: sudo yum install -y gcc10.x86_64 gcc10-c++.x86_64
 def instrument_c(src_file: str, tmp_dir: str) -> None:
     subprocess.check_call(
-        [instrumentors["c"], "-f", src_file, "-o", tmp_dir + "/ground_truth"]
+        [instrumentor("c"), "-f", src_file, "-o", tmp_dir + "/ground_truth"]
     )
     subprocess.check_call(
         [
@@ -69,12 +86,75 @@ def instrument_c(src_file: str, tmp_dir: str) -> None:
     )
 
 
+ground_truth_cache = DiskCache(
+    "ground_truth", int(os.environ.get("GAINTRUST_GROUND_TRUTH_CACHE_MB", "256")) * 2**20
+)
+replay_cache = DiskCache(
+    "replay", int(os.environ.get("GAINTRUST_REPLAY_CACHE_MB", "1024")) * 2**20
+)
+
+
+def instrument_cache_enabled() -> bool:
+    return os.environ.get("GAINTRUST_INSTRUMENT_CACHE", "1") != "0"
+
+
+def instrumentor_fingerprint(language: str) -> str:
+    # rebuilding an instrumentor invalidates everything it produced
+    stat = os.stat(instrumentor(language))
+    return f"{language}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def ground_truth(language: str, src_file: str) -> str:
+    """
+    Build the instrumented ground truth library of a source file, once per source.
+
+    Args:
+        language (str): The language of concern.
+        src_file (str): The go source, or the json description of C sources.
+
+    Returns:
+        str: Path to libground_truth.so.
+
+    Raises:
+        CalledProcessError: If instrumentation fails.
+    """
+    with open(src_file, "rb") as f:
+        src = f.read()
+    key = digest(instrumentor_fingerprint(language), src)
+
+    entry = ground_truth_cache.get(key) if instrument_cache_enabled() else None
+    if entry is None:
+        with ground_truth_cache.put(key) as scratch:
+            if language == "go":
+                instrument_go(src_file, str(scratch))
+            elif language == "c":
+                instrument_c(src_file, str(scratch))
+            else:
+                raise NotImplementedError
+            # only the library is needed by the rust instrumentor
+            for path in scratch.iterdir():
+                if path.name != "libground_truth.so":
+                    if path.is_dir():
+                        shutil.rmtree(path)
+                    else:
+                        path.unlink()
+        entry = ground_truth_cache.path(key)
+    else:
+        logging.info(f"Reusing instrumented ground truth of {src_file}")
+
+    return get_path(str(entry / "libground_truth.so"))
+
+
 def instrument(
     language: str, res_dir: str, submodule_name: str, output_dir: str
 ) -> None:
     """
     Instrument the source directory
 
+    The ground truth library is built once per source and instrumented
+    replay workspaces are reused when the same Rust code is instrumented
+    again, see ground_truth_cache and replay_cache.
+
     Args:
         language (str): The language of concern.
         res_dir (str): Path to the results directory where original and traspiled code can be found.
@@ -94,34 +174,53 @@ def instrument(
         raise FileExistsError(
             f"output directory {output_dir} exists, cannot instrument {submodule_name}"
         )
-    with tempfile.TemporaryDirectory() as tmp_dir:
-        src_file: str
-        if language == "go":
-            src_file = get_path(f"{res_dir}/{submodule_name}.go")
-            instrument_go(src_file, tmp_dir)
-        elif language == "c":
-            src_file = get_path(f"{res_dir}/{submodule_name}.json")
-            instrument_c(src_file, tmp_dir)
-        else:
-            raise NotImplementedError
-
-        subprocess.check_call(
-            [
-                instrumentors["rust"],
-                "-f",
-                rs_file,
-                "-o",
-                output_dir,
-                "--capture-stdout",
-                "--wrapper-structs",
-                "--arbitrary-precision",
-                "--ground-truth",
-                tmp_dir + "/libground_truth.so",
-                "--multi-examples",
-                str(n_counter_examples),
-            ]
-        )
-        subprocess.check_call(["mv", tmp_dir + "/libground_truth.so", output_dir])
+    src_file: str
+    if language == "go":
+        src_file = get_path(f"{res_dir}/{submodule_name}.go")
+    elif language == "c":
+        src_file = get_path(f"{res_dir}/{submodule_name}.json")
+    else:
+        raise NotImplementedError
+    lib_file = ground_truth(language, src_file)
+
+    with open(rs_file, "rb") as f:
+        rust_code = f.read()
+    key = digest(
+        instrumentor_fingerprint("rust"),
+        submodule_name,
+        str(n_counter_examples),
+        rust_code,
+        # the key of the ground truth entry
+        os.path.basename(os.path.dirname(lib_file)),
+    )
+
+    entry = replay_cache.get(key) if instrument_cache_enabled() else None
+    if entry is not None:
+        logging.info(f"Reusing instrumented replay workspace of {submodule_name}")
+        shutil.copytree(entry, output_dir, symlinks=True)
+        return
+
+    subprocess.check_call(
+        [
+            instrumentor("rust"),
+            "-f",
+            rs_file,
+            "-o",
+            output_dir,
+            "--capture-stdout",
+            "--wrapper-structs",
+            "--arbitrary-precision",
+            "--ground-truth",
+            lib_file,
+            "--multi-examples",
+            str(n_counter_examples),
+        ]
+    )
+    shutil.copy(lib_file, output_dir)
+
+    if instrument_cache_enabled():
+        with replay_cache.put(key) as scratch:
+            shutil.copytree(output_dir, scratch, symlinks=True, dirs_exist_ok=True)
 
 
 def verify_llm(
@@ -148,8 +247,243 @@ def verify_llm(
     answer = claude_gen(bedrock, prompt)
 
 
+def merge_examples(*example_lists: str) -> str:
+    """
+    Merge json lists of examples, dropping duplicates.
+    """
+    merged: Dict[str, Any] = {}
+    for examples in example_lists:
+        for example in json.loads(examples):
+            merged.setdefault(json.dumps(example, sort_keys=True), example)
+    return json.dumps(list(merged.values()))
+
+
+class FuzzShard:
+    """
+    A cargo bolero test process whose stderr is forwarded line by line to a queue
+
+    Args:
+        idx (int): Index of the shard, attached to every forwarded line.
+        command (str): The fuzzing command.
+        env (Dict[str, str]): Its environment.
+        lines (queue.Queue): Receives (idx, line) pairs, and (idx, None) once the process exits.
+    """
+
+    def __init__(
+        self, idx: int, command: str, env: Dict[str, str], lines: "queue.Queue"
+    ) -> None:
+        self.idx = idx
+        # a session of its own, so that signals reach cargo and the fuzzer, not only the shell
+        self.process = subprocess.Popen(
+            command,
+            shell=True,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            env=env,
+            start_new_session=True,
+        )
+        self.reader = threading.Thread(target=self.read, args=(lines,), daemon=True)
+        self.reader.start()
+
+    def read(self, lines: "queue.Queue") -> None:
+        for line in self.process.stderr:
+            lines.put((self.idx, line.decode("utf-8", errors="replace").rstrip("\n")))
+        self.process.wait()
+        lines.put((self.idx, None))
+
+    def signal(self, sig: int) -> None:
+        if self.process.poll() is None:
+            try:
+                os.killpg(self.process.pid, sig)
+            except ProcessLookupError:
+                pass
+
+    def stop(self) -> None:
+        self.signal(signal.SIGKILL)
+        self.process.wait()
+
+
+class FuzzingError(Exception):
+    """
+    Every fuzzing shard exited on its own without reporting examples, e.g.
+    because the fuzz target does not compile or crashes at startup.
+    """
+
+
+# libFuzzer status lines, e.g. "#4096	NEW    cov: 143 ft: 250 corp: 21/512b ..."
+LIBFUZZER_STATUS = re.compile(r"^#(\d+)\s+\w+\s+cov: (\d+)")
+
+# Seconds interrupted shards get to report their examples before being killed
+INTERRUPT_GRACE = 5
+
+
+def fuzz(
+    fuzz_target: str,
+    main_entry: str,
+    env: Dict[str, str],
+    max_len: int,
+    timeout: float,
+    n_shards: int = 1,
+    max_counter_examples: int = 0,
+    plateau_seconds: float = 0,
+    corpus_dir: Optional[str] = None,
+) -> Optional[Tuple[str, str, str]]:
+    """
+    Fuzz the target with n_shards independently seeded libFuzzer processes
+
+    Fuzzer output is parsed while the shards run and the examples they report
+    are merged. Fuzzing ends as soon as
+        - a shard completes,
+        - max_counter_examples distinct counter examples have been reported, if set,
+        - coverage has not grown for plateau_seconds after counter examples were found, if set,
+        - or the timeout expires.
+    Shards are then interrupted and get INTERRUPT_GRACE seconds to report their
+    last examples. Examples found before an early exit are returned as partial
+    results, and so are those found before a timeout when max_counter_examples
+    or plateau_seconds opted into early exits. Otherwise a timeout returns None,
+    so that the caller retries with larger inputs. Shards share corpus_dir as
+    their libFuzzer corpus if given.
+
+    Returns:
+        None: If no shard reported examples.
+        Tuple[str, str, str]: The crash report, positive examples and counter examples.
+
+    Raises:
+        FuzzingError: If every shard exited before reporting anything, which
+            larger inputs or a longer timeout would not change.
+    """
+    lines: "queue.Queue" = queue.Queue()
+    # 0 lets libFuzzer pick a seed, shards need distinct ones
+    seeds = [0] if n_shards == 1 else random.sample(range(1, 2**31), n_shards)
+    corpus_arg = f"--corpus-dir {corpus_dir} " if corpus_dir else ""
+    shards = [
+        FuzzShard(
+            idx,
+            f"cargo bolero test --manifest-path {fuzz_target}/Cargo.toml "
+            f"--features fuzzing {main_entry} --target-dir {fuzz_target}/target/__fuzz__ "
+            f"--sanitizer NONE {corpus_arg}"
+            f'--engine-args="-rss_limit_mb=8096 -max_len={max_len} -seed={seed}" ',
+            env,
+            lines,
+        )
+        for idx, seed in enumerate(seeds)
+    ]
+    reports: List[List[str]] = [[] for _ in shards]
+    positives: List[Optional[str]] = [None] * n_shards
+    counters: List[Optional[str]] = [None] * n_shards
+    coverage = [0] * n_shards
+    running = set(range(n_shards))
+    # shards that exited on their own without reporting examples
+    failed: Dict[int, Optional[int]] = {}
+    interrupted = False
+    timed_out = False
+    keep_partial = bool(max_counter_examples or plateau_seconds)
+    last_progress = time.monotonic()
+
+    def merged() -> Tuple[str, str]:
+        return (
+            merge_examples(*[p for p in positives if p]),
+            merge_examples(*[c for c in counters if c]),
+        )
+
+    def handle(idx: int, line: Optional[str]) -> bool:
+        """
+        Consume a line of shard idx. Returns whether fuzzing can stop.
+        """
+        nonlocal last_progress
+        if line is None:
+            running.discard(idx)
+            if not interrupted and not positives[idx] and not counters[idx]:
+                failed[idx] = shards[idx].process.returncode
+            return bool(positives[idx] and counters[idx])
+
+        reports[idx].append(line)
+        if line.startswith("positive examples: "):
+            positives[idx] = line[len("positive examples: ") :]
+        elif line.startswith("counter examples: "):
+            counters[idx] = line[len("counter examples: ") :]
+            if max_counter_examples and any(positives):
+                n_counters = len(json.loads(merged()[1]))
+                if n_counters >= max_counter_examples:
+                    logging.info(
+                        f"Found {n_counters} counter examples. Stopping verification."
+                    )
+                    return True
+        else:
+            status = LIBFUZZER_STATUS.match(line)
+            if status and int(status.group(2)) > coverage[idx]:
+                coverage[idx] = int(status.group(2))
+                last_progress = time.monotonic()
+        return False
+
+    deadline = time.monotonic() + timeout
+    try:
+        while running:
+            now = time.monotonic()
+            if now >= deadline:
+                logging.info("Verification timeout.")
+                timed_out = True
+                break
+            if (
+                plateau_seconds
+                and any(counters)
+                and now - last_progress >= plateau_seconds
+            ):
+                logging.info(
+                    f"Coverage did not grow for {plateau_seconds}s. Stopping verification."
+                )
+                break
+            try:
+                idx, line = lines.get(timeout=min(1.0, deadline - now))
+            except queue.Empty:
+                continue
+            if handle(idx, line):
+                break
+
+        interrupted = True
+        if keep_partial or not timed_out:
+            for shard in shards:
+                shard.signal(signal.SIGINT)
+            grace = time.monotonic() + INTERRUPT_GRACE
+            while running and time.monotonic() < grace:
+                try:
+                    handle(*lines.get(timeout=max(0.0, grace - time.monotonic())))
+                except queue.Empty:
+                    break
+    finally:
+        for shard in shards:
+            shard.stop()
+
+    if timed_out and not keep_partial:
+        return None
+
+    if len(failed) == n_shards:
+        tail = "\n".join(reports[0][-20:])
+        raise FuzzingError(
+            f"Every fuzzing shard exited without examples, with codes {list(failed.values())}:\n{tail}"
+        )
+
+    if not any(positives) or not any(counters):
+        return None
+
+    if n_shards == 1:
+        crash_report = "\n".join(reports[0])
+    else:
+        crash_report = "\n".join(
+            f"==== shard {idx} (seed {seed}) ====\n" + "\n".join(report)
+            for idx, (seed, report) in enumerate(zip(seeds, reports))
+        )
+    return (crash_report, *merged())
+
+
 def verify(
-    fuzz_target: str, submodule_name: str, result_path: Optional[str] = None
+    fuzz_target: str,
+    submodule_name: str,
+    result_path: Optional[str] = None,
+    n_shards: int = 1,
+    max_counter_examples: int = 0,
+    plateau_seconds: float = 0,
+    corpus: Optional[CorpusStore] = None,
 ) -> Optional[Tuple[str, str]]:
     """
     Verify the fuzzing target
@@ -158,6 +492,10 @@ def verify(
         fuzz_target (str): Path to the fuzz target.
         submoduel_name (str): Name of the submodule.
         result_path (Optional[str]): Optional result path.
+        n_shards (int): Number of fuzzing processes run in parallel.
+        max_counter_examples (int): Stop fuzzing once that many counter examples are found, 0 to let the fuzzer finish.
+        plateau_seconds (float): Stop fuzzing once counter examples are found and coverage stalls that long, 0 to disable.
+        corpus (Optional[CorpusStore]): Seeds fuzzing and collects the new corpus.
 
     Returns:
         None: If fails to generate oracle.
@@ -185,6 +523,12 @@ def verify(
     if len(main_entry) == 0:
         return None
 
+    corpus_dir: Optional[str] = None
+    if corpus:
+        corpus_dir = f"{fuzz_target}/__corpus__"
+        n_seeds = corpus.seed(corpus_dir)
+        logging.info(f"Seeded fuzzing with {n_seeds} inputs.")
+
     VERIFICATION_TIMEOUT = 420
     RETRY_LIMIT = 0
     # exponential backoff...
@@ -192,40 +536,35 @@ def verify(
     retry_cnt = 0
     timeout = VERIFICATION_TIMEOUT
     while True:
-        verification = subprocess.Popen(
-            f"cargo bolero test --manifest-path {fuzz_target}/Cargo.toml "
-            f"--features fuzzing {main_entry} --target-dir {fuzz_target}/target/__fuzz__ "
-            "--sanitizer NONE "
-            f'--engine-args="-rss_limit_mb=8096 -max_len={init_max_len}" ',
-            shell=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            env=env,
-        )
         try:
-            _, errs = verification.communicate(timeout=timeout)
-            crash_report = errs.decode("utf-8").strip()
+            result = fuzz(
+                fuzz_target,
+                main_entry,
+                env,
+                init_max_len,
+                timeout,
+                n_shards=n_shards,
+                max_counter_examples=max_counter_examples,
+                plateau_seconds=plateau_seconds,
+                corpus_dir=corpus_dir,
+            )
+        except FuzzingError as e:
+            logging.info(f"Fuzzing failed: {e}")
+            return None
+        if corpus:
+            n_new = corpus.merge_back(corpus_dir)
+            logging.info(f"Merged {n_new} new inputs back into the corpus.")
+            corpus.reduce(fuzz_target, main_entry, env)
+        if result:
             break
-        except subprocess.TimeoutExpired:
-            verification.kill()
-            if retry_cnt == RETRY_LIMIT:
-                return None
-            logging.info("Verification timeout. Increasing max input size.")
-            retry_cnt += 1
-            init_max_len *= 4
-            timeout *= 2
-            continue
-
-    positive_examples: Optional[str] = None
-    counter_examples: Optional[str] = None
-    for line in crash_report.splitlines():
-        if line.startswith("positive examples: "):
-            positive_examples = line[len("positive examples: ") :]
-        elif line.startswith("counter examples: "):
-            counter_examples = line[len("counter examples: ") :]
+        if retry_cnt == RETRY_LIMIT:
+            return None
+        logging.info("Increasing max input size.")
+        retry_cnt += 1
+        init_max_len *= 4
+        timeout *= 2
 
-    if not positive_examples or not counter_examples:
-        return None
+    crash_report, positive_examples, counter_examples = result
 
     # report, _ = compute_coverage_by_libfuzzer_corpus(fuzz_target)
 
@@ -240,31 +579,98 @@ def verify(
     return positive_examples, counter_examples
 
 
-rust_sysroot = (
-    subprocess.run("rustc --print sysroot", capture_output=True, shell=True, check=True)
-    .stdout.decode("utf-8")
-    .strip()
-)
-llvm_cov = (
-    subprocess.run(
-        f'find {rust_sysroot} -name "llvm-cov" | head -n 1',
-        capture_output=True,
-        shell=True,
-        check=True,
-    )
-    .stdout.decode("utf-8")
-    .strip()
-)
-llvm_profdata = (
-    subprocess.run(
-        f'find {rust_sysroot} -name "llvm-profdata" | head -n 1',
-        capture_output=True,
-        shell=True,
-        check=True,
+# Environment variables overriding the toolchain discovery
+TOOLCHAIN_OVERRIDES = {
+    "sysroot": "GAINTRUST_RUST_SYSROOT",
+    "llvm-cov": "GAINTRUST_LLVM_COV",
+    "llvm-profdata": "GAINTRUST_LLVM_PROFDATA",
+}
+
+
+def find_tool(sysroot: str, name: str) -> str:
+    for dirpath, _, filenames in os.walk(sysroot):
+        if name in filenames:
+            return os.path.join(dirpath, name)
+    return ""
+
+
+@functools.lru_cache(maxsize=None)
+def toolchain() -> Dict[str, str]:
+    """
+    Locate the Rust sysroot and the LLVM coverage tools shipped with it
+
+    Finding the tools walks the whole sysroot, so results are cached on disk per
+    rustc version. Each entry can be overridden with the environment variables
+    of TOOLCHAIN_OVERRIDES, in which case rustc is not even queried.
+
+    Returns:
+        Dict[str, str]: Paths of sysroot, llvm-cov and llvm-profdata. Tools that
+            cannot be found map to an empty string.
+    """
+    tools = {
+        key: os.environ[var]
+        for key, var in TOOLCHAIN_OVERRIDES.items()
+        if os.environ.get(var)
+    }
+    if len(tools) == len(TOOLCHAIN_OVERRIDES):
+        return tools
+
+    version = subprocess.run(
+        ["rustc", "-vV"], capture_output=True, check=True, text=True
+    ).stdout
+    cache_file = (
+        cache_root() / "toolchain" / f"{digest(version, tools.get('sysroot', ''))[:16]}.json"
     )
-    .stdout.decode("utf-8")
-    .strip()
-)
+    discovered: Dict[str, str] = {}
+    if cache_file.exists():
+        try:
+            discovered = json.loads(cache_file.read_text())
+        except json.JSONDecodeError:
+            discovered = {}
+
+    if not all(discovered.get(key) for key in TOOLCHAIN_OVERRIDES):
+        sysroot = tools.get("sysroot") or (
+            subprocess.run(
+                ["rustc", "--print", "sysroot"],
+                capture_output=True,
+                check=True,
+                text=True,
+            ).stdout.strip()
+        )
+        discovered = {
+            "sysroot": sysroot,
+            "llvm-cov": find_tool(sysroot, "llvm-cov"),
+            "llvm-profdata": find_tool(sysroot, "llvm-profdata"),
+        }
+        # a missing tool is not cached, it may get installed later
+        if all(discovered.values()):
+            cache_file.parent.mkdir(parents=True, exist_ok=True)
+            tmp_file = cache_file.with_suffix(f".{os.getpid()}.tmp")
+            tmp_file.write_text(json.dumps(discovered))
+            os.replace(tmp_file, cache_file)
+
+    return {**discovered, **tools}
+
+
+def rust_sysroot() -> str:
+    return toolchain()["sysroot"]
+
+
+def llvm_tool(name: str) -> str:
+    path = toolchain()[name]
+    if not path:
+        raise RuntimeError(
+            f"{name} not found, install llvm-tools-preview or set {TOOLCHAIN_OVERRIDES[name]}"
+        )
+    return path
+
+
+def llvm_cov() -> str:
+    return llvm_tool("llvm-cov")
+
+
+def llvm_profdata() -> str:
+    return llvm_tool("llvm-profdata")
 
 
 def parse_llvm_cov_show(target_dir: str, show: str) -> List[Tuple[str, str]]:
@@ -311,26 +717,10 @@ def test_cases_cov_info(replay_dir: str, io_examples: str) -> List[int]:
         List[int]: A mapping from line number to the number of examples that cover it
         List[str]: A list of processed lines. We need this since line numbers in original code and coverage report might not match.
     """
-    io_examples = json.loads(io_examples)
-    cov_mat = []
-    processed_lines: List[str] = []
-    for io_example in io_examples:
-        _, show = compute_coverage(replay_dir, json.dumps([io_example]))
-
-        def parse_exec_count(s: str) -> int:
-            try:
-                return int(s)
-            except ValueError:
-                return 0
+    cov_mat, processed_lines = compute_coverage_matrix(replay_dir, io_examples)
 
-        cov: List[int] = list(
-            map(lambda line_info: parse_exec_count(line_info[0]), show)
-        )
-        cov_mat.append(cov)
-
-        processed_lines = list(
-            map(lambda line_info: line_info[1], show)
-        )  # same for every loop iteration
+    if not cov_mat:
+        return [0] * len(processed_lines), processed_lines
 
     # transpose cov matrix: line -> io_example -> int
     cov_mat = [list(l) for l in zip(*cov_mat)]
@@ -345,52 +735,44 @@ def compute_sbfl_scores(
     positive_examples: str,
     counter_examples: str,
     sbfl_technique: str = "ochiai",
-):
-    totalp = len(json.loads(positive_examples))
-    totalf = len(json.loads(counter_examples))
+) -> Tuple[List[float], List[str]]:
+    """
+    Score the lines of a candidate by spectrum-based fault localization
 
-    covp, processed_lines = test_cases_cov_info(replay_dir, positive_examples)
-    covf, processed_lines = test_cases_cov_info(replay_dir, counter_examples)
+    Args:
+        replay_dir (str): Path to the replay target.
+        positive_examples (str): A set of positive examples.
+        counter_examples (str): A set of counter examples.
+        sbfl_technique (str): One of fault_localization.FORMULAS.
 
-    def ochiai(totalp, totalf, ep, ef):
-        try:
-            return (ef * ef) / ((totalp + totalf) * (ef + ep))
-        except ZeroDivisionError:
-            return 0
+    Returns:
+        List[float]: Suspiciousness score per line.
+        List[str]: The scored lines.
+    """
+    import numpy as np
 
-    def tarantula(totalp, totalf, ep, ef):
-        np = totalp - ep
-        nf = totalf - ef
-        try:
-            return (ef / ef + nf) / ((ef / ef + nf) + (ep / ep + np))
-        except ZeroDivisionError:
-            return 0
+    import fault_localization
 
-    if sbfl_technique == "ochiai":
-        scores = [ochiai(totalp, totalf, ep, ef) for ep, ef in zip(covp, covf)]
-    else:
-        scores = [tarantula(totalp, totalf, ep, ef) for ep, ef in zip(covp, covf)]
+    covp, processed_lines = compute_coverage_matrix(replay_dir, positive_examples)
+    covf, processed_lines = compute_coverage_matrix(replay_dir, counter_examples)
 
-    return scores, processed_lines
+    n_lines = len(processed_lines)
+    if n_lines == 0:
+        return [], processed_lines
+    coverage = np.array(covp + covf, dtype=np.int64).reshape(-1, n_lines) > 0
+    failing = np.arange(coverage.shape[0]) >= len(covp)
+    scores = fault_localization.suspiciousness(coverage, failing, sbfl_technique)
+
+    return scores.tolist(), processed_lines
 
 
 def group_examples_by_coverage(
     replay_dir: str, negative_examples: str, N_EXAMPLES: int, early_stop: bool = True
 ) -> Dict[List[int], Any]:
-    negative_examples = json.loads(negative_examples)
+    cov_mat, _ = compute_coverage_matrix(replay_dir, negative_examples)
     cov_to_ce = defaultdict(list)
-    for example in negative_examples:
-        l_cov = []
-        _, ex_data = compute_coverage(replay_dir, str([example]))
-        for ex_d in ex_data:
-            try:
-                ex_cnt = int(ex_d[0])
-                if ex_cnt > 0:
-                    l_cov.append(1)
-                else:
-                    l_cov.append(0)
-            except:
-                l_cov.append(0)
+    for example, cov in zip(json.loads(negative_examples), cov_mat):
+        l_cov = [1 if cnt > 0 else 0 for cnt in cov]
         cov_to_ce[str(l_cov)].append(example)
         if early_stop and len(cov_to_ce[str(l_cov)]) == N_EXAMPLES:
             return {str(l_cov): cov_to_ce[str(l_cov)]}
@@ -408,19 +790,10 @@ def group_inp_by_coverage(ces, lang, res_dir, submodule_name):
         except subprocess.CalledProcessError:
             logging.info("Failed to instrument candidate.")
             return None
+        cov_mat, _ = compute_coverage_matrix(workspace, json.dumps(ces))
         cov_to_ce = defaultdict(list)
-        for ce in ces:
-            l_cov = []
-            _, ex_data = compute_coverage(workspace, str([ce]))
-            for ex_d in ex_data:
-                try:
-                    ex_cnt = int(ex_d[0])
-                    if ex_cnt > 0:
-                        l_cov.append(1)
-                    else:
-                        l_cov.append(0)
-                except:
-                    l_cov.append(0)
+        for ce, cov in zip(ces, cov_mat):
+            l_cov = [1 if cnt > 0 else 0 for cnt in cov]
             cov_to_ce[str(l_cov)].append(ce)
         # except subprocess.CalledProcessError:
         #     logging.info("Failed to instrument candidate.")
@@ -469,13 +842,13 @@ def compute_coverage_by_libfuzzer_corpus(
     )
 
     subprocess.call(
-        f"{llvm_profdata} merge -sparse {fuzz_target}/*.profraw -o {fuzz_target}/cov.profdata",
+        f"{llvm_profdata()} merge -sparse {fuzz_target}/*.profraw -o {fuzz_target}/cov.profdata",
         shell=True,
     )
 
     report = (
         subprocess.run(
-            f"{llvm_cov} report -instr-profile={fuzz_target}/cov.profdata {test_bin}",
+            f"{llvm_cov()} report -instr-profile={fuzz_target}/cov.profdata {test_bin}",
             shell=True,
             capture_output=True,
         )
@@ -484,7 +857,7 @@ def compute_coverage_by_libfuzzer_corpus(
     )
     show = (
         subprocess.run(
-            f"{llvm_cov} show -instr-profile={fuzz_target}/cov.profdata {test_bin} "
+            f"{llvm_cov()} show -instr-profile={fuzz_target}/cov.profdata {test_bin} "
             "--show-instantiations --show-line-counts-or-regions",
             shell=True,
             capture_output=True,
@@ -543,13 +916,13 @@ def compute_coverage(
     )
 
     subprocess.call(
-        f"{llvm_profdata} merge -sparse {replay_dir}/*.profraw -o {replay_dir}/cov.profdata",
+        f"{llvm_profdata()} merge -sparse {replay_dir}/*.profraw -o {replay_dir}/cov.profdata",
         shell=True,
     )
 
     report = (
         subprocess.run(
-            f"{llvm_cov} report -instr-profile={replay_dir}/cov.profdata {test_bin}",
+            f"{llvm_cov()} report -instr-profile={replay_dir}/cov.profdata {test_bin}",
             shell=True,
             capture_output=True,
         )
@@ -558,7 +931,7 @@ def compute_coverage(
     )
     show = (
         subprocess.run(
-            f"{llvm_cov} show -instr-profile={replay_dir}/cov.profdata {test_bin} "
+            f"{llvm_cov()} show -instr-profile={replay_dir}/cov.profdata {test_bin} "
             "--show-instantiations --show-line-counts-or-regions",
             shell=True,
             capture_output=True,
@@ -570,6 +943,189 @@ def compute_coverage(
     return report, parse_llvm_cov_show(replay_dir, show)
 
 
+COVERAGE_FLAGS = "-Zunstable-options -C instrument-coverage=except-unused-functions"
+
+
+def build_replay_test_binary(replay_dir: str) -> str:
+    """
+    Build the coverage-instrumented test binary of a replay target.
+
+    Returns:
+        str: Path to the test binary.
+    """
+    env = os.environ.copy()
+    env["RUSTFLAGS"] = COVERAGE_FLAGS
+    build = subprocess.run(
+        [
+            "cargo",
+            "test",
+            "--manifest-path",
+            f"{replay_dir}/Cargo.toml",
+            "--features",
+            "replay",
+            "--tests",
+            "--no-run",
+            "--message-format=json",
+        ],
+        capture_output=True,
+        check=True,
+        env=env,
+    )
+    for line in build.stdout.decode("utf-8").splitlines():
+        if not line.startswith("{"):
+            continue
+        artifact = json.loads(line)
+        if artifact.get("reason") != "compiler-artifact":
+            continue
+        if artifact["profile"]["test"] and artifact.get("executable"):
+            return artifact["executable"]
+    raise RuntimeError(f"No test binary built for {replay_dir}")
+
+
+def line_counts(segments: List[List[Any]], first: int, last: int) -> List[int]:
+    """
+    Execution counts of lines first..last from llvm-cov export segments, the
+    same way llvm-cov show computes its line counts.
+
+    Args:
+        segments (List[List[Any]]): Sorted [line, col, count, has_count, is_region_entry, (is_gap)] entries.
+        first (int): First line, 1-based.
+        last (int): Last line, inclusive.
+
+    Returns:
+        List[int]: Execution count per line, 0 for lines that are not mapped.
+    """
+    counts = []
+    idx = 0
+    wrapped = None  # the region that is still active at the start of a line
+    for line in range(first, last + 1):
+        while idx < len(segments) and segments[idx][0] < line:
+            wrapped = segments[idx]
+            idx += 1
+        line_segments = []
+        while idx < len(segments) and segments[idx][0] == line:
+            line_segments.append(segments[idx])
+            idx += 1
+
+        def starts_region(segment: List[Any]) -> bool:
+            is_gap = len(segment) > 5 and segment[5]
+            return segment[3] and segment[4] and not is_gap
+
+        count = wrapped[2] if wrapped and wrapped[3] else 0
+        if line_segments and not line_segments[0][3] and line_segments[0][4]:
+            count = 0  # start of a skipped region
+        for segment in line_segments:
+            if starts_region(segment):
+                count = max(count, segment[2])
+        counts.append(count)
+
+        if line_segments:
+            wrapped = line_segments[-1]
+    return counts
+
+
+def compute_coverage_matrix(
+    replay_dir: str, io_examples: str, max_workers: Optional[int] = None
+) -> Tuple[List[List[int]], List[str]]:
+    """
+    Compute line coverage of every I/O example separately
+
+    The replay binary is built once and every example runs it with its own
+    profile, so the cost per example is one run of the test binary, one
+    llvm-profdata merge and one llvm-cov export, executed concurrently.
+
+    Args:
+        replay_dir (str): Path to the replay target.
+        io_examples (str): A list of examples.
+        max_workers (Optional[int]): Number of examples processed concurrently.
+
+    Returns:
+        List[List[int]]: A mapping from example to line to execution count.
+        List[str]: The non-blank lines between the extern "C" block and mod communication.
+    """
+    replay_dir = os.path.abspath(replay_dir)
+    examples = json.loads(io_examples)
+    src_file = f"{replay_dir}/src/lib.rs"
+
+    with open(src_file, "r") as f:
+        src_lines = f.read().splitlines()
+    first: Optional[int] = None
+    last = len(src_lines)
+    for line_no, line in enumerate(src_lines, start=1):
+        if "mod communication {" in line:
+            last = line_no - 1
+            break
+        if 'extern "C" {' in line and first is None:
+            first = line_no
+    if first is None:
+        logging.info(f'No extern "C" block in {src_file}, no line to cover.')
+        return [], []
+    # blank lines are skipped, as parse_llvm_cov_show does
+    line_numbers = [
+        line_no for line_no in range(first, last + 1) if src_lines[line_no - 1].strip()
+    ]
+    processed_lines = [src_lines[line_no - 1] for line_no in line_numbers]
+
+    if not examples:
+        return [], processed_lines
+
+    test_bin = build_replay_test_binary(replay_dir)
+
+    with tempfile.TemporaryDirectory() as prof_dir:
+
+        def example_coverage(idx: int, example: Any) -> List[int]:
+            env = os.environ.copy()
+            env["LLVM_PROFILE_FILE"] = f"{prof_dir}/{idx}.profraw"
+            subprocess.run(
+                [test_bin],
+                input=json.dumps([example]).encode(),
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                cwd=replay_dir,
+                env=env,
+            )
+            subprocess.run(
+                [
+                    llvm_profdata(),
+                    "merge",
+                    "-sparse",
+                    f"{prof_dir}/{idx}.profraw",
+                    "-o",
+                    f"{prof_dir}/{idx}.profdata",
+                ],
+                capture_output=True,
+                check=True,
+            )
+            export = subprocess.run(
+                [
+                    llvm_cov(),
+                    "export",
+                    "-format=text",
+                    "-skip-functions",
+                    f"-instr-profile={prof_dir}/{idx}.profdata",
+                    test_bin,
+                    src_file,
+                ],
+                capture_output=True,
+                check=True,
+            )
+            files = json.loads(export.stdout)["data"][0]["files"]
+            for file_info in files:
+                if os.path.realpath(file_info["filename"]) == os.path.realpath(src_file):
+                    counts = line_counts(file_info["segments"], first, last)
+                    return [counts[line_no - first] for line_no in line_numbers]
+            return [0] * len(processed_lines)
+
+        with ContextThreadPoolExecutor(
+            max_workers=max_workers or os.cpu_count()
+        ) as executor:
+            cov_mat = list(
+                executor.map(example_coverage, range(len(examples)), examples)
+            )
+
+    return cov_mat, processed_lines
+
+
 def soft_verify(
     replay_target: str,
     submodule_name: str,
@@ -1,8 +1,8 @@
-from dataclasses import dataclass
-from typing import Any, Optional, List, Tuple, Union
-import anthropic
+from dataclasses import dataclass, replace
+from typing import Any, Iterator, Optional, List, Tuple, Union
 import logging
 import json
+import re
 import random
 import tempfile
 import functools
@@ -14,16 +14,30 @@ import llms
 from llms import Prompt, QueryEngine
 
 from utils import (
+    BUILD,
     compile_and_record_query,
-    parse_error_coarse,
+    parse_error_json,
     tag,
     make_prompt,
     make_instruction,
     tag,
 )
 from settings import Options
+from corpus import CorpusStore, corpus_store
+from budget import elide_functions, fit_prompt
 import oracle
 
+# Arrays in examples shown to the model are cut to this many elements
+MAX_ARRAY_LENGTH = 5
+
+FIX_CONSTRAINTS = [
+    "Use only safe Rust.",
+    "Don't use raw pointers.",
+    "Use box pointer whenever possible. Box pointers are preferable to other alternatives.",
+    "Try not to use Traits if possible. I would not like to have Traits in resulting Rust code.",
+    "Try not to use custom Generics if possible.",
+]
+
 
 class ConversationFeedback(Enum):
     NEGATIVE = (-1,)
@@ -157,58 +171,85 @@ class Candidate:
             ce_group = random.sample(self.extra.ce_group, n_examples)
         else:
             ce_group = self.extra.ce_group
-        textual_examples = list_examples(ce_group)
-
-        if len(history) > 0:
-            return Prompt(
-                context="That is incorrect on the following inputs:\n" + tag(textual_examples, "testcases"),
-                instruction="Make changes in the given code to obtain expected outputs for given test inputs.",
-                constraints=[
-                    "Use only safe Rust.",
-                    "Don't use raw pointers.",
-                    "Use box pointer whenever possible. Box pointers are preferable to other alternatives.",
-                    "Try not to use Traits if possible. I would not like to have Traits in resulting Rust code.",
-                    "Try not to use custom Generics if possible.",
-                ],
-                history=history
-            )
 
-        context = (
-            f"\n\nYou are given a {src_lang} code contained in the following <code> tag\n"
-            + tag(src_code, "code")
-            + "\n"
-            + "You are also given a plausible Rust translation contained in <code> tag that does not provide expected outputs for certain inputs. "
-            + tag(self.rust_code, "code")
-            + "\n"
-        )
+        def context_of(src: str) -> str:
+            return (
+                f"\n\nYou are given a {src_lang} code contained in the following <code> tag\n"
+                + tag(src, "code")
+                + "\n"
+                + "You are also given a plausible Rust translation contained in <code> tag that does not provide expected outputs for certain inputs. "
+                + tag(self.rust_code, "code")
+                + "\n"
+            )
 
-        extra_information: str
-        if n_examples > 0:
-            enhancement = self.extra.enhancement(context, textual_examples, query_engine)
-            extra_information = (
+        def extra_information_of(textual_examples: str, enhancement: str = "") -> str:
+            if n_examples == 0:
+                return ""
+            return (
                 "A set of input/output example(s) contained in <testcases> tag is given below.\n"
                 + tag(textual_examples, "testcases")
                 + "\n"
                 + enhancement
             )
-        else:
-            extra_information = ""
 
-        prompt = Prompt(
-            context=context,
-            instruction="Make changes in the given code to obtain expected outputs for given test inputs.",
-            constraints=[
-                "Use only safe Rust.",
-                "Don't use raw pointers.",
-                "Use box pointer whenever possible. Box pointers are preferable to other alternatives.",
-                "Try not to use Traits if possible. I would not like to have Traits in resulting Rust code.",
-                "Try not to use custom Generics if possible.",
-            ],
-            extra_information=extra_information,
-        )
+        # the enhancement is a query of its own, only made for the variant that fits
+        fitted: List[Tuple[str, str]] = []
+
+        def variants() -> Iterator[Prompt]:
+            for examples, max_array_length, src in self.trimmed_inputs(ce_group, src_code):
+                textual_examples = list_examples(examples, max_array_length)
+                if len(history) > 0:
+                    yield Prompt(
+                        context="That is incorrect on the following inputs:\n" + tag(textual_examples, "testcases"),
+                        instruction="Make changes in the given code to obtain expected outputs for given test inputs.",
+                        constraints=list(FIX_CONSTRAINTS),
+                        history=history
+                    )
+                else:
+                    # recorded before yielding, fit_prompt does not resume the variant it picks
+                    fitted.append((src, textual_examples))
+                    yield Prompt(
+                        context=context_of(src),
+                        instruction="Make changes in the given code to obtain expected outputs for given test inputs.",
+                        constraints=list(FIX_CONSTRAINTS),
+                        extra_information=extra_information_of(textual_examples),
+                    )
+
+        prompt = fit_prompt(query_engine, variants())
+
+        if len(history) == 0 and n_examples > 0:
+            src, textual_examples = fitted[-1]
+            enhancement = self.extra.enhancement(context_of(src), textual_examples, query_engine)
+            if enhancement:
+                enhanced = replace(
+                    prompt, extra_information=extra_information_of(textual_examples, enhancement)
+                )
+                # the enhancement is dropped if it pushes the prompt past the budget
+                prompt = fit_prompt(query_engine, [enhanced, prompt])
 
         return prompt
 
+    def trimmed_inputs(
+        self, ce_group: List[Any], src_code: str
+    ) -> Iterator[Tuple[List[Any], int, str]]:
+        """
+        Prompt inputs from the most to the least detailed: shorter arrays in
+        examples first, then fewer examples, then source functions the
+        candidate does not mention reduced to their signatures.
+
+        Yields:
+            Tuple[List[Any], int, str]: Examples, max_array_length of examples and source code.
+        """
+        for max_array_length in (MAX_ARRAY_LENGTH, 3, 1):
+            yield ce_group, max_array_length, src_code
+        n_examples = len(ce_group)
+        while n_examples > 1:
+            n_examples //= 2
+            yield ce_group[:n_examples], 1, src_code
+        yield ce_group[:1], 1, elide_functions(
+            src_code, lambda name: re.search(rf"\b{name}\b", self.rust_code) is not None
+        )
+
     @property
     def ok(self) -> bool:
         return self.score == 1
@@ -232,11 +273,24 @@ class CandidateFactory:
         language: str,
         submodule_name: str,
         sem_fix: str,
+        fuzz_shards: int = 1,
+        max_counter_examples: int = 0,
+        fuzz_plateau_seconds: int = 0,
+        reuse_fuzz_corpus: bool = False,
+        tiered_verification: bool = False,
     ) -> None:
         self.src_code = src_code
         self.src_code_json = src_code_json
         self.language = language
         self.submodule_name = submodule_name
+        self.fuzz_shards = fuzz_shards
+        self.max_counter_examples = max_counter_examples
+        self.fuzz_plateau_seconds = fuzz_plateau_seconds
+        self.reuse_fuzz_corpus = reuse_fuzz_corpus
+        self.tiered_verification = tiered_verification
+        self.store: Optional[CorpusStore] = None
+        if reuse_fuzz_corpus or tiered_verification:
+            self.store = corpus_store(language, submodule_name, src_code_json)
         if sem_fix == "base":
             Extra = Enhancement
         elif sem_fix == "llm-explain":
@@ -256,6 +310,41 @@ class CandidateFactory:
         )
         return ret
 
+    def verify(self, workspace: str) -> Optional[Tuple[str, str]]:
+        """
+        Generate the examples of a new candidate
+
+        With tiered verification, the examples banked for the benchmark are
+        replayed first and the fuzzer only runs if all of them pass.
+
+        Returns:
+            None: If fails to generate oracle.
+            Tuple[str, str]: A pair of positive/negative examples.
+        """
+        if self.tiered_verification and self.store:
+            bank = self.store.examples()
+            if bank:
+                replayed = oracle.soft_verify(
+                    workspace, self.submodule_name, json.dumps(bank), "[]"
+                )
+                if replayed and json.loads(replayed[1]):
+                    logging.info(
+                        f"{len(json.loads(replayed[1]))} of {len(bank)} banked examples fail. Skipping fuzzing."
+                    )
+                    return replayed
+
+        validation_result = oracle.verify(
+            workspace,
+            self.submodule_name,
+            n_shards=self.fuzz_shards,
+            max_counter_examples=self.max_counter_examples,
+            plateau_seconds=self.fuzz_plateau_seconds,
+            corpus=self.store if self.reuse_fuzz_corpus else None,
+        )
+        if validation_result and self.store:
+            self.store.record_examples(*validation_result)
+        return validation_result
+
     def debug_candidate(self, candidate: Candidate) -> None:
         with tempfile.TemporaryDirectory(ignore_cleanup_errors=True) as tmp_dir:
             src_dir = tmp_dir
@@ -331,7 +420,7 @@ class CandidateFactory:
             validation_result: Optional[Tuple[str, str]]
             if requires_verification:
                 # validation_result = oracle.verify_llm(self.language, self.src_code, rust_code, positive_examples)
-                validation_result = oracle.verify(workspace, self.submodule_name)
+                validation_result = self.verify(workspace)
             else:
                 validation_result = oracle.soft_verify(
                     workspace, self.submodule_name, positive_examples, negative_examples
@@ -401,23 +490,31 @@ class SemanticsStrategy:
             history=history[:(self.options.conversation_window_size * 2)],
         )
         REP_THOLD = 5
-        trial = 0
         new_rust_code: str
-        while trial < REP_THOLD:
-            new_rust_code = self.query_engine.generate_code(prompt)
+        samples = self.query_engine.code_samples(
+            prompt, REP_THOLD, self.options.samples_per_call
+        )
+        for new_rust_code in samples:
             comp_out = compile_and_record_query(
                 new_rust_code,
                 self.src_dir,
                 self.query_engine.stringify_prompt(prompt),
                 log_id=f"{self.restart_idx}_{self.budget}_{0}",
+                mode=self.options.compile_mode,
             )
-            comp_out = parse_error_coarse(
-                comp_out.stderr
-            )  # parse_error_timepass(, work_dir.split("/")[-1])
+            if not comp_out.returncode and self.options.compile_mode != BUILD:
+                # the fix is handed to the oracle, so it has to survive codegen too
+                comp_out = compile_and_record_query(
+                    new_rust_code,
+                    self.src_dir,
+                    self.query_engine.stringify_prompt(prompt),
+                    log_id=f"{self.restart_idx}_{self.budget}_{0}",
+                    mode=BUILD,
+                )
+            comp_out = parse_error_json(comp_out)
             if not len(comp_out[0]):
                 break
             logging.info("Fixed code does not compile. Giving it another try.")
-            trial += 1
 
         if len(comp_out[0]):
             # TODO
@@ -443,7 +540,9 @@ class SemanticsStrategy:
         return f"{self.options.work_dir}/wspace"
 
 
-def list_examples(negative_examples: List[Any]) -> str:
+def list_examples(
+    negative_examples: List[Any], max_array_length: int = MAX_ARRAY_LENGTH
+) -> str:
     examples_list = ""
     for ce_idx, s_ce in enumerate(negative_examples):
         if s_ce["actual"] == "ExecutionFailure":
@@ -451,19 +550,19 @@ def list_examples(negative_examples: List[Any]) -> str:
             act_out = "Runtime crash"
         else:
             act_out = s_ce["actual"]["ExecutionSuccess"]
-            act_out = simplify_data(json.loads(act_out))
+            act_out = simplify_data(json.loads(act_out), max_array_length)
 
         if s_ce["expected"] == "ExecutionFailure":
             # exp_out = "Execution Failure"
             exp_out = "Input is invalid, crash gracefully"
         else:
             exp_out = s_ce["expected"]["ExecutionSuccess"]
-            exp_out = simplify_data(json.loads(exp_out))
+            exp_out = simplify_data(json.loads(exp_out), max_array_length)
 
         arguments = "Arguments:\n"
         for arg_idx, arg in enumerate(s_ce["args"]):
             arg = json.loads(arg)
-            arg = simplify_data(arg)
+            arg = simplify_data(arg, max_array_length)
             arguments = arguments + f"  Argument {arg_idx}: {arg}\n"
 
         examples_list = (
@@ -474,18 +573,17 @@ def list_examples(negative_examples: List[Any]) -> str:
     return examples_list
 
 
-def simplify_data(json_data):
-    MAX_ARRAY_LENGTH = 5
+def simplify_data(json_data, max_array_length: int = MAX_ARRAY_LENGTH):
     if isinstance(json_data, dict):
-        return {key: simplify_data(value) for key, value in json_data.items()}
+        return {key: simplify_data(value, max_array_length) for key, value in json_data.items()}
     elif isinstance(json_data, list):
-        if len(json_data) > MAX_ARRAY_LENGTH:
-            n_removed = len(json_data) - MAX_ARRAY_LENGTH
-            return [simplify_data(value) for value in json_data[:MAX_ARRAY_LENGTH]] + [
+        if len(json_data) > max_array_length:
+            n_removed = len(json_data) - max_array_length
+            return [simplify_data(value, max_array_length) for value in json_data[:max_array_length]] + [
                 f"... and {n_removed} other elements"
             ]
         else:
-            return [simplify_data(value) for value in json_data]
+            return [simplify_data(value, max_array_length) for value in json_data]
 
     return json_data
 
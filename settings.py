@@ -26,6 +26,16 @@ class Options:
     beam_width: int = 1
     n_fix_peers: int = 1
     transpl_attempt_budget: int = 3
+    compile_mode: str = "check"  # choices = ["check", "build"]
+    parallel_candidates: int = 1  # >1 compiles initial translations concurrently
+    samples_per_call: int = 1  # candidates drawn per model call in retry loops
+    fuzz_shards: int = 1  # parallel fuzzing processes per verification
+    max_counter_examples: int = 0  # stop fuzzing once found, 0 waits for the fuzzer
+    fuzz_plateau_seconds: int = 0  # stop fuzzing when coverage stalls after counter examples, 0 disables
+    reuse_fuzz_corpus: bool = False  # seed fuzzing with the corpus of earlier candidates of the benchmark
+    tiered_verification: bool = False  # replay banked examples before fuzzing new candidates
+    response_cache: bool = False  # replay model responses of earlier runs with identical prompts
+    decomposition: str = "iter"  # choices = ["iter", "dag"], how the simplify fallback splits a benchmark
     model: str = "local-qwen"
 
     @property
@@ -24,7 +24,8 @@ from langchain_core.runnables import Runnable, RunnablePassthrough
 # Import GAINTRUST components
 from llms import QueryEngine, Prompt, USER, ASSISTANT, LocalQwen, CodeLlama
 from llms import QueryEngineFactory
-from utils import tag, cd, compile_and_record_query, parse_error_timepass, rudra_suggest
+from utils import tag, cd, compile_and_record_query, parse_error_json, rendered_diagnostics, rudra_suggest
+import crates
 from langchain_local_integration import LocalModelLangChainAdapter, CToRustTranspilerChain, CToRustTranspilerWithFeedback
 
 # Task types for C to Rust transpilation
@@ -59,10 +60,7 @@ class TaskRouter:
         if isinstance(model, str):
             if model in ["local-qwen", "codellama"]:
                 # Create a local model
-                if model == "local-qwen":
-                    engine = LocalQwen(self.global_constraints)
-                else:
-                    engine = CodeLlama(self.global_constraints)
+                engine = QueryEngineFactory.create_engine(model, self.global_constraints)
                 self.model = LocalModelLangChainAdapter(engine, model_name=model)
             else:
                 # Assume it's a remote model like GPT-4, Claude, etc.
@@ -73,7 +71,7 @@ class TaskRouter:
                     )
                 except ImportError:
                     # Fallback to local model if remote integration is not available
-                    engine = LocalQwen(self.global_constraints)
+                    engine = QueryEngineFactory.create_engine("local-qwen", self.global_constraints)
                     self.model = LocalModelLangChainAdapter(engine, model_name="local-qwen")
         else:
             # Already a LangChain model
@@ -174,10 +172,7 @@ class CToRustSupervisor:
         if isinstance(supervisor_model, str):
             if supervisor_model in ["local-qwen", "codellama"]:
                 # Create a local model
-                if supervisor_model == "local-qwen":
-                    engine = LocalQwen(self.global_constraints)
-                else:
-                    engine = CodeLlama(self.global_constraints)
+                engine = QueryEngineFactory.create_engine(supervisor_model, self.global_constraints)
                 self.supervisor = LocalModelLangChainAdapter(engine, model_name=supervisor_model)
             else:
                 # Assume it's a remote model
@@ -188,7 +183,7 @@ class CToRustSupervisor:
                     )
                 except ImportError:
                     # Fallback to local model if remote integration is not available
-                    engine = LocalQwen(self.global_constraints)
+                    engine = QueryEngineFactory.create_engine("local-qwen", self.global_constraints)
                     self.supervisor = LocalModelLangChainAdapter(engine, model_name="local-qwen")
         else:
             # Already a LangChain model
@@ -473,7 +468,7 @@ class CToRustSupervisor:
             )
             
             # Parse compilation errors
-            parsed_comp_out = parse_error_timepass(comp_out.stderr, file_name)
+            parsed_comp_out = parse_error_json(comp_out)
             num_errs = parsed_comp_out[-1]
             
             logging.info(f"Combined code has {num_errs} errors")
@@ -606,7 +601,7 @@ class SupervisorWithFeedback(CToRustSupervisor):
             if self.use_rudra:
                 error_output = rudra_suggest(compile_dir, f"{file_name}_feedback_{i+1}")
             else:
-                error_output = comp_out.stderr.decode("utf-8", errors="ignore") if hasattr(comp_out, 'stderr') else ""
+                error_output = rendered_diagnostics(comp_out)
             
             # Create feedback prompt
             feedback_prompt = ChatPromptTemplate.from_messages([
@@ -669,7 +664,7 @@ Return only the fixed Rust code in a markdown rust block.
                 )
                 
                 # Parse compilation errors
-                parsed_comp_out = parse_error_timepass(comp_out.stderr, file_name)
+                parsed_comp_out = parse_error_json(comp_out)
                 num_errs = parsed_comp_out[-1]
                 
                 logging.info(f"Feedback loop {i+1}: {num_errs} errors")
@@ -702,8 +697,7 @@ Return only the fixed Rust code in a markdown rust block.
         
         # Clean up
         src_dir = f"{self.work_dir}/wspace"
-        with cd(src_dir):
-            subprocess.run("cargo clean", capture_output=True, shell=True)
+        crates.clean(src_dir)
         
         return result
 
@@ -0,0 +1,75 @@
+from typing import Optional
+
+from budget import elide_functions, fit_prompt, function_bodies
+from llms import Prompt, QueryEngine
+
+C_CODE = """\
+#include <stdio.h>
+struct point { int x; int y; };
+
+static int used(int x) {
+    // a } in a comment
+    if (x) { return 1; }
+    return 0;
+}
+
+int unused(const char *s) {
+    printf("{ %s", s);
+    return '}';
+}
+"""
+
+
+class CountingEngine(QueryEngine):
+    def __init__(self, budget: Optional[int]) -> None:
+        super().__init__([])
+        self.budget = budget
+
+    def raw_query(self, prompt, model_params):
+        raise NotImplementedError
+
+    def prompt_budget(self) -> Optional[int]:
+        return self.budget
+
+    def prompt_tokens(self, prompt: Prompt) -> int:
+        return len(prompt.context)
+
+
+def test_function_bodies_skip_braces_of_structs_comments_and_literals():
+    bodies = [(name, C_CODE[start:end]) for name, start, end in function_bodies(C_CODE)]
+    assert [name for name, _ in bodies] == ["used", "unused"]
+    assert bodies[0][1].startswith("{\n    // a }")
+    assert bodies[0][1].endswith("return 0;\n}")
+    assert bodies[1][1].endswith("return '}';\n}")
+
+
+def test_elide_functions_keeps_signatures():
+    elided = elide_functions(C_CODE, lambda name: name == "used")
+    assert "if (x) { return 1; }" in elided
+    assert "int unused(const char *s) { /* ... */ }" in elided
+    assert "printf" not in elided
+    assert "struct point { int x; int y; };" in elided
+
+
+def test_fit_prompt_picks_the_first_variant_within_budget():
+    variants = [Prompt(context="x" * size) for size in (30, 20, 10)]
+    assert fit_prompt(CountingEngine(25), variants) is variants[1]
+
+
+def test_fit_prompt_falls_back_to_the_smallest_variant():
+    variants = [Prompt(context="x" * size) for size in (30, 20)]
+    assert fit_prompt(CountingEngine(5), variants) is variants[1]
+
+
+def test_fit_prompt_builds_no_variant_it_does_not_need():
+    built = []
+
+    def variants():
+        for size in (30, 20, 10):
+            built.append(size)
+            yield Prompt(context="x" * size)
+
+    fit_prompt(CountingEngine(None), variants())
+    assert built == [30]
+    fit_prompt(CountingEngine(25), variants())
+    assert built == [30, 30, 20]
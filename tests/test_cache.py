@@ -0,0 +1,49 @@
+import os
+
+import pytest
+
+from cache import DiskCache, digest
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    monkeypatch.setenv("GAINTRUST_CACHE_DIR", str(tmp_path))
+    return DiskCache("test", max_bytes=10)
+
+
+def test_digest_is_length_prefixed():
+    assert digest("ab", "c") != digest("a", "bc")
+    assert digest("a", b"b") == digest(b"a", "b")
+
+
+def test_get_returns_what_put_stored(cache):
+    assert cache.get("key") is None
+    with cache.put("key") as entry:
+        (entry / "value").write_text("42")
+    assert (cache.get("key") / "value").read_text() == "42"
+    assert cache.stats() == "test cache: 1 hits, 1 misses (50% hit rate)"
+
+
+def test_failed_put_stores_nothing(cache):
+    with pytest.raises(RuntimeError):
+        with cache.put("key") as entry:
+            (entry / "value").write_text("partial")
+            raise RuntimeError
+    assert cache.get("key") is None
+    assert not any(path.name.startswith(".tmp-") for path in cache.root.iterdir())
+
+
+def test_eviction_drops_least_recently_used_entries(cache):
+    for idx, key in enumerate(["old", "used", "new"]):
+        with cache.put(key) as entry:
+            (entry / "value").write_text("1234")
+        os.utime(cache.path(key), (idx, idx))
+    # a lookup makes an entry the most recently used
+    cache.get("used")
+    with cache.put("newest") as entry:
+        (entry / "value").write_text("1234")
+
+    assert cache.get("old") is None
+    assert cache.get("new") is None
+    assert cache.get("used") is not None
+    assert cache.get("newest") is not None
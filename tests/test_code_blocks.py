@@ -0,0 +1,46 @@
+import pytest
+
+from llms import CodeBlockExtractor, QueryEngine, truncate_at_code_block, truncate_at_stop
+
+RESPONSE = "Here it is:\n```rust\nfn f() -> i32 { 1 }\n```\nIt returns 1.\n```\nmore\n```"
+
+
+def test_code_block_ends_the_response():
+    assert truncate_at_code_block(RESPONSE) == RESPONSE[: RESPONSE.index("\nIt returns")]
+    assert truncate_at_code_block("no code yet") == "no code yet"
+
+
+def test_tagged_code_block():
+    response = "<code>fn f() {}</code> and ```rust\nfn g() {}\n```"
+    assert truncate_at_code_block(response) == "<code>fn f() {}</code>"
+
+
+def test_unclosed_code_block_is_kept():
+    assert truncate_at_code_block("```rust\nfn f() {") == "```rust\nfn f() {"
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 5, 8])
+def test_extractor_finds_delimiters_split_across_chunks(size):
+    extractor = CodeBlockExtractor()
+    chunks = [RESPONSE[idx : idx + size] for idx in range(0, len(RESPONSE), size)]
+    fed = 0
+    for chunk in chunks:
+        fed += len(chunk)
+        if extractor.feed(chunk):
+            break
+    assert extractor.end == RESPONSE.index("\nIt returns")
+    # it stops as soon as the closing delimiter is complete
+    assert fed < extractor.end + size
+    assert extractor.code == "rust\nfn f() -> i32 { 1 }\n"
+    assert QueryEngine.extract(RESPONSE[: extractor.end]).strip() == "fn f() -> i32 { 1 }"
+
+
+def test_extractor_has_no_code_before_the_block_closes():
+    extractor = CodeBlockExtractor()
+    assert not extractor.feed("```rust\nfn f")
+    assert extractor.code is None
+
+
+def test_truncate_at_the_earliest_stop():
+    assert truncate_at_stop("a STOP b END c", ["END", "STOP"]) == "a STOP"
+    assert truncate_at_stop("a b", ["END"]) == "a b"
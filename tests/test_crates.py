@@ -0,0 +1,80 @@
+import shutil
+import subprocess
+
+import pytest
+
+import crates
+import utils
+
+BROKEN = 'pub fn f() -> i32 { let x: i32 = "a"; x }\n'
+
+
+def has_nightly_cargo() -> bool:
+    # compilation flags are nightly options
+    if shutil.which("cargo") is None:
+        return False
+    return subprocess.run(["rustc", "-Z", "help"], capture_output=True).returncode == 0
+
+
+needs_cargo = pytest.mark.skipif(not has_nightly_cargo(), reason="needs a nightly cargo")
+
+
+@pytest.fixture
+def isolated(tmp_path, monkeypatch):
+    monkeypatch.setenv("GAINTRUST_CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setenv("GAINTRUST_TARGET_DIR", str(tmp_path / "shared"))
+    monkeypatch.setenv("GAINTRUST_COMPILE_CACHE", "0")
+    monkeypatch.setattr(crates, "_warmed", set())
+    return tmp_path
+
+
+@pytest.fixture
+def offline(monkeypatch):
+    # crates without dependencies build without the registry
+    monkeypatch.setattr(crates, "DEPENDENCIES", {})
+
+
+def test_seeding_drops_the_artifacts_of_the_warm_up_crate(isolated):
+    shared = isolated / "shared"
+    for path in [
+        "debug/.fingerprint/wspace-fd3af777b4f32d70/lib-wspace",
+        "debug/.fingerprint/rand-0123456789abcdef/lib-rand",
+        "debug/deps/libwspace-fd3af777b4f32d70.rmeta",
+        "debug/deps/wspace-fd3af777b4f32d70.d",
+        "debug/deps/librand-0123456789abcdef.rlib",
+        "debug/libwspace.rlib",
+        "debug/libwspace.d",
+    ]:
+        (shared / path).parent.mkdir(parents=True, exist_ok=True)
+        (shared / path).write_text("")
+
+    target_dir = crates.crate_target_dir(str(isolated / "work" / "wspace"))
+
+    seeded = sorted(
+        str(path.relative_to(target_dir))
+        for path in (isolated / "work" / "wspace" / "target").rglob("*")
+        if path.is_file()
+    )
+    assert seeded == [
+        "debug/.fingerprint/rand-0123456789abcdef/lib-rand",
+        "debug/deps/librand-0123456789abcdef.rlib",
+    ]
+    # the shared directory is left as is
+    assert (shared / "debug/deps/libwspace-fd3af777b4f32d70.rmeta").exists()
+
+
+@needs_cargo
+def test_first_check_of_a_new_crate_reports_errors(isolated, offline):
+    comp_output = utils.compile_and_record_query(
+        BROKEN, str(isolated / "w" / "wspace"), mode=utils.CHECK
+    )
+    assert utils.parse_error_json(comp_output)[-1] == 1
+
+
+@needs_cargo
+def test_check_and_build_count_the_same_errors(isolated, offline):
+    work_dir = str(isolated / "w" / "wspace")
+    code = BROKEN + "pub fn h() { undefined(); }\n"
+    checked = utils.compile_and_record_query(code, work_dir, mode=utils.CHECK)
+    built = utils.compile_and_record_query(code, work_dir, mode=utils.BUILD)
+    assert utils.parse_error_json(checked)[-1] == utils.parse_error_json(built)[-1] == 2
@@ -0,0 +1,80 @@
+import decomposition
+from decomposition import Function
+
+SOURCE = {
+    "Includes": ["#include <stdint.h>"],
+    "Enums": ["enum mode { A, B };"],
+    "TypeDefs": ["typedef struct point point_t;", "typedef int (*cmp_fn)(int, int);"],
+    "Defines": ["#define N 4"],
+    "Globals": [],
+    "Structs": ["struct point { int x; enum mode m; };"],
+    "Function Declarations": [
+        "int leaf(point_t *p);",
+        "int even(int x);",
+        "int odd(int x);",
+        "int top(int x);",
+    ],
+    "Function Implementations": [
+        "int leaf(point_t *p) { return p->x; }",
+        "int even(int x) { return x == 0 ? 1 : odd(x - 1); }",
+        "int odd(int x) { return x == 0 ? 0 : even(x - 1) + leaf(0); }",
+        "int top(int x) { cmp_fn f = 0; return even(x); }",
+    ],
+}
+
+
+def graph_of(calls):
+    return {name: Function(name, "", "", set(callees)) for name, callees in calls}
+
+
+def test_dependency_graph():
+    graph = decomposition.dependency_graph(SOURCE, "c")
+    assert list(graph) == ["leaf", "even", "odd", "top"]
+    assert graph["odd"].calls == {"even", "leaf"}
+    assert graph["leaf"].calls == set()
+    # types used through other types are included
+    assert graph["leaf"].types == {"point_t", "point", "mode"}
+    assert graph["top"].types == {"cmp_fn"}
+
+
+def test_components_condense_call_cycles():
+    graph = decomposition.dependency_graph(SOURCE, "c")
+    assert decomposition.components(graph) == [("leaf",), ("even", "odd"), ("top",)]
+
+
+def test_levels_translate_cycles_after_their_callees_and_before_their_callers():
+    graph = graph_of(
+        [("a", []), ("b", ["c"]), ("c", ["b", "a"]), ("e", ["b"]), ("f", ["f"]), ("h", ["e", "f"])]
+    )
+    assert decomposition.levels(graph) == [[("a",), ("f",)], [("b", "c")], [("e",)], [("h",)]]
+
+
+def test_levels_cover_every_function_once():
+    graph = graph_of([(str(idx), [str((idx * 7 + 3) % 20), str((idx * 3) % 20)]) for idx in range(20)])
+    names = [name for level in decomposition.levels(graph) for component in level for name in component]
+    assert sorted(names) == sorted(graph)
+
+
+def test_callees_are_transitive_and_in_source_order():
+    graph = graph_of([("a", []), ("b", ["c"]), ("c", ["b", "a"]), ("e", ["b"])])
+    assert decomposition.callees(graph, ("e",)) == ["a", "b", "c"]
+    assert decomposition.callees(graph, ("b", "c")) == ["a"]
+
+
+def test_rust_signatures():
+    code = "use std::x;\npub fn even(x: i32) -> i32 {\n    0\n}\nunsafe fn raw(\n    p: *const u8,\n) {}\n"
+    assert decomposition.rust_signatures(code) == {
+        "even": "pub fn even(x: i32) -> i32",
+        "raw": "unsafe fn raw( p: *const u8, )",
+    }
+
+
+def test_assemble_hoists_imports_once():
+    assembled = decomposition.assemble(
+        ["use a::b;\nstruct S;", "use a::b;\nuse c::d;\nfn f() {}", "use c::d;\nfn g() {}"]
+    )
+    assert assembled == "use a::b;\nuse c::d;\nstruct S;\nfn f() {}\nfn g() {}"
+
+
+def test_strip_in_scope():
+    assert decomposition.strip_in_scope("use a::b;\nuse c::d;\nfn f() {}", "use a::b;") == "use c::d;\nfn f() {}"
@@ -0,0 +1,83 @@
+import json
+import subprocess
+
+from error import Error
+from utils import parse_error_json
+
+MISMATCH = {
+    "message": "mismatched types",
+    "code": {"code": "E0308", "explanation": "..."},
+    "level": "error",
+    "spans": [
+        {
+            "file_name": "src/lib.rs",
+            "line_start": 1,
+            "column_start": 34,
+            "is_primary": True,
+            "text": [{"text": 'pub fn f() -> i32 { let x: i32 = "a"; x }'}],
+            "label": "expected `i32`, found `&str`",
+        }
+    ],
+    "children": [
+        {"message": "-Ztrack-diagnostics: created at compiler/rustc_hir_typeck/src/coercion.rs:1", "children": []},
+        {"message": "expected due to this", "children": []},
+    ],
+    "rendered": "error[E0308]: mismatched types\n",
+}
+
+
+def record(message, package_id="wspace 0.1.0 (path+file:///w/wspace)"):
+    # cargo writes compact records
+    return json.dumps(
+        {"reason": "compiler-message", "package_id": package_id, "message": message},
+        separators=(",", ":"),
+    )
+
+
+def completed(lines, returncode=101, stderr=b""):
+    stdout = "\n".join(lines).encode("utf-8")
+    return subprocess.CompletedProcess("cargo check", returncode, stdout, stderr)
+
+
+def test_error_from_diagnostic():
+    err = Error.from_diagnostic(MISMATCH)
+    assert err.code == "error[E0308]:"
+    assert err.message == " mismatched types"
+    assert err.location == "src/lib.rs:1:34"
+    assert 'let x: i32 = "a"' in err.context
+    assert "expected `i32`, found `&str`" in err.context
+    assert err.diagnostic == "rustc_hir_typeck"
+    assert err.residual == "expected due to this\n"
+
+
+def test_error_without_code():
+    err = Error.from_diagnostic({"message": "cannot find function `g`", "level": "error"})
+    assert err.code == "error:"
+    assert err.location == ""
+
+
+def test_parse_error_json_counts_errors_of_local_crates_only():
+    warning = dict(MISMATCH, level="warning", code=None)
+    abort = dict(MISMATCH, message="aborting due to 1 previous error", code=None)
+    dependency = record(MISMATCH, package_id="registry+https://github.com/rust-lang/crates.io-index#rand@0.8.4")
+    errors, err_code_num, err_diag_num, _, num_errors = parse_error_json(
+        completed([record(MISMATCH), record(warning), record(abort), dependency, "not json"])
+    )
+    assert num_errors == 1
+    assert err_code_num == {"error[E0308]:": 1}
+    assert err_diag_num == {"rustc_hir_typeck": 1}
+    assert errors[0].location == "src/lib.rs:1:34"
+
+
+def test_parse_error_json_reports_cargo_failures():
+    comp_output = completed([], stderr=b"warning: x\nerror: failed to parse manifest")
+    assert parse_error_json(comp_output)[-1] == 1
+
+
+def test_parse_error_json_reports_silent_cargo_failures():
+    errors = parse_error_json(completed([], returncode=-9))[0]
+    assert [err.code for err in errors] == ["error:"]
+
+
+def test_parse_error_json_of_a_clean_build():
+    assert parse_error_json(completed([], returncode=0))[-1] == 0
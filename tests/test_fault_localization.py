@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+
+import fault_localization
+import utils
+
+# 4 examples x 3 lines, the last two examples fail
+COVERAGE = np.array(
+    [
+        [1, 1, 0],
+        [1, 0, 0],
+        [1, 1, 1],
+        [1, 0, 1],
+    ],
+    dtype=bool,
+)
+FAILING = np.array([False, False, True, True])
+
+
+def test_spectrum_counts_passing_and_failing_coverage():
+    ep, ef, np_, nf = fault_localization.spectrum(COVERAGE, FAILING)
+    assert ep.tolist() == [2, 1, 0]
+    assert ef.tolist() == [2, 1, 2]
+    assert np_.tolist() == [0, 1, 2]
+    assert nf.tolist() == [0, 1, 0]
+
+
+def test_spectrum_rejects_mismatched_shapes():
+    with pytest.raises(ValueError):
+        fault_localization.spectrum(COVERAGE, FAILING[:3])
+
+
+def test_only_failing_line_ranks_first():
+    # dstar scores an empty denominator 1 whatever the failing coverage
+    for technique in set(fault_localization.FORMULAS) - {"dstar"}:
+        scores = fault_localization.suspiciousness(COVERAGE, FAILING, technique)
+        ranked = fault_localization.rank(scores, ["a", "b", "c"])
+        assert ranked[0][2] == "c", technique
+
+
+def test_tarantula():
+    scores = fault_localization.suspiciousness(COVERAGE, FAILING, "tarantula")
+    # fail ratio / (fail ratio + pass ratio)
+    assert scores.tolist() == pytest.approx([0.5, 0.5, 1.0])
+    # the baseline computed 1 + pass ratio for covered lines
+    assert utils.tarantula(1, 1, 1, 1) == pytest.approx(0.5)
+    assert utils.tarantula(0, 2, 0, 2) == 0
+
+
+def test_ochiai():
+    scores = fault_localization.suspiciousness(COVERAGE, FAILING, "ochiai")
+    assert scores.tolist() == pytest.approx([2 / np.sqrt(8), 1 / np.sqrt(4), 1.0])
+    assert utils.ochiai(0, 0, 1, 1) == 0
+
+
+def test_dstar_keeps_the_baseline_score_for_an_empty_denominator():
+    scores = fault_localization.suspiciousness(COVERAGE, FAILING, "dstar")
+    assert scores.tolist() == pytest.approx([8 / 2, 1 / 2, 1.0])
+    assert utils.dstar(2, 0, 0, 5) == 1
+    assert utils.dstar(0, 0, 0, 5) == 1
+
+
+def test_unknown_technique():
+    with pytest.raises(ValueError):
+        fault_localization.suspiciousness(COVERAGE, FAILING, "unknown")
+
+
+def test_rank_keeps_line_order_on_ties():
+    ranked = fault_localization.rank(np.array([0.5, 1.0, 0.5]), ["a", "b", "c"], top=2)
+    assert ranked == [(1, 1.0, "b"), (0, 0.5, "a")]
@@ -0,0 +1,14 @@
+import contextvars
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable
+
+
+class ContextThreadPoolExecutor(ThreadPoolExecutor):
+    """
+    A ThreadPoolExecutor running every task in a copy of the context of the
+    thread submitting it, so that context variables, e.g. the benchmark a
+    record is logged for, follow the work to the worker threads.
+    """
+
+    def submit(self, fn: Callable[..., Any], /, *args: Any, **kwargs: Any) -> Future:
+        return super().submit(contextvars.copy_context().run, fn, *args, **kwargs)
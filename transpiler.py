@@ -1,9 +1,11 @@
 import json
 import logging
-import anthropic
+from typing import Callable, Dict, Tuple
 from llms import QueryEngine, Prompt
 from utils import *
-import csv
+import crates
+import decomposition
+from threads import ContextThreadPoolExecutor
 
 
 class Transpiler:
@@ -19,6 +21,9 @@ class Transpiler:
         transpl_attempt_budget,
         work_dir,
         model_params={"temperature": 0.2},
+        compile_mode=CHECK,
+        parallel_candidates=1,
+        samples_per_call=1,
     ) -> None:
         self.src_lang = src_lang
         self.benchmark = benchmark
@@ -34,6 +39,10 @@ class Transpiler:
         self.hint = ""
         self.model_params = model_params
         self.work_dir = work_dir
+        self.compile_mode = compile_mode
+        self.parallel_candidates = parallel_candidates
+        self.samples_per_call = samples_per_call
+        self.crate_pool = None
 
     def transpile(self):
         if self.prompt == "base" or self.prompt == "c2rust":
@@ -42,6 +51,8 @@ class Transpiler:
             return self.transpile_mutate()
         elif self.prompt == "decomp-iter":
             return self.transpile_decomp_iter()
+        elif self.prompt == "decomp-dag":
+            return self.transpile_decomp_dag()
 
     def update_prompt(self, cur_code, cur_answer):
         prompt = Prompt(
@@ -65,84 +76,32 @@ class Transpiler:
         return prompt
 
     def transpile_decomp_iter(self):
-        compiles = False
         logging.info(f"Now transpiling {self.fname}.")
 
         src_dir = f"{self.work_dir}/wspace/"
         res_dir = f"{self.work_dir}/results/"
 
         source_dict = json.load(open(f"{self.benchmark_path}/{self.fname}.json", "r"))
-        imports = source_dict["Includes"]
-        structs = source_dict["Structs"]
         declarations = source_dict["Function Declarations"]
         implementations = source_dict["Function Implementations"]
-        enums = source_dict["Enums"]
-        defines = source_dict["Defines"]
-        type_defs = source_dict["TypeDefs"]
-        global_vars = source_dict["Globals"]
-        all_aux = (
-            "\n".join(enums)
-            + "\n"
-            + "\n".join(type_defs)
-            + "\n"
-            + "\n".join(defines)
-            + "\n"
-            + "\n".join(global_vars)
-        )
 
         func_name = "header"
 
-        all_imp = "\n".join(imports)
-        all_st = "\n".join(structs)
-        # cur_code = "\n" + all_imp + "\n" + all_st
-        cur_code = "\n" + all_imp + "\n" + all_aux + "\n" + all_st
+        cur_code = decomposition.header_code(source_dict)
         cur_answer = ""
 
-        prompt = Prompt(
-            context=f"You are given a {self.src_lang.capitalize()} code contained in <code> tags. "
-            + "This code contains only import statements and possibly structs and gloabal variables. We need to translate this code piece to Rust.\n"
-            + tag(cur_code, "code"),
-            instruction=f"Give me the Rust translation of the above {self.src_lang.capitalize()} code.",
-            constraints=[
-                "Make sure it includes all imports, uses safe rust, and compiles.",
-                "Don't use raw pointers.",
-                "Use box pointer whenever possible. Box pointers are preferable to other alternatives.",
-                "Try not to use Traits if possible. I would not like to have Traits in resulting Rust code.",
-                "Try not to use custom Generics if possible.",
-                "Do not give me main function.",
-            ],
-        )
+        prompt = self.header_prompt(cur_code)
 
         for func_dec, func_impl in zip(declarations, implementations):
             logging.info(f"   Working on {func_name} function.")
 
-            min_num_errs = 2**32
-            for attempt in range(1, self.transpl_attempt_budget + 1):
-                # answer = claude_gen(
-                #     self.query_engine, prompt, model_params=self.model_params
-                # )
-                # cand_answer_processed, comp_out = postprocess(
-                #     answer, src_dir, prompt, log_id=func_name
-                # )
-                answer = self.query_engine.generate_code(prompt, model_params=self.model_params)
-                cand_answer_processed = answer
-                comp_out = compile_and_record_query(answer, src_dir, self.query_engine.stringify_prompt(prompt), log_id=func_name)
-                parsed_comp_out = parse_error_timepass(comp_out.stderr, self.fname)
-                num_errs = parsed_comp_out[-1]
-
-                logging.info(f"\tAttempt {attempt}: {num_errs} errors.")
-                if num_errs < min_num_errs:
-                    min_num_errs = num_errs
-                    best_answer_processed = cand_answer_processed
-
-                if not num_errs:
-                    break
-
-
+            best_answer_processed, _ = self.best_sample(
+                prompt, lambda answer: answer, self.compiler(src_dir, prompt), func_name
+            )
             # answer_processed, _ = postprocess(
             #     best_answer_processed, src_dir, prompt, log_id=func_name
             # )
-            _ = compile_and_record_query(best_answer_processed, src_dir, self.query_engine.stringify_prompt(prompt), log_id=func_name)
+            _ = compile_and_record_query(best_answer_processed, src_dir, self.query_engine.stringify_prompt(prompt), log_id=func_name, mode=self.compile_mode)
             answer_processed = best_answer_processed
 
             cur_answer += answer_processed
@@ -150,42 +109,30 @@ class Transpiler:
 
             prompt = self.update_prompt(cur_code, cur_answer)
 
-            if self.src_lang == "c":
-                func_name = (
-                    func_dec.split("(")[0].split("\n")[-1].strip().split(" ")[-1]
-                )
-            else:
-                func_name = (
-                    func_impl.split("{")[0]
-                    .split("(")[-2]
-                    .split("\n")[-1]
-                    .strip()
-                    .split(" ")[-1]
-                )
+            func_name = decomposition.function_name(func_dec, func_impl, self.src_lang)
 
         logging.info(f"   Working on {func_name} function.")
-        min_num_errs = 2**32
-        for attempt in range(1, self.transpl_attempt_budget + 1):
-            answer = self.query_engine.generate_code(prompt, model_params=self.model_params)
-            cand_answer_processed = answer
-            comp_out = compile_and_record_query(answer, src_dir, self.query_engine.stringify_prompt(prompt), log_id=func_name)
-
-            parsed_comp_out = parse_error_timepass(comp_out.stderr, self.fname)
-            num_errs = parsed_comp_out[-1]
-
-            logging.info(f"\tAttempt {attempt}: {num_errs} errors.")
-            if num_errs < min_num_errs:
-                min_num_errs = num_errs
-                best_answer_processed = cand_answer_processed
-
-            if not num_errs:
-                break
-
+        best_answer_processed, _ = self.best_sample(
+            prompt, lambda answer: answer, self.compiler(src_dir, prompt), func_name
+        )
         cur_answer += best_answer_processed
 
-        comp_out = compile_and_record_query(cur_answer, src_dir, self.query_engine.stringify_prompt(prompt), log_id=func_name)
+        return self.finish_decomposition(
+            cur_answer, self.query_engine.stringify_prompt(prompt), func_name, src_dir, res_dir
+        )
+
+    def finish_decomposition(
+        self, cur_answer: str, prompt_str: str, func_name: str, src_dir: str, res_dir: str
+    ) -> bool:
+        """
+        Build the assembled translation of a decomposition, fix it if it does
+        not compile, and record it in res_dir if it does.
+        """
+        compiles = False
+        # the assembled translation is handed to the oracle, so build it fully
+        comp_out = compile_and_record_query(cur_answer, src_dir, prompt_str, log_id=func_name, mode=BUILD)
         answer_processed = cur_answer
-        parsed_comp_out = parse_error_timepass(comp_out.stderr, self.fname)
+        parsed_comp_out = parse_error_json(comp_out)
 
         if self.comp_fixer.fix_type == "comp-msft-fix" and parsed_comp_out[-1]:
             logging.info(
@@ -200,7 +147,7 @@ class Transpiler:
             logging.info(
                 f"\t\tNum errors decreased from {init_num_err} to {fnl_num_err}. Fix path was {self.comp_fixer.fix_path}."
             )
-            if not fnl_num_err:
+            if not fnl_num_err and self.builds(rust_code, src_dir):
                 os.makedirs(f"{res_dir}", exist_ok=True)
                 subprocess.run(
                     f"cp {self.benchmark_path}/{self.fname}.json {res_dir}/", shell=True
@@ -227,7 +174,7 @@ class Transpiler:
             logging.info(
                 f"\t\tNum errors decreased from {init_num_err} to {fnl_comp_out[-1]}. Fix path was {self.comp_fixer.fix_path}."
             )
-            if not fnl_comp_out[-1]:
+            if not fnl_comp_out[-1] and self.builds(rust_code, src_dir):
                 os.makedirs(f"{res_dir}/", exist_ok=True)
                 subprocess.run(
                     f"cp {self.benchmark_path}/{self.fname}.json {res_dir}/", shell=True
@@ -255,11 +202,248 @@ class Transpiler:
             compiles = True
 
         # clean project to reduce size
-        with cd(f"{src_dir}"):
-            subprocess.run("cargo clean", capture_output=True, shell=True)
+        crates.clean(src_dir)
 
         return compiles
 
+    def header_prompt(self, header_code: str) -> Prompt:
+        return Prompt(
+            context=f"You are given a {self.src_lang.capitalize()} code contained in <code> tags. "
+            + "This code contains only import statements and possibly structs and gloabal variables. We need to translate this code piece to Rust.\n"
+            + tag(header_code, "code"),
+            instruction=f"Give me the Rust translation of the above {self.src_lang.capitalize()} code.",
+            constraints=[
+                "Make sure it includes all imports, uses safe rust, and compiles.",
+                "Don't use raw pointers.",
+                "Use box pointer whenever possible. Box pointers are preferable to other alternatives.",
+                "Try not to use Traits if possible. I would not like to have Traits in resulting Rust code.",
+                "Try not to use custom Generics if possible.",
+                "Do not give me main function.",
+            ],
+        )
+
+    def transpile_decomp_dag(self):
+        """
+        Translate the header, then the functions level by level along their
+        call graph. The functions of a level are translated concurrently, each
+        prompted with only the C types it uses and the Rust signatures of the
+        functions it calls, and compiled against its translated callees.
+        Functions of a call cycle are translated together, as one component.
+        """
+        logging.info(f"Now transpiling {self.fname} along its call graph.")
+
+        src_dir = f"{self.work_dir}/wspace/"
+        res_dir = f"{self.work_dir}/results/"
+
+        source_dict = json.load(open(f"{self.benchmark_path}/{self.fname}.json", "r"))
+        graph = decomposition.dependency_graph(source_dict, self.src_lang)
+        definitions = decomposition.type_definitions(source_dict)
+
+        logging.info("   Working on header.")
+        header_prompt = self.header_prompt(decomposition.header_code(source_dict))
+        header, _ = self.best_sample(
+            header_prompt, lambda answer: answer, self.compiler(src_dir, header_prompt), "header"
+        )
+
+        # translations of components, i.e. of single functions or call cycles
+        translations: Dict[Tuple[str, ...], str] = {}
+        pool = self.pool()
+        for level in decomposition.levels(graph):
+            logging.info(f"   Working on {', '.join('/'.join(component) for component in level)} concurrently.")
+            with ContextThreadPoolExecutor(max_workers=max(1, self.parallel_candidates)) as executor:
+                futures = {
+                    component: executor.submit(
+                        self.translate_component, graph, definitions, component, header, translations, pool
+                    )
+                    for component in level
+                }
+                level_translations = {component: future.result() for component, future in futures.items()}
+            translations.update(level_translations)
+
+        cur_answer = decomposition.assemble(
+            [header] + [translations[component] for component in decomposition.components(graph)]
+        )
+        return self.finish_decomposition(
+            cur_answer, self.query_engine.stringify_prompt(header_prompt), "assembled", src_dir, res_dir
+        )
+
+    def translate_component(
+        self,
+        graph: Dict[str, decomposition.Function],
+        definitions: Dict[str, str],
+        component: Tuple[str, ...],
+        header: str,
+        translations: Dict[Tuple[str, ...], str],
+        pool: crates.CratePool,
+    ) -> str:
+        """
+        Translate a function, or the functions of a call cycle together, given
+        the translations of the components they call.
+
+        Returns:
+            str: The candidate with the fewest errors when compiled after the
+            header and its callees.
+        """
+        functions = [graph[name] for name in component]
+        component_of = {name: translated for translated in translations for name in translated}
+        callees = list(
+            dict.fromkeys(
+                translations[component_of[callee]]
+                for callee in decomposition.callees(graph, component)
+            )
+        )
+        calls = set().union(*(function.calls for function in functions)) - set(component)
+        signatures = decomposition.rust_signatures(
+            "\n".join(dict.fromkeys(translations[component_of[callee]] for callee in calls))
+        )
+        types = "\n".join(
+            definitions[type_name]
+            for type_name in sorted(set().union(*(function.types for function in functions)))
+        )
+        in_scope = header + "\n" + "\n".join(
+            f"{signature} {{ ... }}" for name, signature in signatures.items() if name in calls
+        )
+        what = f"the {component[0]} function" if len(component) == 1 else f"the {', '.join(component)} functions"
+        cycle = "" if len(component) == 1 else " They call each other, so they have to be translated together."
+
+        prompt = Prompt(
+            context=f"You are given {what} in {self.src_lang.capitalize()} contained in <code> tags, along with the types used. We need to translate this code to Rust.{cycle}\n"
+            + tag(types + "\n" + "\n".join(function.implementation for function in functions), "code")
+            + "\nThe following Rust code, contained in <code> tags, is already translated and in scope. Bodies of the functions it calls are omitted.\n"
+            + tag(in_scope, "code"),
+            instruction=f"Give me the Rust translation of {what} only.",
+            constraints=[
+                "Use the same function name, same argument and return types.",
+                "Do not repeat the code that is already in scope.",
+                "Don't use raw pointers.",
+                "Use box pointer whenever possible. Box pointers are preferable to other alternatives.",
+                "Try not to use Traits if possible. I would not like to have Traits in resulting Rust code.",
+                "Try not to use custom Generics if possible.",
+                "Do not give me main function.",
+            ],
+        )
+        prompt_str = self.query_engine.stringify_prompt(prompt)
+
+        def compile_candidate(code: str, log_id: str) -> subprocess.CompletedProcess:
+            with pool.crate() as crate_dir:
+                return compile_and_record_query(
+                    decomposition.assemble([header] + callees + [code]),
+                    crate_dir,
+                    prompt_str,
+                    log_id=log_id,
+                    target_dir=crates.CratePool.target_dir(crate_dir),
+                    mode=self.compile_mode,
+                    log_dir=f"{self.work_dir}/wspace/logs",
+                )
+
+        translation, _ = self.best_sample(
+            prompt,
+            # imports already in scope are dropped, the rest are hoisted by assemble
+            lambda answer: decomposition.strip_in_scope(answer, "\n".join([header] + callees)),
+            compile_candidate,
+            "_".join(component),
+        )
+        return translation
+
+    def best_sample(
+        self,
+        prompt: Prompt,
+        process: Callable[[str], str],
+        compile_code: Callable[[str, str], subprocess.CompletedProcess],
+        log_id: str,
+    ) -> Tuple[str, int]:
+        """
+        Draw samples of prompt until one compiles or the attempt budget runs out.
+
+        Returns:
+            Tuple[str, int]: The candidate with the fewest errors and its number of errors.
+        """
+        min_num_errs = 2**32
+        best = ""
+        samples = self.query_engine.code_samples(
+            prompt, self.transpl_attempt_budget, self.samples_per_call, self.model_params
+        )
+        for attempt, answer in enumerate(samples, 1):
+            candidate = process(answer)
+            comp_out = compile_code(candidate, f"{log_id}_{attempt}")
+            num_errs = parse_error_json(comp_out)[-1]
+            logging.info(f"\t{log_id} attempt {attempt}: {num_errs} errors.")
+            if num_errs < min_num_errs:
+                min_num_errs, best = num_errs, candidate
+            if not num_errs:
+                break
+        return best, min_num_errs
+
+    def compiler(
+        self, work_dir: str, prompt: Prompt
+    ) -> Callable[[str, str], subprocess.CompletedProcess]:
+        """
+        Compiles candidates for prompt in work_dir, for best_sample.
+        """
+        prompt_str = self.query_engine.stringify_prompt(prompt)
+        return lambda code, log_id: compile_and_record_query(
+            code, work_dir, prompt_str, log_id=log_id, mode=self.compile_mode
+        )
+
+    def pool(self) -> crates.CratePool:
+        if self.crate_pool is None:
+            self.crate_pool = crates.CratePool(
+                f"{self.work_dir}/pool",
+                self.parallel_candidates,
+                COMPILE_RUSTFLAGS,
+                self.compile_mode,
+            )
+        return self.crate_pool
+
+    def transpile_concurrently(self, prompt):
+        """
+        Requests all attempts up front and compiles them concurrently in the
+        crates of a pool, stopping at the first candidate without errors.
+
+        Returns:
+            Tuple[str, int, int]: The best candidate, its number of errors and
+            the number of candidates compiled.
+        """
+        candidates = self.query_engine.generate_codes(
+            prompt, self.transpl_attempt_budget, model_params=self.model_params
+        )
+        with open(f"{self.work_dir}/initial_translation.txt", "a") as f:
+            for attempt, candidate in enumerate(candidates, 1):
+                f.write(f"==========(ATTEMPT {attempt})==========\n\n{candidate}\n\n")
+
+        all_num_errs = compile_concurrently(
+            candidates,
+            self.pool(),
+            f"{self.work_dir}/wspace",
+            self.query_engine.stringify_prompt(prompt),
+            mode=self.compile_mode,
+        )
+
+        min_num_errs = 2**32
+        best_candidate = candidates[0]
+        num_attempts = 0
+        for attempt, (candidate, num_errs) in enumerate(zip(candidates, all_num_errs), 1):
+            if num_errs is None:
+                logging.info(f"\tAttempt {attempt}: cancelled.")
+                continue
+            num_attempts += 1
+            logging.info(f"\tAttempt {attempt}: {num_errs} errors.")
+            if num_errs < min_num_errs:
+                min_num_errs = num_errs
+                best_candidate = candidate
+
+        return best_candidate, min_num_errs, num_attempts
+
+    def builds(self, rust_code: str, src_dir: str) -> bool:
+        """
+        Whether a candidate that passed the compile loop also survives a full build.
+        Candidates are handed to the oracle only after this check.
+        """
+        if self.compile_mode == BUILD:
+            return True
+        comp_out = compile_and_record_query(rust_code, src_dir, log_id="final", mode=BUILD)
+        return not parse_error_json(comp_out)[-1]
+
     def write_src_code_to_res_dir(self, res_dir: str, src_code: str):
         with open(f"{res_dir}/{self.fname}.{self.src_lang}", "w") as fw:
             fw.write(src_code)
@@ -340,52 +524,52 @@ class Transpiler:
 
         min_num_errs = 2**32
         initial_translation_attempts = 0
-        for attempt in range(1, self.transpl_attempt_budget + 1):
-            initial_translation_attempts += 1
-            cand_answer_processed = self.query_engine.generate_code(
-                prompt, model_params=self.model_params
+        if self.parallel_candidates > 1:
+            (
+                best_answer_processed,
+                min_num_errs,
+                initial_translation_attempts,
+            ) = self.transpile_concurrently(prompt)
+        else:
+            samples = self.query_engine.code_samples(
+                prompt, self.transpl_attempt_budget, self.samples_per_call, self.model_params
             )
-            # print("DEBUG: Prompted model")
-            with open(f"{self.work_dir}/initial_translation.txt", "a") as f:
-                f.write(f"==========(ATTEMPT {attempt})==========\n\n{cand_answer_processed}\n\n")
+            for attempt, cand_answer_processed in enumerate(samples, 1):
+                initial_translation_attempts += 1
+                # print("DEBUG: Prompted model")
+                with open(f"{self.work_dir}/initial_translation.txt", "a") as f:
+                    f.write(f"==========(ATTEMPT {attempt})==========\n\n{cand_answer_processed}\n\n")
 
-            comp_out = compile_and_record_query(cand_answer_processed, src_dir, self.query_engine.stringify_prompt(prompt))
-            print("DEBUG: Compiled and recorded")
+                comp_out = compile_and_record_query(cand_answer_processed, src_dir, self.query_engine.stringify_prompt(prompt), mode=self.compile_mode)
+                print("DEBUG: Compiled and recorded")
 
-            cand_init_comp_out = parse_error_timepass(comp_out.stderr, self.fname)
-            num_errs = cand_init_comp_out[-1]
+                cand_init_comp_out = parse_error_json(comp_out)
+                num_errs = cand_init_comp_out[-1]
 
-            logging.info(f"\tAttempt {attempt}: {num_errs} errors.")
-            if num_errs < min_num_errs:
-                min_num_errs = num_errs
-                best_answer_processed = cand_answer_processed
+                logging.info(f"\tAttempt {attempt}: {num_errs} errors.")
+                if num_errs < min_num_errs:
+                    min_num_errs = num_errs
+                    best_answer_processed = cand_answer_processed
 
-            if not num_errs:
-                break
+                if not num_errs:
+                    break
 
         if min_num_errs == 0:
             initial_translation = True
         else:
             initial_translation = False
 
-        with open("measurements.csv", 'r', newline='') as csvfile:
-            reader = list(csv.reader(csvfile))
-
-            if len(reader) > 1:
-                last_row = reader[-1]
-                last_row.append(f'{initial_translation}')  # Updating 'initial_translation'
-                last_row.append(f'{initial_translation_attempts}')  # Updating 'initial_translation_attempts'
-                last_row.append(f"{min_num_errs}") # Updating 'initial_translation_errors'
-          
-                with open("measurements.csv", 'w', newline='') as csvfile:
-                    writer = csv.writer(csvfile)
-                    writer.writerows(reader[:-1])
-                    writer.writerow(last_row)
+        record_measurement(
+            self.fname,
+            initial_translation,  # 'initial_translation'
+            initial_translation_attempts,  # 'initial_translation_attempts'
+            min_num_errs,  # 'initial_translation_errors'
+        )
         # below is needed to write the best program to file
         # answer_processed, comp_out = postprocess(best_answer_processed, src_dir, prompt)
-        comp_out = compile_and_record_query(best_answer_processed, src_dir, self.query_engine.stringify_prompt(prompt))
+        comp_out = compile_and_record_query(best_answer_processed, src_dir, self.query_engine.stringify_prompt(prompt), mode=BUILD)
         answer_processed = best_answer_processed
-        init_comp_out = parse_error_timepass(comp_out.stderr, self.fname)
+        init_comp_out = parse_error_json(comp_out)
 
         print("DEBUG: Finished attempted translation. Onto fixing.")
         # apply cargo fix
@@ -405,7 +589,7 @@ class Transpiler:
             logging.info(
                 f"\t\tNum errors decreased from {init_num_err} to {fnl_num_err}. Fix path was {self.comp_fixer.fix_path}."
             )
-            if not fnl_num_err:
+            if not fnl_num_err and self.builds(rust_code, src_dir):
                 os.makedirs(f"{res_dir}", exist_ok=True)
                 self.write_src_code_to_res_dir(res_dir, code)
                 with open(f"{res_dir}/{self.fname}.rs", "w") as fw:
@@ -438,29 +622,21 @@ class Transpiler:
                 f"\tNumber of errors decreased from {init_num_err} to {fnl_num_err} via LLM."
             )
 
-            with open("measurements.csv", 'r', newline='') as csvfile:
-                reader = list(csv.reader(csvfile))
-
             cl_style, cl_complex, cl_correct, cl_perf = clippy_linter_stats(rust_code, src_dir)
 
             print("DEBUG: Linting completed")
-            if len(reader) > 1:
-                last_row = reader[-1]
-                last_row.append(f"{cl_style}")  #Updating clippy style, complexity, correctness, and performance stats
-                last_row.append(f"{cl_complex}")
-                last_row.append(f"{cl_correct}")
-                last_row.append(f"{cl_perf}")
-
-                last_row.append(f'{fnl_num_err == 0}')  # Updating 'compiles'
-                last_row.append(f'{num_llm_call}')  # Updating 'compiles_attempts'
-                last_row.append(f"{fnl_num_err}") # Updating 'final_translation_errors'
-
-                with open("measurements.csv", 'w', newline='') as csvfile:
-                    writer = csv.writer(csvfile)
-                    writer.writerows(reader[:-1])
-                    writer.writerow(last_row)
-
-            if not fnl_num_err:
+            record_measurement(
+                self.fname,
+                cl_style,  # clippy style, complexity, correctness, and performance stats
+                cl_complex,
+                cl_correct,
+                cl_perf,
+                fnl_num_err == 0,  # 'compiles'
+                num_llm_call,  # 'compiles_attempts'
+                fnl_num_err,  # 'final_translation_errors'
+            )
+
+            if not fnl_num_err and self.builds(rust_code, src_dir):
                 os.makedirs(f"{res_dir}/", exist_ok=True)
                 self.write_src_code_to_res_dir(res_dir, code)
                 with open(f"{res_dir}/{self.fname}.rs", "w") as fw:
@@ -501,7 +677,6 @@ class Transpiler:
             compiles = True
 
         # clean project to reduce size
-        with cd(f"{src_dir}"):
-            subprocess.run("cargo clean", capture_output=True, shell=True)
+        crates.clean(src_dir)
 
         return compiles
@@ -1,15 +1,20 @@
 import os
 import re
+import csv
 import json
 import logging
-import anthropic
+import functools
+import threading
 import subprocess
-import matplotlib.pyplot as plt
 from error import Error
+from cache import DiskCache, digest
+import crates
+import fault_localization
 from pathlib import Path
-from typing import List
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 from collections import defaultdict, Counter
 from contextlib import contextmanager
+from threads import ContextThreadPoolExecutor
 from tenacity import retry, wait_random_exponential
 
 #for maintainability
@@ -466,6 +471,8 @@ def make_prompt(
     assert code
     assert preamble
     assert instruction
+    import anthropic
+
     prompt = f"""{anthropic.HUMAN_PROMPT}\n\n{preamble + tag(code, "code") + tag(examples, "testcases") + enhancement + instruction}{anthropic.AI_PROMPT}"""
 
     return prompt
@@ -533,6 +540,8 @@ def claude_gen(query_engine, prompt, model_params={"temperature": 0.2}):
 
 def clean_answer_llm(answer):
     # TODO Maybe try later, but below mechanical clean works well so far.
+    import anthropic
+
     cln_instruction = "\n\nIf there is any non-code related text above, clean it. I only want the code back. \n\n"
     cln_prompt = (
         f"""{anthropic.HUMAN_PROMPT} {answer + cln_instruction} {anthropic.AI_PROMPT}"""
@@ -644,54 +653,239 @@ def clean_answer_mech(answer):
     return answer
 
 
+COMPILE_RUSTFLAGS = "-Z track-diagnostics -Z time-passes"
+
+# "check" only emits metadata, which is all we need for counting errors.
+# "build" runs codegen as well and is used for candidates we keep.
+CHECK = "check"
+BUILD = "build"
+COMPILE_COMMANDS = {
+    CHECK: "cargo check --manifest-path Cargo.toml --message-format=json",
+    BUILD: "cargo build --manifest-path Cargo.toml --message-format=json",
+}
+
+# compilation results keyed by everything that can influence the compiler output
+compile_cache = DiskCache(
+    "compile", int(os.environ.get("GAINTRUST_COMPILE_CACHE_MB", "512")) * 2**20
+)
+
+
+def compile_cache_enabled() -> bool:
+    return os.environ.get("GAINTRUST_COMPILE_CACHE", "1") != "0"
+
+
+@functools.lru_cache(maxsize=None)
+def rustc_version(work_dir: str) -> str:
+    # resolved per directory since rust-toolchain files can pin another toolchain
+    return subprocess.run(
+        "rustc -vV", capture_output=True, shell=True, cwd=work_dir
+    ).stdout.decode("utf-8")
+
+
+def compile_cache_key(code: str, work_dir: str, mode: str) -> str:
+    with open(Path(work_dir) / "Cargo.toml", "r", encoding="utf-8") as f:
+        manifest = f.read()
+    return digest(
+        code,
+        manifest,
+        COMPILE_RUSTFLAGS,
+        COMPILE_COMMANDS[mode],
+        rustc_version(str(Path(work_dir).resolve())),
+    )
+
+
+def load_compile_result(key: str, mode: str) -> Optional[subprocess.CompletedProcess]:
+    entry = compile_cache.get(key)
+    if entry is None:
+        return None
+    try:
+        returncode = int((entry / "returncode").read_text())
+        stdout = (entry / "stdout").read_bytes()
+        stderr = (entry / "stderr").read_bytes()
+    except (FileNotFoundError, ValueError):
+        return None
+    return subprocess.CompletedProcess(COMPILE_COMMANDS[mode], returncode, stdout, stderr)
+
+
+def store_compile_result(key: str, comp_output: subprocess.CompletedProcess) -> None:
+    with compile_cache.put(key) as entry:
+        (entry / "stdout").write_bytes(comp_output.stdout)
+        (entry / "stderr").write_bytes(comp_output.stderr)
+        (entry / "returncode").write_text(str(comp_output.returncode))
+
+
+def cargo_compile(
+    work_dir: str,
+    target_dir: Optional[str] = None,
+    clean: bool = True,
+    mode: str = BUILD,
+) -> subprocess.CompletedProcess:
+    """
+    Compiles the crate at work_dir in its own target directory, seeded with the
+    compiled dependencies.
+
+    Only the crate itself is cleaned beforehand, so dependencies are not rebuilt.
+    """
+    if target_dir is None:
+        crates.warm_dependencies(COMPILE_RUSTFLAGS, mode)
+        target_dir = crates.crate_target_dir(work_dir)
+    if clean:
+        crates.clean(work_dir, target_dir)
+    return subprocess.run(
+        COMPILE_COMMANDS[mode],
+        capture_output=True,
+        shell=True,
+        cwd=work_dir,
+        env=crates.cargo_env(work_dir, COMPILE_RUSTFLAGS, target_dir),
+    )
+
+
 def compile_and_record_query(
-    code: str, work_dir: str, prompt: str = "", log_id=0
+    code: str,
+    work_dir: str,
+    prompt: str = "",
+    log_id=0,
+    use_cache: bool = True,
+    target_dir: Optional[str] = None,
+    mode: str = BUILD,
+    log_dir: Optional[str] = None,
 ) -> subprocess.CompletedProcess:
-    crate_toml = Path(work_dir) / "Cargo.toml"
-    if not crate_toml.exists():
+    """
+    Args:
+        log_dir (Optional[str]): Where the candidate and its diagnostics are
+            logged, defaults to the logs directory of work_dir.
+    """
+    crate_exists = not crates.init_crate(work_dir)
+    if not crate_exists:
         print("DEBUG: Initializing crate")
-        if not Path(work_dir).exists():
-            subprocess.run(f"cargo new --lib {work_dir}", capture_output=True, shell=True)
-        else:
-            subprocess.run(f"cargo init --lib {work_dir}", capture_output=True, shell=True)
-        # Add default dependencies
-        with open(crate_toml, "a", encoding="utf-8") as fw:
-            fw.write("\n[dependencies]\n")
-            fw.write('rand = "0.8.4"\n')
-            fw.write('libc = "0.2"\n')
-            fw.write('regex = "1.10.2"\n')
-            fw.write('lazy_static = "1.4.0"\n')
-            fw.write('once_cell = "1.19.0"\n')
-    else:
-        print("DEBUG: Crate exists, cleaning")
-        with cd(work_dir):
-            subprocess.run("cargo clean", capture_output=True, shell=True)
 
-    os.makedirs(f"{work_dir}/logs", exist_ok=True)
-    os.makedirs(f"{work_dir}/src", exist_ok=True)
-    with open(f"{work_dir}/logs/prog_{log_id}.ans", "w") as f:
+    log_dir = log_dir or f"{work_dir}/logs"
+    os.makedirs(log_dir, exist_ok=True)
+    with open(f"{log_dir}/prog_{log_id}.ans", "w") as f:
         f.write(f"{prompt}\n\n==========\n\n{code}")
-    with open(f"{work_dir}/logs/prog_{log_id}.rs", "w") as f:
+    with open(f"{log_dir}/prog_{log_id}.rs", "w") as f:
         f.write(code)  # for logging purpose
     with open(f"{work_dir}/src/lib.rs", "w", encoding="utf-8") as f:
         f.write(code)  # will be overwritten by feedback fixes
 
-    with cd(f"{work_dir}"):
-        comp_output = subprocess.run(
-            f'RUSTFLAGS="-Z track-diagnostics -Z time-passes" cargo build --manifest-path Cargo.toml',
-            capture_output=True,
-            shell=True,
-        )
-    
-    print("DEBUG: Called cargo build")
+    use_cache = use_cache and compile_cache_enabled()
+    comp_output: Optional[subprocess.CompletedProcess] = None
+    if use_cache:
+        key = compile_cache_key(code, work_dir, mode)
+        comp_output = load_compile_result(key, mode)
+        if comp_output is not None:
+            logging.info(f"Reusing cached compilation result. {compile_cache.stats()}")
+
+    if comp_output is None:
+        comp_output = cargo_compile(work_dir, target_dir, clean=crate_exists, mode=mode)
+        print(f"DEBUG: Called cargo {mode}")
+
+        if use_cache:
+            store_compile_result(key, comp_output)
 
     # comp_output = subprocess.run(f"rustc --out-dir {work_dir} -Z track-diagnostics {work_dir}/{fname_wout_ext}.rs", capture_output=True, shell=True)
-    with open(f"{work_dir}/logs/prog_{log_id}.err", "wb") as file:
+    with open(f"{log_dir}/prog_{log_id}.err", "wb") as file:
+        file.write(rendered_diagnostics(comp_output).encode("utf-8"))
         file.write(comp_output.stderr)
 
     return comp_output
 
 
+def compile_concurrently(
+    codes: List[str],
+    pool: "crates.CratePool",
+    work_dir: str,
+    prompt: str = "",
+    mode: str = CHECK,
+) -> List[Optional[int]]:
+    """
+    Compiles candidates concurrently, each in its own crate of the pool.
+
+    Compilation itself happens in cargo subprocesses, so a thread per crate is
+    enough to keep all of them busy. Once a candidate compiles without errors,
+    candidates that have not started yet are cancelled. Candidates are logged
+    under work_dir, since crates of the pool are reused.
+
+    Returns:
+        List[Optional[int]]: Number of errors per candidate, None if cancelled.
+    """
+    clean_found = threading.Event()
+
+    def compile_one(idx: int, code: str) -> Optional[int]:
+        if clean_found.is_set():
+            return None
+        with pool.crate() as crate_dir:
+            comp_output = compile_and_record_query(
+                code,
+                crate_dir,
+                prompt,
+                log_id=idx,
+                target_dir=crates.CratePool.target_dir(crate_dir),
+                mode=mode,
+                log_dir=f"{work_dir}/logs",
+            )
+        num_errs = parse_error_json(comp_output)[-1]
+        if not num_errs:
+            clean_found.set()
+        return num_errs
+
+    with ContextThreadPoolExecutor(max_workers=pool.size) as executor:
+        futures = [
+            executor.submit(compile_one, idx, code) for idx, code in enumerate(codes)
+        ]
+        return [future.result() for future in futures]
+
+
+MEASUREMENTS_CSV = "measurements.csv"
+MEASUREMENT_FIELDS = [
+    "model_name",
+    "file_name",
+    "initial_translation",
+    "initial_translation_attempts",
+    "initital_translation_errors",
+    "clippy_style",
+    "clippy_complexity",
+    "clippy_correctness",
+    "clippy_performance",
+    "compiles",
+    "compiles_attempts",
+    "final_translation_errors",
+]
+
+# rows are updated in place, so concurrent benchmarks must take turns
+_measurements_lock = threading.Lock()
+
+
+def start_measurement(model_name: str, file_name: str) -> None:
+    """
+    Appends a new row for file_name to measurements.csv, creating the file if needed.
+    """
+    with _measurements_lock:
+        if not os.path.exists(MEASUREMENTS_CSV):
+            with open(MEASUREMENTS_CSV, "w", newline="") as csvfile:
+                csv.writer(csvfile).writerow(MEASUREMENT_FIELDS)
+        with open(MEASUREMENTS_CSV, "a", newline="") as csvfile:
+            csv.writer(csvfile).writerow([model_name, file_name])
+
+
+def record_measurement(file_name: str, *values: Any) -> None:
+    """
+    Appends values to the latest row of file_name in measurements.csv.
+    """
+    with _measurements_lock:
+        if not os.path.exists(MEASUREMENTS_CSV):
+            return
+        with open(MEASUREMENTS_CSV, "r", newline="") as csvfile:
+            rows = list(csv.reader(csvfile))
+        for row in reversed(rows[1:]):
+            if len(row) > 1 and row[1] == file_name:
+                row.extend(str(value) for value in values)
+                break
+        else:
+            return
+        with open(MEASUREMENTS_CSV, "w", newline="") as csvfile:
+            csv.writer(csvfile).writerows(rows)
+
 
 def rudra_suggest(work_dir: str, log_id) -> str:
     """Generate rudra suggestions by explaining Rust error codes."""
@@ -731,58 +925,59 @@ def clippy_linter_stats(code, work_dir):
 
     print(f"DEBUG: Using work_dir = {work_path}")
 
-    with cd(work_path):
-        print("DEBUG: Cleaning cargo project...")
-        subprocess.run("cargo clean", capture_output=True, shell=True)
-
-        print("DEBUG: Writing new code to src/lib.rs...")
-        lib_rs.write_text(code)
-
-        print("DEBUG: Running cargo clippy...")
-        result = subprocess.run(
-            "cargo clippy --message-format=json",
-            shell=True,
-            check=False,
-            capture_output=True,
-            text=True
-        )
-        print("DEBUG: Clippy exited with code:", result.returncode)
+    print("DEBUG: Cleaning cargo project...")
+    crates.clean(str(work_path))
+
+    print("DEBUG: Writing new code to src/lib.rs...")
+    lib_rs.write_text(code)
+
+    print("DEBUG: Running cargo clippy...")
+    result = subprocess.run(
+        "cargo clippy --message-format=json",
+        shell=True,
+        check=False,
+        capture_output=True,
+        text=True,
+        cwd=work_path,
+        env=crates.cargo_env(str(work_path)),
+    )
+    print("DEBUG: Clippy exited with code:", result.returncode)
 
-        output_lines = result.stdout.splitlines()
-        if result.returncode != 0:
-            print("DEBUG: Clippy failed, adding stderr")
-            output_lines += result.stderr.splitlines()
+    output_lines = result.stdout.splitlines()
+    if result.returncode != 0:
+        print("DEBUG: Clippy failed, adding stderr")
+        output_lines += result.stderr.splitlines()
 
-        else:
-            print("DEBUG: Clippy completed successfully")
-
-        category_counts = Counter()
-        print(category_counts)
-        # Combine stdout and stderr for parsing
-        # output_lines = result.stdout.splitlines() + result.stderr.splitlines()
-        for line in output_lines:
-            line = line.strip()
-            if not line.startswith("{"):
-                continue  # skip malformed or irrelevant lines
-            try:
-                msg = json.loads(line)
-                if msg.get("reason") == "compiler-message":
-                    message = msg.get("message")
-                    if not isinstance(message, dict):
-                        continue
-                    code_info = message.get("code") or {}
-                    lint_code = code_info.get("code", "")
-                    if lint_code.startswith("clippy::"):
-                        lint_name = extract_category(lint_code)
-                        category = LINT_CATEGORY_MAP.get(lint_name)
-                        if category in categories:
-                            category_counts[category] += 1
-            except Exception as e:
-                print("Unhandled exception:", e)
-                continue
+    else:
+        print("DEBUG: Clippy completed successfully")
+
+    category_counts = Counter()
+    print(category_counts)
+    # Combine stdout and stderr for parsing
+    # output_lines = result.stdout.splitlines() + result.stderr.splitlines()
+    for line in output_lines:
+        line = line.strip()
+        if not line.startswith("{"):
+            continue  # skip malformed or irrelevant lines
+        try:
+            msg = json.loads(line)
+            if msg.get("reason") == "compiler-message":
+                message = msg.get("message")
+                if not isinstance(message, dict):
+                    continue
+                code_info = message.get("code") or {}
+                lint_code = code_info.get("code", "")
+                if lint_code.startswith("clippy::"):
+                    lint_name = extract_category(lint_code)
+                    category = LINT_CATEGORY_MAP.get(lint_name)
+                    if category in categories:
+                        category_counts[category] += 1
+        except Exception as e:
+            print("Unhandled exception:", e)
+            continue
 
-        print("Final counts:", category_counts)
-        return tuple(category_counts[cat] for cat in categories)
+    print("Final counts:", category_counts)
+    return tuple(category_counts[cat] for cat in categories)
 
 
 
@@ -791,23 +986,9 @@ def postprocess(answer, work_dir, prompt="", log_id=0):
     # if "fn main" not in answer_clean:
     #     answer_clean += "\n\nfn main(){}\n"
 
-    crate_toml = Path(work_dir) / "Cargo.toml"
-    if not crate_toml.exists():
+    crate_exists = not crates.init_crate(work_dir)
+    if not crate_exists:
         print("DEBUG: Initializing crate for postprocess")
-        if not Path(work_dir).exists():
-            subprocess.run(f"cargo new --lib {work_dir}", capture_output=True, shell=True)
-        else:
-            subprocess.run(f"cargo init --lib {work_dir}", capture_output=True, shell=True)
-        # Add default dependencies
-        with open(crate_toml, "a", encoding="utf-8") as fw:
-            fw.write('rand = "0.8.4"\n')
-            fw.write('libc = "0.2"\n')
-            fw.write('regex = "1.10.2"\n')
-            fw.write('lazy_static = "1.4.0"\n')
-            fw.write('once_cell = "1.19.0"\n')
-    else:
-        with cd(work_dir):
-            subprocess.run("cargo clean", capture_output=True, shell=True)
 
     os.makedirs(f"{work_dir}/logs", exist_ok=True)
     with open(f"{work_dir}/logs/prog_{log_id}.ans", "w") as f:
@@ -817,21 +998,19 @@ def postprocess(answer, work_dir, prompt="", log_id=0):
     with open(f"{work_dir}/src/lib.rs", "w", encoding="utf-8") as f:
         f.write(answer_clean)  # will be overwritten by feedback fixes
 
-    with cd(f"{work_dir}"):
-        comp_output = subprocess.run(
-            f'RUSTFLAGS="-Z track-diagnostics -Z time-passes" cargo build --manifest-path Cargo.toml',
-            capture_output=True,
-            shell=True,
-        )
+    comp_output = cargo_compile(work_dir, clean=crate_exists)
 
     # comp_output = subprocess.run(f"rustc --out-dir {work_dir} -Z track-diagnostics {work_dir}/{fname_wout_ext}.rs", capture_output=True, shell=True)
-    with open(f"{work_dir}/logs/prog_{log_id}.err", "wb") as file:
+    with open(f"{log_dir}/prog_{log_id}.err", "wb") as file:
+        file.write(rendered_diagnostics(comp_output).encode("utf-8"))
         file.write(comp_output.stderr)
 
     return answer_clean, comp_output
 
 
 def plot_err(paths, data):
+    import matplotlib.pyplot as plt
+
     def autopct_format(values):
         def my_format(pct):
             total = sum(values)
@@ -861,16 +1040,104 @@ def plot_err(paths, data):
     # fig.savefig(f"transpilations/{src_lang}/{bm_path}/base/{out_folder}/error_dist_after_fix.pdf")
 
 
+def compiler_messages(stdout: bytes) -> Iterator[Dict[str, Any]]:
+    """
+    Streams the diagnostics of local crates out of cargo's --message-format=json output.
+    """
+    for line in stdout.splitlines():
+        # cheap pre-filter, most records are artifact notifications
+        if b'"reason":"compiler-message"' not in line:
+            continue
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError:
+            continue
+        # skip diagnostics of registry dependencies
+        if record.get("package_id", "").startswith("registry+"):
+            continue
+        yield record["message"]
+
+
+def rendered_diagnostics(comp_output: subprocess.CompletedProcess) -> str:
+    return "".join(
+        message.get("rendered") or ""
+        for message in compiler_messages(comp_output.stdout)
+    )
+
+
+def parse_time_passes(stderr: bytes) -> List[Tuple[str, float]]:
+    """
+    Extracts the -Z time-passes timings of the local crate from cargo's stderr.
+
+    Returns:
+        List[Tuple[str, float]]: Compilation steps in order with their duration in seconds.
+    """
+    timings = []
+    for line in stderr.decode("utf-8", errors="ignore").splitlines():
+        if re.match(r"\s*(Compiling|Checking) ", line):
+            # only keep the passes of the last crate, i.e. the candidate
+            timings = []
+        elif line.startswith("time:"):
+            duration = line[len("time:") :].split(";", 1)[0].strip()
+            try:
+                timings.append((re.split(r"\s+", line)[-1], float(duration)))
+            except ValueError:
+                continue
+    return timings
+
+
+def parse_error_json(comp_output: subprocess.CompletedProcess):
+    """
+    Parses compilation errors from the JSON diagnostics of compile_and_record_query.
+
+    Returns the same tuple as parse_error_timepass: errors, number of errors per
+    error code, number of errors per compiler component, compilation steps and
+    the total number of errors.
+    """
+    errors = []
+    err_code_num, err_diag_num = defaultdict(int), defaultdict(int)
+    for message in compiler_messages(comp_output.stdout):
+        if message["level"] not in ("error", "error: internal compiler error"):
+            continue
+        if message["message"].startswith("aborting due to"):
+            continue
+        err = Error.from_diagnostic(message)
+        errors.append(err)
+        err_code_num[err.code] += 1
+        err_diag_num[err.diagnostic] += 1
+
+    if comp_output.returncode and not errors:
+        # cargo failed before rustc could report anything, e.g. a broken manifest
+        stderr = comp_output.stderr.decode("utf-8", errors="ignore")
+        if "error" in stderr:
+            err = Error(stderr[stderr.find("error"):])
+        else:
+            # e.g. cargo killed by a signal, Error needs an error line to parse
+            err = Error(f"error: cargo exited with code {comp_output.returncode}\n{stderr}")
+        errors.append(err)
+        err_code_num[err.code] += 1
+        err_diag_num[err.diagnostic] += 1
+
+    common_comp_steps = ["free_global_ctxt", "total"]
+    compilation_steps = [
+        step
+        for step, _ in parse_time_passes(comp_output.stderr)
+        if step not in common_comp_steps
+    ]
+
+    print("DEBUG: Found errors:", len(errors))
+    return errors, err_code_num, err_diag_num, compilation_steps, len(errors)
+
+
 def parse_error_timepass(stderr, fname):
     print("DEBUG: Parsing errors")
     lines = stderr.decode("utf-8").splitlines()
-    ln_cnt = 0
-    line = lines[ln_cnt]
-    while (
-        f"Compiling wspace" not in line
-    ):  # WATCHOUT HERE: wspace is the name of the cargo project. Has to be updated if the path that we write transpiled rust code changes
-        ln_cnt += 1
-        line = lines[ln_cnt]
+    # WATCHOUT HERE: wspace is the name of the cargo project. Has to be updated if the path that we write transpiled rust code changes
+    ln_cnt = -1
+    for idx, line in enumerate(lines):
+        if "Compiling wspace" in line or "Checking wspace" in line:
+            ln_cnt = idx
+            break
 
     relevant_lines = lines[ln_cnt + 1 :]
 
@@ -1043,26 +1310,15 @@ def parse_coverage(cov_report):
 
 
 def dstar(num_cf, num_uf, num_cs, num_us, star=3):
-    if num_cs + num_uf == 0:
-        return 1
-    return num_cf**star / (num_cs + num_uf)
+    return float(fault_localization.dstar(num_cs, num_cf, num_us, num_uf, star))
 
 
 def tarantula(num_cf, num_uf, num_cs, num_us):
-    try:
-        return num_cf / (num_cf + num_uf) / (num_cf / (num_cf + num_uf)) + (
-            num_cs / (num_cs + num_us)
-        )
-    except ZeroDivisionError:
-        return 0
+    return float(fault_localization.tarantula(num_cs, num_cf, num_us, num_uf))
 
 
 def ochiai(num_cf, num_uf, num_cs, num_us):
-    try:
-        return num_cf / ((num_cf + num_uf) * (num_cf + num_cs)) ** (0.5)
-    except ZeroDivisionError:
-        return 0
-
+    return float(fault_localization.ochiai(num_cs, num_cf, num_us, num_uf))
 
 
 def prepare_c2rust(src_lang, benchmark, fname):